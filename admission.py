@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import os
+import math
+import time
+import logging
+import threading
+from collections import deque
+from functools import wraps
+
+from flask import g, jsonify
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Generations running at once per worker; anything above waits in a bounded queue
+MAX_ACTIVE = int(os.getenv('MOOSIC_MAX_ACTIVE_GENERATIONS', '4'))
+MAX_QUEUED = int(os.getenv('MOOSIC_MAX_QUEUED_GENERATIONS', '8'))
+QUEUE_TIMEOUT = float(os.getenv('MOOSIC_QUEUE_TIMEOUT_SECONDS', '10'))
+
+# Degradation steps in the order they switch on: (step, queue depth, recent
+# latency in seconds). A step is active when either threshold is reached.
+DEFAULT_LADDER = [
+    ('skip_era_filter', 1, 8.0),
+    ('skip_quoted_search', 2, 12.0),
+    ('reduce_target', 4, 20.0),
+]
+STEPS = {step for step, _, _ in DEFAULT_LADDER}
+
+
+def parse_ladder(value):
+    """Parse 'skip_era_filter:1:8,reduce_target:4:20' into a ladder"""
+    ladder = []
+    for item in (value or '').split(','):
+        parts = item.strip().split(':')
+        if len(parts) != 3 or parts[0] not in STEPS:
+            continue
+        try:
+            ladder.append((parts[0], int(parts[1]), float(parts[2])))
+        except ValueError:
+            continue
+    return ladder
+
+
+LADDER = parse_ladder(os.getenv('MOOSIC_DEGRADATION_LADDER')) or DEFAULT_LADDER
+
+
+class Gate:
+    """
+    Bounded concurrency limit with a bounded wait queue. Also keeps the
+    latencies of recently finished requests to size Retry-After and to drive
+    the degradation ladder.
+    """
+
+    def __init__(self, max_active=MAX_ACTIVE, max_queued=MAX_QUEUED, queue_timeout=QUEUE_TIMEOUT, window=20):
+        self.max_active = max(1, max_active)
+        self.max_queued = max(0, max_queued)
+        self.queue_timeout = queue_timeout
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self._cond = threading.Condition()
+        self.active = 0
+        self.queued = 0
+        self._latencies = deque(maxlen=self.window)
+
+    def acquire(self):
+        """Take a slot, waiting in the queue if needed. Returns False when full or timed out"""
+        with self._cond:
+            if self.active < self.max_active and not self.queued:
+                self.active += 1
+                return True
+            if self.queued >= self.max_queued:
+                return False
+            self.queued += 1
+            try:
+                deadline = time.monotonic() + self.queue_timeout
+                while self.active >= self.max_active:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.queued -= 1
+
+    def release(self, elapsed):
+        with self._cond:
+            self.active -= 1
+            self._latencies.append(elapsed)
+            self._cond.notify()
+
+    def recent_latency(self):
+        """Mean latency of the last `window` requests, 0 before any finished"""
+        latencies = list(self._latencies)
+        return sum(latencies) / len(latencies) if latencies else 0.0
+
+    def retry_after(self):
+        """Seconds until the queue has likely drained enough to take another request"""
+        waves = (self.queued + self.active) / self.max_active
+        return max(1, math.ceil(waves * (self.recent_latency() or 1.0)))
+
+    def degradation(self):
+        """Steps of the ladder that apply at the current queue depth and latency"""
+        queued, latency = self.queued, self.recent_latency()
+        return frozenset(step for step, depth, seconds in LADDER if queued >= depth or latency >= seconds)
+
+
+GATE = Gate()
+os.register_at_fork(after_in_child=GATE.reset)
+
+
+def degraded(step):
+    """Whether the current request runs with `step` of the degradation ladder"""
+    return step in g.get('degradation', ())
+
+
+def admitted(view):
+    """
+    Run the view inside the shared generation gate. Requests that find the
+    queue full, or wait longer than QUEUE_TIMEOUT, get a fast 503 with
+    Retry-After instead of piling onto the upstream APIs.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        waited = time.perf_counter()
+        if not GATE.acquire():
+            retry_after = GATE.retry_after()
+            metrics.admission_rejected(view.__name__)
+            logger.warning("Rejecting %s: %s active, %s queued, retry after %ss",
+                           view.__name__, GATE.active, GATE.queued, retry_after)
+            response = jsonify({'error': 'Server is busy, please try again shortly', 'retryAfter': retry_after})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+
+        start = time.perf_counter()
+        metrics.admission_wait(view.__name__, start - waited)
+        g.degradation = GATE.degradation()
+        for step in g.degradation:
+            metrics.degraded(step)
+        if g.degradation:
+            logger.info("Degrading %s: %s", view.__name__, ', '.join(sorted(g.degradation)))
+        try:
+            return view(*args, **kwargs)
+        finally:
+            GATE.release(time.perf_counter() - start)
+
+    return wrapper
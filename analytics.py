@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Append-only analytics log of playlist requests, for capacity questions the
+live metrics cannot answer per request: upstream calls per generation, LLM
+hit rate, which fallbacks fire, latency by prompt class.
+
+Views wrapped in @recorded append one row per request to a SQLite table
+(MOOSIC_ANALYTICS_DB). Rows are queued and written in batches by a
+background thread, off the request path. Report with:
+
+    python analytics.py report --since 24
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import logging
+import argparse
+import threading
+from functools import wraps
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv('MOOSIC_ANALYTICS_DB', '/tmp/moosic_analytics.sqlite3')
+ENABLED = os.getenv('MOOSIC_ANALYTICS', 'true').lower() in ('1', 'true', 'yes')
+BATCH_SIZE = 200
+FLUSH_INTERVAL = 1.0
+MAX_PENDING = 10000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS requests (
+    ts REAL NOT NULL,
+    endpoint TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    duration_ms REAL NOT NULL,
+    prompt_class TEXT,
+    degradation TEXT,
+    stages TEXT,
+    upstream TEXT,
+    llm_attempted INTEGER,
+    llm_resolved INTEGER,
+    sources TEXT,
+    tracks INTEGER
+);
+CREATE INDEX IF NOT EXISTS requests_ts ON requests (ts);
+'''
+COLUMNS = ('ts', 'endpoint', 'status', 'duration_ms', 'prompt_class', 'degradation',
+           'stages', 'upstream', 'llm_attempted', 'llm_resolved', 'sources', 'tracks')
+JSON_COLUMNS = ('stages', 'upstream', 'sources')
+
+
+def connect(path):
+    connection = sqlite3.connect(path, timeout=10)
+    # WAL lets every worker append while a report reads
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class AnalyticsLog:
+    def __init__(self, path=DB_PATH, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.after_fork()
+
+    def after_fork(self):
+        self._queue = queue.Queue(self.max_pending)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._connection = None
+
+    def append(self, row):
+        """Queue one row; drops it (and counts the drop) rather than block a request"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            metrics.analytics_dropped()
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='analytics-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, rows):
+        try:
+            if self._connection is None:
+                self._connection = connect(self.path)
+            with self._connection:
+                self._connection.executemany(
+                    f"INSERT INTO requests ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                    [tuple(row.get(column) for column in COLUMNS) for row in rows])
+        except sqlite3.Error as e:
+            logger.warning("Could not write %s analytics rows: %s", len(rows), e)
+            self._connection = None
+
+    def flush(self):
+        """Write whatever is queued from the calling thread, e.g. at exit"""
+        rows = []
+        while True:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if rows:
+            self._write(rows)
+
+
+LOG = AnalyticsLog(DB_PATH)
+
+
+def note(**fields):
+    """Attach fields (prompt_class, stages, sources, llm_attempted, ...) to the current request's row"""
+    from flask import g
+    row = g.get('analytics')
+    if row is not None:
+        row.update(fields)
+
+
+def recorded(view):
+    """Append a row describing each request to the view to the analytics log"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return view(*args, **kwargs)
+        from flask import g, make_response
+        g.analytics = {}
+        start = time.perf_counter()
+        status = 500
+        try:
+            with metrics.counting_upstream_calls() as calls:
+                response = make_response(view(*args, **kwargs))
+            status = response.status_code
+            return response
+        finally:
+            row = g.analytics
+            LOG.append({
+                'ts': time.time(),
+                'endpoint': view.__name__,
+                'status': status,
+                'duration_ms': round((time.perf_counter() - start) * 1000, 1),
+                'prompt_class': row.get('prompt_class'),
+                'degradation': ','.join(sorted(g.get('degradation') or ())) or None,
+                'stages': json.dumps({stage: round(seconds * 1000, 1)
+                                      for stage, seconds in (row.get('stages') or {}).items()}),
+                'upstream': json.dumps(calls),
+                'llm_attempted': row.get('llm_attempted'),
+                'llm_resolved': row.get('llm_resolved'),
+                'sources': json.dumps(row.get('sources') or {}),
+                'tracks': row.get('tracks'),
+            })
+
+    return wrapper
+
+
+def _after_fork():
+    LOG.after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+atexit.register(LOG.flush)
+
+
+# -- report ---------------------------------------------------------------
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def load_rows(path, since_hours=None, endpoint=None):
+    query = f"SELECT {', '.join(COLUMNS)} FROM requests WHERE 1=1"
+    params = []
+    if since_hours:
+        query += " AND ts >= ?"
+        params.append(time.time() - since_hours * 3600)
+    if endpoint:
+        query += " AND endpoint = ?"
+        params.append(endpoint)
+    connection = connect(path)
+    try:
+        rows = [dict(zip(COLUMNS, values)) for values in connection.execute(query, params)]
+    finally:
+        connection.close()
+    for row in rows:
+        for column in JSON_COLUMNS:
+            row[column] = json.loads(row[column] or '{}')
+    return rows
+
+
+def _latency_line(label, durations):
+    return (f"  {label:<28} {len(durations):>6} {percentile(durations, 50):9.0f} "
+            f"{percentile(durations, 95):9.0f} {percentile(durations, 99):9.0f}")
+
+
+def report(rows, out=sys.stdout):
+    if not rows:
+        print("No analytics rows", file=out)
+        return
+    header = f"  {'':<28} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    for endpoint in sorted({row['endpoint'] for row in rows}):
+        subset = [row for row in rows if row['endpoint'] == endpoint]
+        ok = [row for row in subset if row['status'] < 400]
+        statuses = {}
+        for row in subset:
+            statuses[row['status']] = statuses.get(row['status'], 0) + 1
+        print(f"\n== {endpoint}: {len(subset)} requests, statuses "
+              f"{', '.join(f'{s}: {n}' for s, n in sorted(statuses.items()))} ==", file=out)
+
+        print(header, file=out)
+        print(_latency_line('all (2xx/3xx)', [row['duration_ms'] for row in ok]), file=out)
+        for prompt_class in sorted({row['prompt_class'] for row in ok if row['prompt_class']}):
+            print(_latency_line(f"prompt class {prompt_class}",
+                                [row['duration_ms'] for row in ok if row['prompt_class'] == prompt_class]), file=out)
+        for degradation in sorted({row['degradation'] for row in ok if row['degradation']}):
+            print(_latency_line(f"degraded {degradation}",
+                                [row['duration_ms'] for row in ok if row['degradation'] == degradation]), file=out)
+
+        stages = sorted({stage for row in ok for stage in row['stages']})
+        if stages:
+            print(f"\n  {'stage':<28} {'runs':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}", file=out)
+            for stage in stages:
+                print(_latency_line(stage, [row['stages'][stage] for row in ok if stage in row['stages']]), file=out)
+
+        calls = sorted({call for row in ok for call in row['upstream']})
+        if calls:
+            print(f"\n  {'upstream calls':<28} {'mean':>9} {'p95':>9} {'max':>9}", file=out)
+            for call in calls:
+                counts = [row['upstream'].get(call, 0) for row in ok]
+                print(f"  {call:<28} {sum(counts) / len(counts):9.2f} {percentile(counts, 95):9.0f} "
+                      f"{max(counts):9.0f}", file=out)
+
+        attempted = [row for row in ok if row['llm_attempted']]
+        if attempted:
+            print(f"\n  {'LLM hit rate':<28} {'attempted':>9} {'resolved':>9} {'rate':>9}", file=out)
+            for prompt_class in sorted({row['prompt_class'] or 'unknown' for row in attempted}):
+                subset_attempted = [row for row in attempted if (row['prompt_class'] or 'unknown') == prompt_class]
+                total = sum(row['llm_attempted'] for row in subset_attempted)
+                resolved = sum(row['llm_resolved'] or 0 for row in subset_attempted)
+                print(f"  {prompt_class:<28} {total:9} {resolved:9} {resolved / total:9.0%}", file=out)
+
+        sources = sorted({source for row in ok for source in row['sources']})
+        if sources:
+            print(f"\n  {'track source':<28} {'fired':>9} {'mean':>9} {'share':>9}", file=out)
+            all_tracks = sum(sum(row['sources'].values()) for row in ok) or 1
+            for source in sources:
+                counts = [row['sources'].get(source, 0) for row in ok]
+                fired = sum(1 for count in counts if count)
+                print(f"  {source:<28} {fired / len(ok):9.0%} {sum(counts) / len(ok):9.1f} "
+                      f"{sum(counts) / all_tracks:9.0%}", file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate the request analytics log')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    report_parser = subparsers.add_parser('report', help='Print percentiles and breakdowns')
+    report_parser.add_argument('--db', default=DB_PATH, help='Analytics SQLite file')
+    report_parser.add_argument('--since', type=float, help='Only the last N hours')
+    report_parser.add_argument('--endpoint', help='Only one view, e.g. generate_playlist')
+    report_parser.add_argument('--json', action='store_true', help='Print the raw rows as JSON lines')
+    args = parser.parse_args()
+
+    rows = load_rows(args.db, args.since, args.endpoint)
+    if args.json:
+        for row in rows:
+            print(json.dumps(row))
+    else:
+        report(rows)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,8 +17,8 @@ application = app
 if __name__ == '__main__':
     try:
         port = int(os.environ.get('PORT', 3001))
-        logger.info(f'Starting application on port {port}')
+        logger.info('Starting application on port %s', port)
         application.run(host='0.0.0.0', port=port)
     except Exception as e:
-        logger.error(f'Failed to start application: {str(e)}')
+        logger.error('Failed to start application: %s', str(e))
         raise
\ No newline at end of file
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Batch generation: several playlists from one request, generated
+concurrently. The caller fetches the user's token and taste profile once;
+within the batch, identical upstream reads (searches, album lookups) are
+made once and shared, and the generations' suggestion requests are sent as
+one combined LLM call when the model's completion budget allows it.
+"""
+
+import os
+import time
+import logging
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+import suggestion_backends
+
+logger = logging.getLogger(__name__)
+
+MAX_PLAYLISTS = int(os.getenv('MOOSIC_BATCH_MAX_PLAYLISTS', '5'))
+# How long the first suggestion request of a batch waits for the others
+COMBINE_WINDOW = 0.25
+
+
+class SharedReads:
+    """Upstream reads keyed by what they ask for; a read already made or in flight is not repeated"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def get(self, key, fetch):
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = Future()
+        metrics.cache_lookup('batch_reads', not owner)
+        if owner:
+            try:
+                future.set_result(fetch())
+            except Exception as e:
+                # Waiting readers see the error; later ones try again
+                with self._lock:
+                    self._futures.pop(key, None)
+                future.set_exception(e)
+        return future.result()
+
+
+class CombinedSuggestions:
+    """
+    Collects the suggestion requests of a batch's generations. The first
+    request waits up to COMBINE_WINDOW for the generations that have not
+    asked yet, then sends everything collected as one combined call; each
+    generation gets its own list back. Requests the combined call did not
+    answer are sent on their own through the router.
+    """
+
+    def __init__(self, members, window=COMBINE_WINDOW):
+        self.window = window
+        self._cond = threading.Condition()
+        self._outstanding = members
+        self._pending = []
+
+    def member(self):
+        return _Member(self)
+
+    def _leave(self):
+        with self._cond:
+            self._outstanding -= 1
+            self._cond.notify_all()
+
+    def suggest(self, endpoint, request):
+        future = Future()
+        with self._cond:
+            self._outstanding -= 1
+            leader = not self._pending
+            self._pending.append((request, future))
+            self._cond.notify_all()
+            if leader:
+                deadline = time.monotonic() + self.window
+                while self._outstanding > 0 and time.monotonic() < deadline:
+                    self._cond.wait(deadline - time.monotonic())
+                gathered, self._pending = self._pending, []
+        if leader:
+            self._send(endpoint, gathered)
+        answer = future.result()
+        return answer if answer is not None else suggestion_backends.suggest(endpoint, request)
+
+    def _send(self, endpoint, gathered):
+        answers = None
+        if len(gathered) > 1:
+            try:
+                answers = suggestion_backends.combine(endpoint, [request for request, _ in gathered])
+            except Exception as e:
+                logger.warning("Could not combine %s suggestion requests: %s", len(gathered), e)
+        if answers is not None:
+            logger.info("Answered %s of %s suggestion requests with one combined call",
+                        sum(answer is not None for answer in answers), len(gathered))
+        for position, (_, future) in enumerate(gathered):
+            future.set_result(answers[position] if answers is not None else None)
+
+
+class _Member:
+    """One generation's view of CombinedSuggestions, called like suggestion_backends.suggest"""
+
+    def __init__(self, combined):
+        self._combined = combined
+        self._asked = False
+
+    def __call__(self, endpoint, request):
+        self._asked = True
+        return self._combined.suggest(endpoint, request)
+
+    def close(self):
+        # A generation that never asked must not keep the others waiting
+        if not self._asked:
+            self._asked = True
+            self._combined._leave()
+
+
+def generate_all(items, generate):
+    """
+    generate(item, suggest=..., reads=...) for every item (one playlist each)
+    concurrently, in the caller's context; the results in item order.
+    """
+    reads = SharedReads()
+    combined = CombinedSuggestions(len(items))
+
+    def one(item):
+        suggest = combined.member()
+        try:
+            return generate(item, suggest=suggest, reads=reads)
+        finally:
+            suggest.close()
+
+    with ThreadPoolExecutor(max_workers=max(1, len(items)), thread_name_prefix='batch') as pool:
+        futures = [pool.submit(contextvars.copy_context().run, one, item) for item in items]
+    return [future.result() for future in futures]
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the pure-Python work a generation does per request:
+parsing the LLM reply, cleaning suggestions for search, the suspicious
+track scan, intent detection, fuzzy artist matching, filtering candidate
+batches and building the tracks the client shows. Inputs come from
+benchmarks/fixtures: 25 and 100 suggestions, 100 search candidates.
+
+With pytest-benchmark installed, save a baseline and compare against it:
+
+    python -m pytest benchmarks/bench_hot_paths.py --benchmark-autosave
+    python -m pytest benchmarks/bench_hot_paths.py --benchmark-compare --benchmark-compare-fail=mean:10%
+
+Without it, `python benchmarks/bench_hot_paths.py` times the same cases.
+"""
+
+import os
+import sys
+import json
+import random
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import intent
+import responses
+import candidate_filter
+import resolution
+import suggestion_backends
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'spotify_tracks.json')
+
+DESCRIPTIONS = [
+    'top songs of 2016',
+    'chill lo-fi beats for studying',
+    'upbeat 80s rock for a road trip',
+    'sad indie folk for a rainy day',
+    'songs like Blinding Lights',
+    'energetic edm workout',
+    '90s hip-hop classics',
+    'romantic soul and r&b',
+    'happy pop for a party',
+    'relaxed jazz for sunday morning',
+]
+
+# Versions search turns up next to the originals
+VARIANTS = [' (Karaoke Version)', ' - Made Famous by the Original Artist', ' (Instrumental)', ' [Tribute]', '']
+
+
+def load_tracks():
+    with open(FIXTURES) as f:
+        return json.load(f)['tracks']
+
+
+def suggestion_reply(tracks, count, seed=1):
+    """An LLM reply listing `count` songs, numbered like the model sometimes does, ~10% made up"""
+    rng = random.Random(seed)
+    lines = []
+    for i in range(count):
+        if rng.random() < 0.1:
+            lines.append(f"{i + 1}. Imaginary Song {rng.randint(1, 10 ** 6)} by Nobody {rng.randint(1, 1000)}")
+        else:
+            track = tracks[i % len(tracks)]
+            lines.append(f"{i + 1}. {track['name']} by {track['artists'][0]['name']}")
+    return '\n'.join(lines)
+
+
+def candidates(tracks, count=100, seed=2):
+    """Search results: fixture tracks, some renamed to karaoke/cover versions"""
+    rng = random.Random(seed)
+    items = []
+    for i in range(count):
+        item = dict(tracks[i % len(tracks)])
+        item['name'] = item['name'] + rng.choice(VARIANTS)
+        items.append(item)
+    return items
+
+
+def build_cases():
+    """{name: (func, args)}, each func doing one request's worth of the work"""
+    tracks = load_tracks()
+    reply_25, reply_100 = suggestion_reply(tracks, 25), suggestion_reply(tracks, 100)
+    songs_100 = suggestion_backends.song_lines(suggestion_backends.parse_song_lines(reply_100))
+    items = candidates(tracks)
+    # Each suggestion's artist against ten search results, the last of them by that artist
+    artist_queries = [(items[50 + i:59 + i] + [tracks[i]], tracks[i]['artists'][0]['name']) for i in range(25)]
+
+    def search_terms(songs):
+        return [resolution.search_terms(song) for song in songs]
+
+    def suspicious_scan(items):
+        return [item for item in items if not intent.is_suspicious(item['name'])]
+
+    def read_intent(descriptions):
+        for description in descriptions:
+            description_lower = description.lower()
+            intent.prompt_class(description_lower)
+            intent.mood_profile(description_lower)
+            intent.detect_genres(description_lower)
+            intent.detect_era(description_lower)
+
+    def artist_matching(queries):
+        return [resolution.best_artist_match(results, artist) for results, artist in queries]
+
+    def filter_candidates(items):
+        # A 50-track playlist filled from a 100-candidate batch, era checked
+        selection = candidate_filter.CandidateFilter(limit=50, min_year=1970, max_year=2030)
+        return selection.accept(items, 'bench', check_era=True, min_popularity=40)
+
+    def track_summaries(items):
+        return [responses.track_summary(item, responses.IMAGE_SIZES['medium']) for item in items]
+
+    return {
+        'parse_song_lines_25': (suggestion_backends.parse_song_lines, (reply_25,)),
+        'parse_song_lines_100': (suggestion_backends.parse_song_lines, (reply_100,)),
+        'search_terms_100': (search_terms, (songs_100,)),
+        'suspicious_scan_100': (suspicious_scan, (items,)),
+        'intent_10_descriptions': (read_intent, (DESCRIPTIONS,)),
+        'best_artist_match_25': (artist_matching, (artist_queries,)),
+        'candidate_filter_100': (filter_candidates, (items,)),
+        'track_summary_100': (track_summaries, (items,)),
+    }
+
+
+if __name__ != '__main__':
+    import pytest
+
+    pytest.importorskip('pytest_benchmark')
+    CASES = build_cases()
+
+    @pytest.mark.parametrize('name', list(CASES))
+    def test_hot_path(benchmark, name):
+        func, args = CASES[name]
+        benchmark(func, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the per-request pure-Python hot paths')
+    parser.add_argument('--repeat', type=int, default=5, help='Timing rounds per case; the best is reported')
+    parser.add_argument('--only', help='Comma-separated case names')
+    args = parser.parse_args()
+
+    cases = build_cases()
+    names = [name.strip() for name in args.only.split(',')] if args.only else list(cases)
+    print(f"{'case':<26} {'best us':>10} {'loops':>8}")
+    for name in names:
+        func, func_args = cases[name]
+        timer = timeit.Timer(lambda: func(*func_args))
+        loops, _ = timer.autorange()
+        best = min(timer.repeat(repeat=args.repeat, number=loops)) / loops
+        print(f"{name:<26} {best * 1e6:10.1f} {loops:8d}")
+
+
+if __name__ == '__main__':
+    main()
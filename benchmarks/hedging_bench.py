@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Hedged request benchmark: times N searches against the Spotify stand-in
+with a slow tail, once plain and once through hedging.Hedger, and reports
+latency percentiles and the extra requests the hedges cost.
+
+    python benchmarks/hedging_bench.py --requests 2000 --spotify-slow-rate 0.02 --spotify-slow-ms 1500
+"""
+
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import hedging
+import metrics
+import stub_services
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[max(0, int(len(ordered) * pct / 100.0) - 1)]
+
+
+def run(search, total, concurrency):
+    def one(i):
+        start = time.perf_counter()
+        search(i)
+        return (time.perf_counter() - start) * 1000
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(one, range(total)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare search latency with and without hedging')
+    stub_services.add_stub_arguments(parser)
+    parser.add_argument('--requests', type=int, default=2000, help='Searches per run')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent searches')
+    parser.add_argument('--budget', type=float, default=hedging.BUDGET, help='Hedge budget (share of calls)')
+    parser.set_defaults(spotify_slow_rate=0.02, spotify_slow_ms=1500)
+    args = parser.parse_args()
+
+    stubs = stub_services.stub_environment_from_args(args).start()
+    url = f"{stubs.env()['SPOTIFY_API_URL']}/search"
+    session = requests.Session()
+    queries = ['love', 'night', 'summer', 'heart', 'dance', 'blue', 'fire', 'home']
+
+    def search(i):
+        return session.get(url, params={'q': queries[i % len(queries)], 'type': 'track', 'limit': 3})
+
+    hedger = hedging.Hedger(budget=args.budget)
+    try:
+        print(f"{args.requests} searches, {args.concurrency} concurrent, {args.spotify_slow_rate:.0%} "
+              f"take +{args.spotify_slow_ms:.0f} ms, budget {args.budget:.0%}")
+        print(f"{'':<10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'requests':>9}")
+        for label, func in (('plain', search), ('hedged', lambda i: hedger.call('spotify_search', lambda: search(i)))):
+            metrics.REGISTRY.reset()
+            stubs.reset_counts()
+            latencies = run(func, args.requests, args.concurrency)
+            sent = sum(stubs.call_counts().values())
+            print(f"{label:<10} {percentile(latencies, 50):8.1f} {percentile(latencies, 95):8.1f} "
+                  f"{percentile(latencies, 99):8.1f} {max(latencies):8.1f} {sent / args.requests:9.1%}")
+        hedges = {dict(labels)['outcome']: count for name, labels, count in metrics.REGISTRY.snapshot()['counters']
+                  if name == 'moosic_hedges_total'}
+        print(f"hedges: {hedges}")
+    finally:
+        stubs.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Offline load and latency benchmark for server.py.
+
+Starts the Spotify/OpenAI stand-ins from stub_services.py, points the server
+at them and drives /api/generate-playlist, /api/generate-playlists,
+/api/create-playlist, /api/playlist/<id>/extend and /api/check-auth at a
+target concurrency. Reports p50/p95/p99 latency,
+throughput and upstream calls per request for each endpoint.
+
+    python benchmarks/load_test.py --concurrency 8 --requests 40
+
+By default the server runs in-process on a threaded werkzeug server. To
+benchmark a real deployment (e.g. gunicorn), start the stand-ins with
+`python benchmarks/stub_services.py`, start the server with the printed
+environment and pass --target and --port-base.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_services import add_stub_arguments, stub_environment_from_args  # noqa: E402
+
+GENERATE_PROMPTS = [
+    'top songs of 2016',
+    'chill lo-fi beats for studying',
+    'upbeat 80s rock for a road trip',
+    'sad indie folk for a rainy day',
+    'songs like Blinding Lights',
+    'energetic edm workout',
+    '90s hip-hop classics',
+    'romantic soul and r&b',
+    'happy pop for a party',
+    'relaxed jazz for sunday morning',
+]
+# Descriptions per /api/generate-playlists request
+BATCH_SIZE = 3
+
+CREATE_PAYLOADS = [
+    {'mood': 'happy', 'genres': ['pop', 'dance'], 'playlistName': 'Bench happy'},
+    {'mood': 'chill', 'genres': ['indie', 'folk'], 'playlistName': 'Bench chill'},
+    {'mood': 'energetic', 'genres': ['rock'], 'playlistName': 'Bench energetic'},
+    {'mood': 'sad', 'genres': ['r&b', 'soul'], 'playlistName': 'Bench sad'},
+]
+
+SESSION_COOKIE = 'moosic_session'
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def start_in_process_server(stub_env):
+    """Import server.py against the stand-ins and serve it on a random port"""
+    os.environ.update(stub_env)
+    for key, value in {
+        'SPOTIFY_CLIENT_ID': 'bench-client',
+        'SPOTIFY_CLIENT_SECRET': 'bench-secret',
+        'SPOTIFY_REDIRECT_URI': 'http://127.0.0.1/api/callback',
+        'OPENAI_API_KEY': 'bench-key',
+        'FRONTEND_URL': 'http://127.0.0.1:5173',
+        'BACKEND_URL': 'http://127.0.0.1:3001',
+        'MOOSIC_LOG_FORMAT': 'text',
+        'LOG_LEVEL': 'WARNING',
+        # Start every run with an empty shared track store and recommender
+        'MOOSIC_TRACK_STORE_DIR': tempfile.mkdtemp(prefix='moosic_bench_tracks_'),
+        'MOOSIC_RECOMMENDER_DIR': tempfile.mkdtemp(prefix='moosic_bench_recommender_'),
+        'MOOSIC_GENERATION_STATE_DIR': tempfile.mkdtemp(prefix='moosic_bench_state_'),
+        'MOOSIC_SNAPSHOT_DIR': tempfile.mkdtemp(prefix='moosic_bench_snapshots_'),
+        'MOOSIC_TASTE_DIR': tempfile.mkdtemp(prefix='moosic_bench_taste_'),
+        'MOOSIC_CHECKPOINT_DIR': tempfile.mkdtemp(prefix='moosic_bench_checkpoints_'),
+        'MOOSIC_GENRE_SEEDS_PATH': os.path.join(tempfile.mkdtemp(prefix='moosic_bench_seeds_'), 'genre_seeds.json'),
+        'MOOSIC_CHART_INDEX': os.path.join(tempfile.mkdtemp(prefix='moosic_bench_charts_'), 'charts.json'),
+        'MOOSIC_ANALYTICS_DB': os.environ.get('MOOSIC_ANALYTICS_DB') or os.path.join(
+            tempfile.mkdtemp(prefix='moosic_bench_analytics_'), 'analytics.sqlite3'),
+    }.items():
+        os.environ.setdefault(key, value)
+
+    import logging
+    from werkzeug.serving import make_server
+    import server
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    httpd = make_server('127.0.0.1', 0, server.app, threaded=True)
+    thread = threading.Thread(target=httpd.serve_forever, name='bench-server', daemon=True)
+    thread.start()
+    return httpd, f"http://127.0.0.1:{httpd.server_port}"
+
+
+def login(target):
+    """
+    Run the PKCE callback against the stand-in token endpoint and return the
+    session cookie. Cookies are Secure, so they are sent by hand over http.
+    """
+    response = requests.post(f"{target}/api/callback", json={
+        'code': 'bench-code', 'state': 'bench-state', 'code_verifier': 'bench-verifier'
+    })
+    response.raise_for_status()
+    # The last Set-Cookie for the session cookie is the one the browser keeps
+    cookie = None
+    for header in response.raw.headers.getlist('Set-Cookie'):
+        name, _, rest = header.partition('=')
+        if name.strip() == SESSION_COOKIE:
+            cookie = rest.split(';', 1)[0]
+    if not cookie:
+        raise RuntimeError('Login did not return a session cookie')
+    return f"{SESSION_COOKIE}={cookie}"
+
+
+def run_endpoint(name, target, cookies, stubs, concurrency, total):
+    """Fire `total` requests at one endpoint from `concurrency` threads"""
+    rng = random.Random(name)
+    playlist_ids = []
+    # Extends of one playlist are serialised, so each thread extends its own
+    threads = threading.local()
+    if name == 'extend':
+        # Untimed: generate the playlists that get extended, one per thread
+        for i in range(concurrency):
+            body = {'description': rng.choice(GENERATE_PROMPTS)}
+            response = requests.post(f"{target}/api/generate-playlist", json=body,
+                                     headers={'Cookie': cookies[i % len(cookies)]})
+            playlist_ids.append((cookies[i % len(cookies)], response.json()['playlist_id']))
+
+    def one(i):
+        headers = {'Cookie': cookies[i % len(cookies)]}
+        start = time.perf_counter()
+        if name == 'generate':
+            body = {'description': rng.choice(GENERATE_PROMPTS)}
+            response = requests.post(f"{target}/api/generate-playlist", json=body, headers=headers)
+        elif name == 'generate-batch':
+            body = {'descriptions': rng.sample(GENERATE_PROMPTS, BATCH_SIZE)}
+            response = requests.post(f"{target}/api/generate-playlists", json=body, headers=headers)
+        elif name == 'create':
+            response = requests.post(f"{target}/api/create-playlist", json=rng.choice(CREATE_PAYLOADS), headers=headers)
+        elif name == 'extend':
+            if not hasattr(threads, 'playlist'):
+                threads.playlist = playlist_ids.pop()
+            cookie, playlist_id = threads.playlist
+            response = requests.post(f"{target}/api/playlist/{playlist_id}/extend", json={'count': 10},
+                                     headers={'Cookie': cookie})
+        else:
+            response = requests.get(f"{target}/api/check-auth", headers=headers)
+        return time.perf_counter() - start, response.status_code
+
+    stubs.reset_counts()
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    wall = time.perf_counter() - wall_start
+
+    latencies = [latency for latency, _ in results]
+    errors = sum(1 for _, status in results if status >= 400)
+    calls = stubs.call_counts()
+    return {
+        'endpoint': name,
+        'requests': total,
+        'concurrency': concurrency,
+        'errors': errors,
+        'throughput_rps': total / wall if wall else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+        'upstream_calls_per_request': {route: count / total for route, count in sorted(calls.items())},
+    }
+
+
+def print_report(results):
+    for result in results:
+        print(f"\n== {result['endpoint']} ({result['requests']} requests, concurrency {result['concurrency']}) ==")
+        print(f"  throughput   {result['throughput_rps']:8.2f} req/s   errors {result['errors']}")
+        print(f"  latency ms   p50 {result['p50_ms']:8.1f}   p95 {result['p95_ms']:8.1f}   "
+              f"p99 {result['p99_ms']:8.1f}   mean {result['mean_ms']:8.1f}")
+        print("  upstream calls per request:")
+        for route, per_request in result['upstream_calls_per_request'].items():
+            print(f"    {route:<40} {per_request:6.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load benchmark for the Moosic backend')
+    parser.add_argument('--endpoints', default='check-auth,generate,create',
+                        help='Comma-separated subset of check-auth, generate, generate-batch, create, extend')
+    parser.add_argument('--concurrency', type=int, default=4, help='Concurrent client threads')
+    parser.add_argument('--requests', type=int, default=20, help='Requests per endpoint')
+    parser.add_argument('--users', type=int, default=0, help='Distinct logged-in sessions (default: concurrency)')
+    parser.add_argument('--target', help='Benchmark an already running server instead of an in-process one')
+    parser.add_argument('--port-base', type=int, default=0,
+                        help='Fixed stand-in ports (required with --target, must match the server environment)')
+    parser.add_argument('--json', help='Also write the results to this file')
+    parser.add_argument('--seed', type=int, default=1234, help='Random seed for stand-in behaviour')
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    if args.target and not args.port_base:
+        parser.error('--target requires --port-base so the server and stand-ins agree on URLs')
+
+    random.seed(args.seed)
+    stubs = stub_environment_from_args(args, args.port_base).start()
+    httpd = None
+    try:
+        if args.target:
+            target = args.target.rstrip('/')
+        else:
+            httpd, target = start_in_process_server(stubs.env())
+
+        cookies = [login(target) for _ in range(args.users or args.concurrency)]
+        names = [name.strip() for name in args.endpoints.split(',') if name.strip()]
+        results = []
+        for name in names:
+            results.append(run_endpoint(name, target, cookies, stubs, args.concurrency, args.requests))
+        print_report(results)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        if httpd is not None:
+            httpd.shutdown()
+        stubs.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Local recommender benchmark: logs N synthetic playlists drawn from
+clustered track catalogues, builds the co-occurrence matrix and times
+in-process queries, with and without playlists still in the unbuilt delta.
+
+    python benchmarks/recommender_bench.py --playlists 20000 --queries 2000
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import string
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import recommender
+
+
+def catalogue(clusters, tracks_per_cluster, rng):
+    return [[''.join(rng.choices(string.ascii_letters + string.digits, k=22)) for _ in range(tracks_per_cluster)]
+            for _ in range(clusters)]
+
+
+def playlist(clusters, rng, length=25):
+    # Mostly one "genre", with a few tracks from elsewhere
+    home = rng.choice(clusters)
+    tracks = rng.sample(home, min(length - 3, len(home)))
+    tracks += [rng.choice(rng.choice(clusters)) for _ in range(3)]
+    return home, tracks
+
+
+def time_queries(model, queries, k):
+    latencies = []
+    precision = []
+    for home, seeds in queries:
+        start = time.perf_counter()
+        ranked = model.recommend(seeds, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        if ranked:
+            members = set(home)
+            precision.append(sum(track_id in members for track_id, _ in ranked) / len(ranked))
+    latencies.sort()
+    return {
+        'p50': statistics.median(latencies),
+        'p95': latencies[int(len(latencies) * 0.95) - 1],
+        'precision': statistics.mean(precision) if precision else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and query the local co-occurrence recommender')
+    parser.add_argument('--playlists', type=int, default=20000, help='Synthetic playlists to log and build')
+    parser.add_argument('--delta', type=int, default=500, help='Playlists logged after the build')
+    parser.add_argument('--clusters', type=int, default=200, help='Track clusters ("genres")')
+    parser.add_argument('--cluster-size', type=int, default=250, help='Tracks per cluster')
+    parser.add_argument('--queries', type=int, default=2000, help='Queries to time')
+    parser.add_argument('--seeds', type=int, default=5, help='Seed tracks per query')
+    parser.add_argument('-k', type=int, default=50, help='Recommendations per query')
+    args = parser.parse_args()
+
+    rng = random.Random(11)
+    clusters = catalogue(args.clusters, args.cluster_size, rng)
+    directory = tempfile.mkdtemp(prefix='moosic_recommender_bench_')
+    try:
+        model = recommender.CooccurrenceModel(directory)
+        for _ in range(args.playlists):
+            model.record(playlist(clusters, rng)[1])
+
+        start = time.perf_counter()
+        tracks, pairs = recommender.build(directory)
+        build_seconds = time.perf_counter() - start
+        matrix_bytes = os.path.getsize(os.path.join(directory, 'matrix.bin'))
+        log_bytes = os.path.getsize(os.path.join(directory, 'playlists.log'))
+
+        queries = []
+        for _ in range(args.queries):
+            home = rng.choice(clusters)
+            queries.append((home, rng.sample(home, args.seeds)))
+
+        start = time.perf_counter()
+        model.refresh()
+        load_ms = (time.perf_counter() - start) * 1000
+        built = time_queries(model, queries, args.k)
+
+        for _ in range(args.delta):
+            model.record(playlist(clusters, rng)[1])
+        start = time.perf_counter()
+        model.refresh()
+        tail_ms = (time.perf_counter() - start) * 1000
+        with_delta = time_queries(model, queries, args.k)
+
+        print(f"{args.playlists} playlists -> {tracks} tracks, {pairs} neighbour entries "
+              f"in {build_seconds:.1f}s")
+        print(f"matrix {matrix_bytes / 1e6:.1f} MB ({matrix_bytes / max(1, tracks):.0f} bytes/track), "
+              f"log {log_bytes / 1e6:.1f} MB, load {load_ms:.1f} ms, tail {args.delta} playlists {tail_ms:.1f} ms")
+        print()
+        print(f"{'query (k=' + str(args.k) + ')':<24} {'p50 ms':>8} {'p95 ms':>8} {'in-cluster':>11}")
+        for label, result in (('matrix only', built), (f"matrix + {args.delta} delta", with_delta)):
+            print(f"{label:<24} {result['p50']:8.2f} {result['p95']:8.2f} {result['precision']:11.0%}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
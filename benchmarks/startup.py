@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Worker startup benchmark: measures, in fresh interpreters, how long it takes
+to import server.py, build the app with create_app() and serve the first
+/api/check-auth request, plus the one-off cost of the lazily imported
+OpenAI/Spotify client libraries.
+
+    python benchmarks/startup.py --runs 5
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = r'''
+import json, os, sys, time
+sys.path.insert(0, sys.argv[1])
+t0 = time.perf_counter()
+import server
+t1 = time.perf_counter()
+app = server.create_app()
+t2 = time.perf_counter()
+client = app.test_client()
+client.get('/api/check-auth')
+t3 = time.perf_counter()
+client.get('/api/check-auth')
+t4 = time.perf_counter()
+server.warm_imports()
+t5 = time.perf_counter()
+print(json.dumps({
+    'import_ms': (t1 - t0) * 1000,
+    'create_app_ms': (t2 - t1) * 1000,
+    'first_request_ms': (t3 - t2) * 1000,
+    'second_request_ms': (t4 - t3) * 1000,
+    'lazy_imports_ms': (t5 - t4) * 1000,
+}))
+'''
+
+BENCH_ENV = {
+    'SPOTIFY_CLIENT_ID': 'bench-client',
+    'SPOTIFY_CLIENT_SECRET': 'bench-secret',
+    'SPOTIFY_REDIRECT_URI': 'http://127.0.0.1/api/callback',
+    'OPENAI_API_KEY': 'bench-key',
+    'FRONTEND_URL': 'http://127.0.0.1:5173',
+    'BACKEND_URL': 'http://127.0.0.1:3001',
+    'LOG_LEVEL': 'WARNING',
+}
+
+
+def run_once():
+    env = dict(BENCH_ENV, **os.environ)
+    output = subprocess.check_output([sys.executable, '-c', PROBE, ROOT], env=env, stderr=subprocess.DEVNULL)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure worker startup and first-request latency')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters to start')
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    print(f"{'phase':<20} {'median ms':>10} {'min ms':>10} {'max ms':>10}")
+    for key in runs[0]:
+        values = [run[key] for run in runs]
+        print(f"{key:<20} {statistics.median(values):10.1f} {min(values):10.1f} {max(values):10.1f}")
+
+
+if __name__ == '__main__':
+    main()
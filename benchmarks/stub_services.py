@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for accounts.spotify.com, api.spotify.com and the OpenAI chat
+endpoint, backed by the recorded fixtures in benchmarks/fixtures.
+
+Each service has configurable latency, jitter and error rate and counts the
+calls it receives per route, so benchmarks can report upstream calls per
+request. Run directly to serve the stand-ins on fixed ports for an external
+server:
+
+    python benchmarks/stub_services.py --port-base 9100
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import urllib.parse
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import genre_seeds
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load_tracks(path=None):
+    """Load the recorded track fixtures"""
+    with open(path or os.path.join(FIXTURES_DIR, 'spotify_tracks.json')) as f:
+        return json.load(f)['tracks']
+
+
+class StubConfig:
+    """Latency and failure behaviour of one stand-in service"""
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, per_token_ms=0.0, slow_rate=0.0, slow_ms=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        # Only used by the OpenAI stand-in: completion latency grows with output length
+        self.per_token_ms = per_token_ms
+        # A long tail: this fraction of calls takes slow_ms extra
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+
+    def delay(self, tokens=0):
+        delay_ms = self.latency_ms + random.uniform(0, self.jitter_ms) + tokens * self.per_token_ms
+        if self.slow_rate > 0 and random.random() < self.slow_rate:
+            delay_ms += self.slow_ms
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000.0)
+
+    def should_fail(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+class StubServer:
+    """A ThreadingHTTPServer running a stand-in service on a background thread"""
+
+    def __init__(self, name, routes, config, port=0):
+        self.name = name
+        self.routes = routes
+        self.config = config
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def count(self, route):
+        with self._lock:
+            self.calls[route] += 1
+
+    def reset_counts(self):
+        with self._lock:
+            self.calls.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=f"stub-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _make_handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _dispatch(self, method):
+            parsed = urllib.parse.urlparse(self.path)
+            path = parsed.path.rstrip('/') or '/'
+            query = {k: v[-1] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+            length = int(self.headers.get('Content-Length') or 0)
+            raw_body = self.rfile.read(length) if length else b''
+
+            for route_method, pattern, name, func in stub.routes:
+                match = re.fullmatch(pattern, path)
+                if route_method != method or not match:
+                    continue
+                stub.count(name)
+                if stub.config.should_fail():
+                    stub.config.delay()
+                    return self._send(503, {'error': {'status': 503, 'message': 'Injected failure'}})
+                status, body, tokens = func(match, query, raw_body, self.headers)
+                stub.config.delay(tokens)
+                return self._send(status, body)
+
+            stub.count('unknown')
+            self._send(404, {'error': {'status': 404, 'message': f'No stub for {method} {path}'}})
+
+        def _send(self, status, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            self._dispatch('GET')
+
+        def do_POST(self):
+            self._dispatch('POST')
+
+        def do_PUT(self):
+            self._dispatch('PUT')
+
+    return Handler
+
+
+def _public_track(track):
+    """Strip fixture-only fields from a track object"""
+    return {key: value for key, value in track.items() if key != 'artist_genres'}
+
+
+def _form_or_json(raw_body, headers):
+    if 'json' in (headers.get('Content-Type') or ''):
+        return json.loads(raw_body or b'{}')
+    return {k: v[-1] for k, v in urllib.parse.parse_qs(raw_body.decode('utf-8')).items()}
+
+
+class SpotifyFixtures:
+    """Query logic over the recorded tracks shared by the Spotify stand-ins"""
+
+    def __init__(self, tracks):
+        self.tracks = tracks
+        self.by_id = {track['id']: track for track in tracks}
+        self.albums = {track['album']['id']: track['album'] for track in tracks}
+        # Like Spotify, only a fixed list of genres are valid seeds
+        self.genres = sorted(genre_seeds.DEFAULT_GENRE_SEEDS)
+        self._track_seeds = {
+            track['id']: {genre_seeds.nearest(genre, self.genres) for genre in track['artist_genres']}
+            for track in tracks
+        }
+        self.artists = {}
+        for track in tracks:
+            artist = track['artists'][0]
+            entry = self.artists.setdefault(artist['id'], {
+                'id': artist['id'],
+                'name': artist['name'],
+                'genres': [],
+                'popularity': track['popularity'],
+                'uri': f"spotify:artist:{artist['id']}",
+            })
+            for genre in track['artist_genres']:
+                if genre not in entry['genres']:
+                    entry['genres'].append(genre)
+        self._haystack = {
+            track['id']: _normalize(f"{track['name']} {track['artists'][0]['name']}") for track in tracks
+        }
+
+    def search(self, q, limit=10, offset=0):
+        q = q or ''
+        genre = None
+        years = None
+        genre_match = re.search(r'genre:"?([^"]+?)"?(?:\s|$)', q)
+        if genre_match:
+            genre = genre_match.group(1).lower()
+            q = q.replace(genre_match.group(0), ' ')
+        year_match = re.search(r'year:(\d{4})(?:-(\d{4}))?', q)
+        if year_match:
+            years = (int(year_match.group(1)), int(year_match.group(2) or year_match.group(1)))
+            q = q.replace(year_match.group(0), ' ')
+        # Drop negations and field prefixes, keep the words
+        q = re.sub(r'NOT\s+\S+', ' ', q)
+        q = re.sub(r'\b(artist|track|album):', ' ', q)
+        words = _normalize(q).split()
+
+        results = []
+        for track in self.tracks:
+            if genre and not any(genre in g for g in track['artist_genres']):
+                continue
+            if years and not years[0] <= int(track['album']['release_date'][:4]) <= years[1]:
+                continue
+            if words:
+                haystack = self._haystack[track['id']]
+                if not all(word in haystack for word in words):
+                    continue
+            results.append(track)
+        if genre or years:
+            results.sort(key=lambda t: t['popularity'], reverse=True)
+        page = results[offset:offset + limit]
+        return {'tracks': {
+            'items': [_public_track(t) for t in page],
+            'total': len(results),
+            'limit': limit,
+            'offset': offset,
+        }}
+
+    def recommendations(self, query):
+        seeds = []
+        for key in ('seed_tracks', 'seed_artists'):
+            seeds.extend(s.split(':')[-1] for s in (query.get(key) or '').split(',') if s)
+        seed_genres = set()
+        for seed in seeds:
+            if seed in self.by_id:
+                seed_genres.update(self.by_id[seed]['artist_genres'])
+            elif seed in self.artists:
+                seed_genres.update(self.artists[seed]['genres'])
+        # Genre seeds that are not in the seed list match nothing
+        genres = {s for s in (query.get('seed_genres') or '').split(',') if s in self.genres}
+        seeds.extend(sorted(genres))
+        limit = int(query.get('limit', 20))
+        min_popularity = int(query.get('min_popularity', 0))
+        candidates = [
+            t for t in self.tracks
+            if t['popularity'] >= min_popularity and t['id'] not in seeds
+            and (seed_genres.intersection(t['artist_genres']) or genres.intersection(self._track_seeds[t['id']]))
+        ]
+        # Deterministic shuffle per seed set so repeated requests match
+        rng = random.Random(','.join(sorted(seeds)))
+        rng.shuffle(candidates)
+        return {'tracks': [_public_track(t) for t in candidates[:limit]], 'seeds': []}
+
+    def top_items(self, kind, time_range, limit, offset=0):
+        ranges = {'short_term': 0, 'medium_term': 1, 'long_term': 2}
+        rng = random.Random(f"{kind}:{time_range}")
+        if kind == 'artists':
+            pool = sorted(self.artists.values(), key=lambda a: a['id'])
+        else:
+            pool = [_public_track(t) for t in self.tracks]
+        rng.shuffle(pool)
+        start = ranges.get(time_range, 1) * 5 + offset
+        items = pool[start:start + limit]
+        return {'items': items, 'total': len(pool), 'limit': limit, 'offset': offset}
+
+
+def _normalize(text):
+    return re.sub(r'[^\w\s]', '', text.lower())
+
+
+def make_spotify_accounts(config, port=0):
+    """Stand-in for accounts.spotify.com token endpoints"""
+    def token(match, query, raw_body, headers):
+        form = _form_or_json(raw_body, headers)
+        if form.get('grant_type') not in ('authorization_code', 'refresh_token', 'client_credentials'):
+            return 400, {'error': 'unsupported_grant_type'}, 0
+        body = {
+            'access_token': 'stub-access-' + hashlib.md5(os.urandom(8)).hexdigest(),
+            'token_type': 'Bearer',
+            'expires_in': 3600,
+            'scope': 'playlist-modify-public playlist-modify-private user-read-private user-read-email user-top-read',
+        }
+        if form.get('grant_type') == 'authorization_code':
+            body['refresh_token'] = 'stub-refresh-token'
+        return 200, body, 0
+
+    routes = [('POST', r'/api/token', 'token', token)]
+    return StubServer('spotify-accounts', routes, config, port)
+
+
+def make_spotify_api(config, fixtures, port=0):
+    """Stand-in for the api.spotify.com/v1 endpoints the server uses"""
+    user = {'id': 'bench-user', 'display_name': 'Bench User', 'email': 'bench@example.com', 'images': []}
+    playlists = {}
+    playlists_lock = threading.Lock()
+
+    def me(match, query, raw_body, headers):
+        return 200, user, 0
+
+    def search(match, query, raw_body, headers):
+        return 200, fixtures.search(query.get('q'), int(query.get('limit', 10)), int(query.get('offset', 0))), 0
+
+    def album(match, query, raw_body, headers):
+        album_data = fixtures.albums.get(match.group(1))
+        if not album_data:
+            return 404, {'error': {'status': 404, 'message': 'non existing id'}}, 0
+        return 200, dict(album_data), 0
+
+    def several_albums(match, query, raw_body, headers):
+        ids = [i for i in (query.get('ids') or '').split(',') if i]
+        return 200, {'albums': [fixtures.albums.get(i) for i in ids]}, 0
+
+    def several_tracks(match, query, raw_body, headers):
+        ids = [i for i in (query.get('ids') or '').split(',') if i]
+        return 200, {'tracks': [_public_track(fixtures.by_id[i]) if i in fixtures.by_id else None for i in ids]}, 0
+
+    def audio_features(match, query, raw_body, headers):
+        ids = [i for i in (query.get('ids') or '').split(',') if i]
+        features = []
+        for track_id in ids:
+            seed = int(hashlib.md5(track_id.encode()).hexdigest()[:8], 16)
+            features.append({
+                'id': track_id,
+                'energy': (seed % 100) / 100.0,
+                'valence': ((seed >> 8) % 100) / 100.0,
+                'danceability': ((seed >> 16) % 100) / 100.0,
+                'tempo': 70 + (seed % 110),
+            })
+        return 200, {'audio_features': features}, 0
+
+    def recommendations(match, query, raw_body, headers):
+        return 200, fixtures.recommendations(query), 0
+
+    def genre_seeds(match, query, raw_body, headers):
+        return 200, {'genres': fixtures.genres}, 0
+
+    def top(match, query, raw_body, headers):
+        return 200, fixtures.top_items(
+            match.group(1), query.get('time_range', 'medium_term'),
+            int(query.get('limit', 20)), int(query.get('offset', 0))
+        ), 0
+
+    def create_playlist(match, query, raw_body, headers):
+        data = json.loads(raw_body or b'{}')
+        playlist_id = hashlib.md5(os.urandom(8)).hexdigest()[:22]
+        with playlists_lock:
+            playlists[playlist_id] = []
+        return 201, {
+            'id': playlist_id,
+            'name': data.get('name'),
+            'description': data.get('description'),
+            'public': data.get('public'),
+            'external_urls': {'spotify': f'https://open.spotify.com/playlist/{playlist_id}'},
+            'owner': {'id': match.group(1)},
+        }, 0
+
+    def add_items(match, query, raw_body, headers):
+        data = json.loads(raw_body or b'{}')
+        # Newer spotipy versions post the bare list of URIs
+        uris = data if isinstance(data, list) else data.get('uris') or []
+        if len(uris) > 100:
+            return 400, {'error': {'status': 400, 'message': 'Too many ids requested'}}, 0
+        with playlists_lock:
+            playlists.setdefault(match.group(1), []).extend(uris)
+        return 201, {'snapshot_id': hashlib.md5(os.urandom(8)).hexdigest()}, 0
+
+    routes = [
+        ('GET', r'/v1/me', 'me', me),
+        ('GET', r'/v1/search', 'search', search),
+        ('GET', r'/v1/albums/([^/]+)', 'album', album),
+        ('GET', r'/v1/albums', 'albums', several_albums),
+        ('GET', r'/v1/tracks', 'tracks', several_tracks),
+        ('GET', r'/v1/audio-features', 'audio_features', audio_features),
+        ('GET', r'/v1/recommendations/available-genre-seeds', 'genre_seeds', genre_seeds),
+        ('GET', r'/v1/recommendations', 'recommendations', recommendations),
+        ('GET', r'/v1/me/top/(artists|tracks)', 'top', top),
+        ('POST', r'/v1/users/([^/]+)/playlists', 'playlist_create', create_playlist),
+        ('POST', r'/v1/playlists/([^/]+)/(?:tracks|items)', 'playlist_add', add_items),
+    ]
+    server = StubServer('spotify-api', routes, config, port)
+    server.playlists = playlists
+    return server
+
+
+def make_openai(config, fixtures, hallucination_rate=0.1, port=0):
+    """
+    Stand-in for the OpenAI chat completions endpoint. Suggestions are drawn
+    from the fixtures (so they resolve against the Spotify stand-in) plus a
+    configurable share of made-up songs that will not resolve.
+    """
+    def chat(match, query, raw_body, headers):
+        data = json.loads(raw_body or b'{}')
+        messages = data.get('messages') or []
+        prompt = '\n'.join(m.get('content') or '' for m in messages)
+
+        # Prefer the count asked for in the latest message - system prompts
+        # contain examples like "2016 songs"
+        count = 25
+        for message in reversed(messages):
+            count_match = re.search(r'\b(\d{1,3})\s+(?:specific\s+|highly relevant\s+|more\s+)?songs',
+                                    message.get('content') or '')
+            if count_match:
+                count = int(count_match.group(1))
+                break
+        rng = random.Random(hashlib.md5(prompt.encode('utf-8')).hexdigest())
+        pool = [t for t in fixtures.tracks if t['popularity'] > 20]
+        rng.shuffle(pool)
+
+        def pick(count, offset=0):
+            songs = []
+            for i in range(count):
+                if rng.random() < hallucination_rate:
+                    songs.append((f"Imaginary Song {rng.randint(1, 10 ** 6)}", f"Nobody {rng.randint(1, 1000)}"))
+                else:
+                    track = pool[(offset + i) % len(pool)]
+                    songs.append((track['name'], track['artists'][0]['name']))
+            return songs
+
+        # A combined request numbers its parts "#1 25 songs for: ..."; answer each under its number
+        sections = re.findall(r'^#(\d+) (\d{1,3}) songs', (messages[-1].get('content') or '') if messages else '',
+                              re.MULTILINE)
+        songs = pick(count)
+
+        if sections:
+            parts = []
+            for number, section_count in sections:
+                lines = pick(int(section_count), offset=int(number) * 7)
+                parts.append(f"#{number}\n" + '\n'.join(f"{title} by {artist}" for title, artist in lines))
+            content = '\n\n'.join(parts)
+        elif 'json' in prompt.lower():
+            content = json.dumps({
+                'songSuggestions': [{'title': title, 'artist': artist} for title, artist in songs],
+                'description': 'A stand-in selection drawn from recorded fixtures.',
+            })
+        else:
+            content = '\n'.join(f"{title} by {artist}" for title, artist in songs)
+
+        prompt_tokens = max(1, len(prompt) // 4)
+        completion_tokens = max(1, len(content) // 4)
+        if data.get('max_tokens') and completion_tokens > data['max_tokens']:
+            content = content[:data['max_tokens'] * 4]
+            completion_tokens = data['max_tokens']
+        return 200, {
+            'id': 'chatcmpl-stub',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': data.get('model'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop',
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        }, completion_tokens
+
+    routes = [('POST', r'/v1/chat/completions', 'chat_completions', chat)]
+    return StubServer('openai', routes, config, port)
+
+
+class StubEnvironment:
+    """All three stand-ins plus the environment variables that point the server at them"""
+
+    def __init__(self, spotify_config=None, openai_config=None, hallucination_rate=0.1, port_base=0):
+        fixtures = SpotifyFixtures(load_tracks())
+        spotify_config = spotify_config or StubConfig()
+        openai_config = openai_config or StubConfig()
+        port = (lambda offset: port_base + offset if port_base else 0)
+        self.accounts = make_spotify_accounts(spotify_config, port(0))
+        self.api = make_spotify_api(spotify_config, fixtures, port(1))
+        self.openai = make_openai(openai_config, fixtures, hallucination_rate, port(2))
+        self.servers = [self.accounts, self.api, self.openai]
+
+    def start(self):
+        for server in self.servers:
+            server.start()
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.stop()
+
+    def reset_counts(self):
+        for server in self.servers:
+            server.reset_counts()
+
+    def call_counts(self):
+        counts = Counter()
+        for server in self.servers:
+            for route, count in server.calls.items():
+                counts[f"{server.name}:{route}"] += count
+        return counts
+
+    def env(self):
+        return {
+            'SPOTIFY_ACCOUNTS_URL': self.accounts.url,
+            'SPOTIFY_API_URL': f"{self.api.url}/v1",
+            'OPENAI_API_BASE': f"{self.openai.url}/v1",
+        }
+
+
+def add_stub_arguments(parser):
+    """Register the latency/error options shared by the benchmark scripts"""
+    parser.add_argument('--spotify-latency-ms', type=float, default=40, help='Base latency of Spotify stand-ins')
+    parser.add_argument('--spotify-jitter-ms', type=float, default=40, help='Uniform random extra Spotify latency')
+    parser.add_argument('--spotify-error-rate', type=float, default=0.0, help='Fraction of Spotify calls answered with 503')
+    parser.add_argument('--spotify-slow-rate', type=float, default=0.0, help='Fraction of Spotify calls in the slow tail')
+    parser.add_argument('--spotify-slow-ms', type=float, default=1000, help='Extra latency of slow-tail Spotify calls')
+    parser.add_argument('--openai-latency-ms', type=float, default=300, help='Base latency of the OpenAI stand-in')
+    parser.add_argument('--openai-jitter-ms', type=float, default=200, help='Uniform random extra OpenAI latency')
+    parser.add_argument('--openai-ms-per-token', type=float, default=5, help='OpenAI latency per completion token')
+    parser.add_argument('--openai-error-rate', type=float, default=0.0, help='Fraction of OpenAI calls answered with 503')
+    parser.add_argument('--hallucination-rate', type=float, default=0.1, help='Share of LLM suggestions that do not exist')
+
+
+def stub_environment_from_args(args, port_base=0):
+    return StubEnvironment(
+        spotify_config=StubConfig(args.spotify_latency_ms, args.spotify_jitter_ms, args.spotify_error_rate,
+                                  slow_rate=args.spotify_slow_rate, slow_ms=args.spotify_slow_ms),
+        openai_config=StubConfig(args.openai_latency_ms, args.openai_jitter_ms, args.openai_error_rate,
+                                 args.openai_ms_per_token),
+        hallucination_rate=args.hallucination_rate,
+        port_base=port_base,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve local Spotify/OpenAI stand-ins')
+    parser.add_argument('--port-base', type=int, default=9100, help='accounts=base, api=base+1, openai=base+2')
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    stubs = stub_environment_from_args(args, args.port_base).start()
+    print("Stand-ins running. Start the server with:")
+    for key, value in stubs.env().items():
+        print(f"  export {key}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stubs.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Track store benchmark: loads N synthetic Spotify tracks into a fresh
+track_store.TrackStore and into the per-worker dicts it replaces, then
+compares memory per track and lookup latency.
+
+    python benchmarks/track_store_bench.py --tracks 1000000
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import string
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import track_store
+
+
+def synthetic_tracks(count, seed=7):
+    rng = random.Random(seed)
+    artists = [f"Artist {i}" for i in range(max(1, count // 20))]
+    for i in range(count):
+        track_id = ''.join(rng.choices(string.ascii_letters + string.digits, k=22))
+        album = ''.join(rng.choices('0123456789abcdef', k=40))
+        yield {
+            'id': track_id,
+            'uri': f"spotify:track:{track_id}",
+            'name': f"Song {i}",
+            'artists': [{'name': rng.choice(artists)}],
+            'album': {
+                'images': [{'url': f"https://i.scdn.co/image/{album}{width}", 'width': width, 'height': width}
+                           for width in (640, 300, 64)],
+                'release_date': f"{rng.randint(1960, 2024)}-01-01",
+            },
+            'popularity': rng.randint(0, 100),
+        }
+
+
+def dict_footprint(tracks):
+    """Bytes allocated for the same tracks held as dicts keyed by id and normalized name"""
+    tracemalloc.start()
+    by_id, by_key = {}, {}
+    for track in tracks:
+        by_id[track['id']] = track
+        by_key[track_store.normalize(track['name'], track['artists'][0]['name'])] = track['id']
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, by_id, by_key
+
+
+def time_lookups(lookup, keys):
+    start = time.perf_counter()
+    for key in keys:
+        lookup(key)
+    return (time.perf_counter() - start) / len(keys) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the shared track store with per-worker dicts')
+    parser.add_argument('--tracks', type=int, default=100000, help='Synthetic tracks to load')
+    parser.add_argument('--lookups', type=int, default=20000, help='Lookups to time per structure')
+    parser.add_argument('--workers', type=int, default=4, help='Workers to compare total memory for')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='moosic_track_store_bench_')
+    try:
+        store = track_store.TrackStore(directory)
+        start = time.perf_counter()
+        batch = []
+        for track in synthetic_tracks(args.tracks):
+            batch.append((track, ()))
+            if len(batch) == 10000:
+                store.put_many(batch)
+                batch = []
+        store.put_many(batch)
+        load_seconds = time.perf_counter() - start
+        stats = store.stats()
+        store_bytes = stats['record_bytes'] + stats['string_bytes'] + stats['index_bytes']
+
+        dict_bytes, by_id, by_key = dict_footprint(synthetic_tracks(args.tracks))
+        sample = random.Random(1).sample(list(by_id.values()), min(args.lookups, args.tracks))
+        ids = [track['id'] for track in sample]
+        names = [(track['name'], track['artists'][0]['name']) for track in sample]
+
+        # A second handle maps the files the way another worker would
+        reader = track_store.TrackStore(directory)
+        store_get = time_lookups(reader.get, ids)
+        store_find = time_lookups(lambda pair: reader.find(*pair), names)
+        dict_get = time_lookups(by_id.get, ids)
+        dict_find = time_lookups(lambda pair: by_key.get(track_store.normalize(*pair)), names)
+
+        print(f"{args.tracks} tracks loaded in {load_seconds:.1f}s (index load {stats['index_load']:.2f})")
+        print(f"{'':<22} {'bytes/track':>12} {'total MB':>10} {f'x{args.workers} workers MB':>18}")
+        print(f"{'track store (shared)':<22} {store_bytes / args.tracks:12.0f} {store_bytes / 1e6:10.1f} "
+              f"{store_bytes / 1e6:18.1f}")
+        print(f"{'dicts (per worker)':<22} {dict_bytes / args.tracks:12.0f} {dict_bytes / 1e6:10.1f} "
+              f"{dict_bytes * args.workers / 1e6:18.1f}")
+        print()
+        print(f"{'lookup':<22} {'store us':>12} {'dict us':>10}")
+        print(f"{'get(id)':<22} {store_get:12.2f} {dict_get:10.2f}")
+        print(f"{'find(title, artist)':<22} {store_find:12.2f} {dict_find:10.2f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+The filtering stage every candidate source (chart, LLM resolution, seed
+tracks, local and Spotify recommendations, genre/era pools, genre search)
+goes through before its tracks join a playlist.
+
+A CandidateFilter holds what the playlist already has - its URIs, in
+order, and its artists - and takes a whole batch from one source at a
+time. In one pass per candidate it drops tracks already in the playlist,
+a second track by an artist already in it, karaoke/cover/tribute versions
+(intent.SUSPICIOUS_PATTERN), tracks below a popularity floor and, where
+asked, tracks outside the requested era; it stops at the playlist cap.
+Rejections are counted per source and filter (moosic_candidates_rejected_total).
+
+Candidates are Spotify tracks or compact ones (track_pools.compact_track).
+"""
+
+import logging
+
+import intent
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _artist(candidate):
+    return candidate['artist'] if 'artist' in candidate else candidate['artists'][0]['name']
+
+
+def _year(candidate):
+    if 'year' in candidate:
+        return candidate['year']
+    year = ((candidate.get('album') or {}).get('release_date') or '')[:4]
+    return int(year) if year.isdigit() else None
+
+
+class CandidateFilter:
+    def __init__(self, limit=None, uris=(), artists=(), min_year=None, max_year=None):
+        self.limit = limit
+        self.uris = list(uris)
+        self.artists = {artist.lower() for artist in artists}
+        self.min_year = min_year
+        self.max_year = max_year
+        self.rejected = {}
+        self._seen = set(self.uris)
+
+    def __contains__(self, uri):
+        return uri in self._seen
+
+    def __len__(self):
+        return len(self.uris)
+
+    def restore(self, uris, artists):
+        """Replace what the playlist has, e.g. from a checkpoint"""
+        self.uris[:] = uris
+        self.artists.clear()
+        self.artists.update(artist.lower() for artist in artists)
+        self._seen = set(self.uris)
+
+    def full(self, limit=None):
+        limit = self.limit if limit is None else limit
+        return limit is not None and len(self.uris) >= limit
+
+    def accept(self, candidates, source, limit=None, take=None, check_era=False, min_popularity=0):
+        """
+        The candidates that pass every filter, in order, recorded as added to
+        the playlist. Stops once the playlist holds `limit` tracks (default:
+        the filter's limit) or `take` candidates of this batch were accepted.
+        """
+        limit = self.limit if limit is None else limit
+        check_era = check_era and bool(self.min_year and self.max_year)
+        accepted = []
+        rejected = {}
+        for candidate in candidates:
+            if (limit is not None and len(self.uris) >= limit) or (take is not None and len(accepted) >= take):
+                break
+            artist = _artist(candidate).lower()
+            if candidate['uri'] in self._seen:
+                reason = 'duplicate_track'
+            elif artist in self.artists:
+                reason = 'duplicate_artist'
+            elif intent.SUSPICIOUS_PATTERN.search(candidate['name']):
+                reason = 'suspicious'
+            elif min_popularity and (candidate.get('popularity') or 0) < min_popularity:
+                reason = 'popularity'
+            elif check_era and not (_year(candidate) and self.min_year <= _year(candidate) <= self.max_year):
+                reason = 'era'
+            else:
+                self._seen.add(candidate['uri'])
+                self.artists.add(artist)
+                self.uris.append(candidate['uri'])
+                accepted.append(candidate)
+                continue
+            rejected[reason] = rejected.get(reason, 0) + 1
+
+        for reason, count in rejected.items():
+            metrics.candidates_rejected(source, reason, count)
+            self.rejected[reason] = self.rejected.get(reason, 0) + count
+        if rejected:
+            logger.debug("%s: accepted %s, rejected %s", source, len(accepted), rejected)
+        return accepted
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Local index of ranked, already-resolved tracks per year and decade, used to
+answer objective requests ("top songs of 2016", "best 80s hits") without
+an LLM call or searches.
+
+The index is filled two ways:
+  - importing a chart file: python charts.py import charts.json
+  - learning from objective generations: the LLM suggestions that resolved
+    and were released in the requested period are voted up, earlier
+    suggestions weighing more
+
+It is one JSON file (MOOSIC_CHART_INDEX) shared by all workers; writers
+merge under an fcntl lock and swap the file in, readers reload it when it
+changes.
+"""
+
+import os
+import sys
+import json
+import fcntl
+import logging
+import argparse
+import threading
+
+import intent
+import track_pools
+
+logger = logging.getLogger(__name__)
+
+INDEX_PATH = os.getenv('MOOSIC_CHART_INDEX', '/tmp/moosic_charts.json')
+ENABLED = os.getenv('MOOSIC_CHARTS', 'true').lower() in ('1', 'true', 'yes')
+MAX_TRACKS = 100
+# Imported chart positions always outrank learned votes
+IMPORT_WEIGHT = 1000.0
+VERSION = 1
+
+
+def decade_of(year):
+    """The ERA_PATTERNS name for a year, e.g. 1987 -> '80s'"""
+    for era, info in intent.ERA_PATTERNS.items():
+        if info['min_year'] <= year <= info['max_year']:
+            return era
+    return None
+
+
+def chart_key(description_lower):
+    """
+    ('year', '2016') or ('decade', '80s') for objective requests about a
+    period, else None
+    """
+    if intent.objective_reason(description_lower) is None:
+        return None
+    year = intent.YEAR_PATTERN.search(description_lower)
+    if year:
+        return 'year', year.group(0)
+    era, _, _ = intent.detect_era(description_lower)
+    return ('decade', era) if era else None
+
+
+def _period(key):
+    kind, name = key
+    if kind == 'year':
+        # A year's hits include singles released late the year before
+        return int(name) - 1, int(name)
+    info = intent.ERA_PATTERNS[name]
+    return info['min_year'], info['max_year']
+
+
+def _compact(item):
+    return item if 'artist' in item else track_pools.compact_track(item)
+
+
+class ChartIndex:
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._charts = {}
+        self._signature = None
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def _reload(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._charts, self._signature = {}, None
+            return
+        signature = (stat.st_ino, stat.st_mtime_ns)
+        if signature == self._signature:
+            return
+        with open(self.path) as f:
+            data = json.load(f)
+        self._charts = data.get('charts', {}) if data.get('version') == VERSION else {}
+        self._signature = signature
+
+    def lookup(self, key, limit=None):
+        """Ranked compact tracks for ('year'|'decade', name), best first"""
+        with self._lock:
+            self._reload()
+            entries = self._charts.get(f"{key[0]}:{key[1]}") or []
+        return entries[:limit] if limit else list(entries)
+
+    def _update(self, votes):
+        """Merge {chart: [(score, compact track)]} into the file under the writer lock"""
+        with open(f"{self.path}.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                data = {'version': VERSION, 'charts': {}}
+            charts = data.setdefault('charts', {})
+            for chart, scored in votes.items():
+                by_uri = {entry['uri']: entry for entry in charts.get(chart, [])}
+                for score, track in scored:
+                    entry = by_uri.setdefault(track['uri'], dict(track, score=0.0))
+                    entry['score'] += score
+                ranked = sorted(by_uri.values(), key=lambda entry: (entry['score'], entry.get('popularity') or 0), reverse=True)
+                charts[chart] = ranked[:MAX_TRACKS]
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+
+    def learn(self, key, items):
+        """Vote for the resolved suggestions of one objective generation, in suggestion order"""
+        low, high = _period(key)
+        tracks = [_compact(item) for item in items]
+        tracks = [track for track in tracks if track['year'] and low <= track['year'] <= high]
+        if not tracks:
+            return 0
+        votes = {}
+        for position, track in enumerate(tracks):
+            score = 1.0 + (len(tracks) - position) / len(tracks)
+            votes.setdefault(f"{key[0]}:{key[1]}", []).append((score, track))
+            decade = decade_of(track['year'])
+            if key[0] == 'year' and decade:
+                votes.setdefault(f"decade:{decade}", []).append((score, track))
+        self._update(votes)
+        return len(tracks)
+
+    def import_charts(self, charts):
+        """
+        Import {year or decade: [track, ...]} in chart order; tracks are
+        Spotify track objects or compact tracks. Years also feed their decade.
+        """
+        votes = {}
+        for name, items in charts.items():
+            name = str(name)
+            kind = 'year' if name.isdigit() else 'decade'
+            for position, item in enumerate(items):
+                track = _compact(item)
+                score = IMPORT_WEIGHT * (1.0 - position / len(items))
+                votes.setdefault(f"{kind}:{name}", []).append((score, track))
+                decade = decade_of(int(name)) if kind == 'year' else None
+                if decade:
+                    votes.setdefault(f"decade:{decade}", []).append((score, track))
+        self._update(votes)
+        return {chart: len(scored) for chart, scored in votes.items()}
+
+
+INDEX = ChartIndex(INDEX_PATH)
+
+
+def lookup(key, limit=None):
+    """Chart tracks for a chart_key(), or [] when disabled or unavailable"""
+    if not ENABLED or key is None:
+        return []
+    try:
+        return INDEX.lookup(key, limit)
+    except (OSError, ValueError) as e:
+        logger.warning("Chart index unavailable: %s", e)
+        return []
+
+
+def learn(key, items):
+    """Record an objective generation's resolved tracks; never raises"""
+    if not ENABLED or key is None or not items:
+        return
+    try:
+        learned = INDEX.learn(key, items)
+        logger.info("Chart index learned %s tracks for %s %s", learned, *key)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning("Could not update chart index: %s", e)
+
+
+def _after_fork():
+    INDEX.after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the local year/decade chart index')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help='Import a chart file')
+    import_parser.add_argument('file', help='JSON: {"charts": {"2016": [track, ...], "80s": [...]}}')
+    show_parser = subparsers.add_parser('show', help='Print a chart')
+    show_parser.add_argument('period', help='A year (2016) or decade (80s, 2010s)')
+    show_parser.add_argument('-n', type=int, default=25, help='Tracks to print')
+    parser.add_argument('--index', default=INDEX_PATH, help='Chart index file')
+    args = parser.parse_args()
+
+    index = ChartIndex(args.index)
+    if args.command == 'import':
+        with open(args.file) as f:
+            counts = index.import_charts(json.load(f)['charts'])
+        print(f"Imported {sum(counts.values())} chart entries into {len(counts)} charts in {args.index}")
+    else:
+        kind = 'year' if args.period.isdigit() else 'decade'
+        for rank, track in enumerate(index.lookup((kind, args.period), args.n), 1):
+            print(f"{rank:3}. {track['name']} by {track['artist']} ({track['year']})  {track['score']:.1f}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Checkpoints of playlist generations, keyed by the generation id returned
+with every /api/generate-playlist response. The pipeline saves one after
+each expensive stage:
+
+  suggestions  the LLM's song suggestions
+  resolution   the tracks resolved from them and the chart
+  tracks       the final track list, before anything is written
+  playlist     the Spotify playlist, once created
+  chunks       how many 100-track chunks have been added to it
+  done         the response sent to the client
+
+A retry with the same id resumes after the last completed stage, so a late
+failure (a chunk that fails to add, a recycled worker) does not redo the LLM
+call and the searches, and never creates a second playlist.
+
+Checkpoints are zlib JSON files in MOOSIC_CHECKPOINT_DIR shared by every
+worker. A generation holds an flock on its lock file while it runs, so two
+concurrent retries of one id cannot both proceed.
+"""
+
+import os
+import re
+import json
+import time
+import zlib
+import fcntl
+import logging
+import threading
+import secrets
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv('MOOSIC_CHECKPOINTS', 'true').lower() in ('1', 'true', 'yes')
+CHECKPOINT_DIR = os.getenv('MOOSIC_CHECKPOINT_DIR', '/tmp/moosic_checkpoints')
+CHECKPOINT_TTL = int(os.getenv('MOOSIC_CHECKPOINT_TTL_SECONDS', str(24 * 3600)))
+STAGES = ('suggestions', 'resolution', 'tracks', 'playlist', 'chunks', 'done')
+VERSION = 1
+PRUNE_INTERVAL = 3600
+
+GENERATION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+
+_last_prune = 0.0
+
+
+class Conflict(Exception):
+    """The generation id is running in another request or belongs to a different generation"""
+
+
+def new_id():
+    return secrets.token_urlsafe(12)
+
+
+def valid_id(generation_id):
+    return isinstance(generation_id, str) and GENERATION_ID_PATTERN.match(generation_id) is not None
+
+
+def _path(generation_id, suffix='.checkpoint'):
+    if not valid_id(generation_id):
+        raise ValueError(f"Invalid generation id: {generation_id!r}")
+    return os.path.join(CHECKPOINT_DIR, f"{generation_id}{suffix}")
+
+
+def load(generation_id):
+    """The saved checkpoint for a generation, or None if missing, expired or unreadable"""
+    try:
+        with open(_path(generation_id), 'rb') as f:
+            state = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, zlib.error) as e:
+        logger.warning("Could not read checkpoint for %s: %s", generation_id, e)
+        return None
+    if state.get('version') != VERSION or time.time() - state.get('saved_at', 0) > CHECKPOINT_TTL:
+        return None
+    return state
+
+
+class Checkpoint:
+    """
+    One generation's progress. Without a generation id (checkpoints off, or
+    the batch's own bookkeeping) nothing is written and nothing was reached.
+    """
+
+    def __init__(self, generation_id=None, user_id=None, description=None, state=None):
+        self.generation_id = generation_id
+        self.state = state or {'user_id': user_id, 'description': description}
+
+    @property
+    def stage(self):
+        return self.state.get('stage')
+
+    def reached(self, stage):
+        return self.stage is not None and STAGES.index(self.stage) >= STAGES.index(stage)
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def save(self, stage, required=False, **fields):
+        """
+        Record a completed stage and what later stages need from it. A failed
+        write is logged, or raised as OSError if the stage is `required`.
+        """
+        self.state.update(fields, stage=stage)
+        if self.generation_id is None:
+            return
+        try:
+            path = _path(self.generation_id)
+            os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(zlib.compress(json.dumps(dict(self.state, version=VERSION, saved_at=int(time.time())),
+                                                 separators=(',', ':')).encode('utf-8')))
+            os.replace(tmp_path, path)
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning("Could not save %s checkpoint for %s: %s", stage, self.generation_id, e)
+            if required:
+                raise OSError(f"Could not save the {stage} checkpoint") from e
+
+
+@contextmanager
+def claimed(generation_id, user_id, description):
+    """
+    The generation's Checkpoint, held exclusively for the with block.
+    Raises Conflict if another request holds it or it was saved for another
+    user or description.
+    """
+    if not ENABLED:
+        yield Checkpoint(None, user_id, description)
+        return
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    fd = os.open(_path(generation_id, '.lock'), os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise Conflict('This generation is already in progress')
+        state = load(generation_id)
+        if state is not None:
+            if state.get('user_id') != user_id or state.get('description') != description:
+                raise Conflict('This generation id belongs to a different playlist request')
+            logger.info("Resuming generation %s after its %s stage", generation_id, state.get('stage'))
+        yield Checkpoint(generation_id, user_id, description, state)
+    finally:
+        os.close(fd)
+    _maybe_prune()
+
+
+def _maybe_prune():
+    """Drop checkpoints and lock files past the TTL, at most once per PRUNE_INTERVAL per process"""
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = now
+    try:
+        with os.scandir(CHECKPOINT_DIR) as entries:
+            for entry in entries:
+                if entry.name.endswith(('.checkpoint', '.lock')) and now - entry.stat().st_mtime > CHECKPOINT_TTL:
+                    os.unlink(entry.path)
+    except OSError as e:
+        logger.warning("Could not prune checkpoints: %s", e)
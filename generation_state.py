@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Generation state saved per playlist so /api/playlist/<id>/extend can add
+tracks without redoing the LLM call, personalization and searches: the
+tracks already in the playlist, their artists, the mood profile, detected
+genres/era, the seeds and the spare candidates generation did not use.
+
+States are zlib-compressed compact JSON, one file per playlist in
+MOOSIC_GENERATION_STATE_DIR, so every worker can extend any playlist. An
+extend holds an flock on the playlist's lock file from loading the state
+to saving it, so concurrent extends cannot add the same tracks twice.
+"""
+
+import os
+import re
+import json
+import time
+import zlib
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+
+import track_pools
+
+logger = logging.getLogger(__name__)
+
+STATE_DIR = os.getenv('MOOSIC_GENERATION_STATE_DIR', '/tmp/moosic_generation_state')
+STATE_TTL = int(os.getenv('MOOSIC_GENERATION_STATE_TTL_SECONDS', str(7 * 24 * 3600)))
+MAX_CANDIDATES = 200
+VERSION = 1
+PRUNE_INTERVAL = 3600
+
+PLAYLIST_ID_PATTERN = re.compile(r'^[A-Za-z0-9]{1,64}$')
+
+_last_prune = 0.0
+
+
+class Conflict(Exception):
+    """Another request is extending the playlist"""
+
+
+def valid_id(playlist_id):
+    return isinstance(playlist_id, str) and PLAYLIST_ID_PATTERN.match(playlist_id) is not None
+
+
+def _path(playlist_id, suffix='.state'):
+    if not valid_id(playlist_id):
+        raise ValueError(f"Invalid playlist id: {playlist_id!r}")
+    return os.path.join(STATE_DIR, f"{playlist_id}{suffix}")
+
+
+def encode(state):
+    return zlib.compress(json.dumps(state, separators=(',', ':')).encode('utf-8'))
+
+
+def decode(blob):
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+def compact_candidates(items, exclude_uris=()):
+    """Unique compact candidates (see track_pools.compact_track) not already in the playlist"""
+    seen = set(exclude_uris)
+    candidates = []
+    for item in items:
+        candidate = item if 'artist' in item else track_pools.compact_track(item)
+        if candidate['uri'] in seen:
+            continue
+        seen.add(candidate['uri'])
+        candidates.append(candidate)
+        if len(candidates) >= MAX_CANDIDATES:
+            break
+    return candidates
+
+
+def save(playlist_id, state):
+    """Write a playlist's generation state; never raises"""
+    state = dict(state, version=VERSION, saved_at=int(time.time()))
+    try:
+        path = _path(playlist_id)
+        os.makedirs(STATE_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(encode(state))
+        os.replace(tmp_path, path)
+    except (OSError, ValueError, TypeError) as e:
+        logger.warning("Could not save generation state for %s: %s", playlist_id, e)
+        return
+    _maybe_prune()
+
+
+def load(playlist_id):
+    """The saved state for a playlist, or None if missing, expired or unreadable"""
+    try:
+        with open(_path(playlist_id), 'rb') as f:
+            state = decode(f.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, zlib.error) as e:
+        logger.warning("Could not read generation state for %s: %s", playlist_id, e)
+        return None
+    if state.get('version') != VERSION or time.time() - state.get('saved_at', 0) > STATE_TTL:
+        return None
+    return state
+
+
+@contextmanager
+def claimed(playlist_id):
+    """Held exclusively for the with block; raises Conflict if another request holds it"""
+    os.makedirs(STATE_DIR, exist_ok=True)
+    fd = os.open(_path(playlist_id, '.lock'), os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise Conflict('This playlist is already being extended')
+        yield
+    finally:
+        os.close(fd)
+
+
+def _maybe_prune():
+    """Drop states and lock files past their TTL, at most once per PRUNE_INTERVAL per process"""
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = now
+    try:
+        with os.scandir(STATE_DIR) as entries:
+            for entry in entries:
+                if entry.name.endswith(('.state', '.lock')) and now - entry.stat().st_mtime > STATE_TTL:
+                    os.unlink(entry.path)
+    except OSError as e:
+        logger.warning("Could not prune generation states: %s", e)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Valid recommendation seed genres and the mapping from free-form artist
+genres ("canadian contemporary r&b", "dance pop") to the nearest seed
+("r-n-b", "pop"). Spotify answers recommendations with nothing for seed
+genres it does not know, so seeds are validated before the call.
+
+The available seeds are cached in one JSON file (MOOSIC_GENRE_SEEDS_PATH)
+shared by all workers and refetched when older than
+MOOSIC_GENRE_SEEDS_TTL_SECONDS; until the first fetch the published list
+below is used.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SEEDS_PATH = os.getenv('MOOSIC_GENRE_SEEDS_PATH', '/tmp/moosic_genre_seeds.json')
+SEEDS_TTL = int(os.getenv('MOOSIC_GENRE_SEEDS_TTL_SECONDS', str(7 * 24 * 3600)))
+RETRY_INTERVAL = 300
+
+DEFAULT_GENRE_SEEDS = (
+    'acoustic', 'afrobeat', 'alt-rock', 'alternative', 'ambient', 'anime', 'black-metal', 'bluegrass',
+    'blues', 'bossanova', 'brazil', 'breakbeat', 'british', 'cantopop', 'chicago-house', 'children',
+    'chill', 'classical', 'club', 'comedy', 'country', 'dance', 'dancehall', 'death-metal', 'deep-house',
+    'detroit-techno', 'disco', 'disney', 'drum-and-bass', 'dub', 'dubstep', 'edm', 'electro', 'electronic',
+    'emo', 'folk', 'forro', 'french', 'funk', 'garage', 'german', 'gospel', 'goth', 'grindcore', 'groove',
+    'grunge', 'guitar', 'happy', 'hard-rock', 'hardcore', 'hardstyle', 'heavy-metal', 'hip-hop',
+    'holidays', 'honky-tonk', 'house', 'idm', 'indian', 'indie', 'indie-pop', 'industrial', 'iranian',
+    'j-dance', 'j-idol', 'j-pop', 'j-rock', 'jazz', 'k-pop', 'kids', 'latin', 'latino', 'malay',
+    'mandopop', 'metal', 'metal-misc', 'metalcore', 'minimal-techno', 'movies', 'mpb', 'new-age',
+    'new-release', 'opera', 'pagode', 'party', 'philippines-opm', 'piano', 'pop', 'pop-film',
+    'post-dubstep', 'power-pop', 'progressive-house', 'psych-rock', 'punk', 'punk-rock', 'r-n-b',
+    'rainy-day', 'reggae', 'reggaeton', 'road-trip', 'rock', 'rock-n-roll', 'rockabilly', 'romance',
+    'sad', 'salsa', 'samba', 'sertanejo', 'show-tunes', 'singer-songwriter', 'ska', 'sleep', 'songwriter',
+    'soul', 'soundtracks', 'spanish', 'study', 'summer', 'swedish', 'synth-pop', 'tango', 'techno',
+    'trance', 'trip-hop', 'turkish', 'work-out', 'world-music',
+)
+
+# Artist genre phrases whose seed is not just the phrase with dashes
+ALIASES = {
+    'r&b': 'r-n-b',
+    'rnb': 'r-n-b',
+    'urban contemporary': 'r-n-b',
+    'rap': 'hip-hop',
+    'trap': 'hip-hop',
+    'alternative rock': 'alt-rock',
+    'rock and roll': 'rock-n-roll',
+    'lo-fi': 'chill',
+    'lofi': 'chill',
+    'motown': 'soul',
+    'new wave': 'synth-pop',
+    'british invasion': 'british',
+    'permanent wave': 'alt-rock',
+    'reggaeton flow': 'reggaeton',
+    'musica mexicana': 'latin',
+}
+
+
+def _slug(phrase):
+    return phrase.replace(' & ', '-n-').replace('&', '-n-').replace(' ', '-')
+
+
+def nearest(genre, available):
+    """
+    The seed for a free-form genre, or None: the longest run of its words
+    that is a seed (directly or via ALIASES), preferring the last words -
+    "canadian contemporary r&b" -> "r-n-b", "dance pop" -> "pop".
+    """
+    words = genre.lower().split()
+    for length in range(len(words), 0, -1):
+        for start in range(len(words) - length, -1, -1):
+            phrase = ' '.join(words[start:start + length])
+            for candidate in (ALIASES.get(phrase), _slug(phrase)):
+                if candidate in available:
+                    return candidate
+    return None
+
+
+class GenreSeeds:
+    def __init__(self, path=SEEDS_PATH, ttl=SEEDS_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._available = frozenset(DEFAULT_GENRE_SEEDS)
+        self._fetched_at = 0
+        self._signature = None
+        self._nearest = {}
+
+    def _reload(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        signature = (stat.st_ino, stat.st_mtime_ns)
+        if signature == self._signature:
+            return
+        with open(self.path) as f:
+            data = json.load(f)
+        if data.get('genres'):
+            self._available = frozenset(data['genres'])
+            self._fetched_at = data.get('fetched_at', 0)
+            self._nearest = {}
+        self._signature = signature
+
+    def _fetch(self, sp):
+        with metrics.upstream('spotify_genre_seeds'):
+            genres = sp.recommendation_genre_seeds()['genres']
+        data = {'fetched_at': int(time.time()), 'genres': sorted(genres)}
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+        logger.info("Cached %s genre seeds", len(genres))
+
+    def available(self, sp=None):
+        """The valid seed genres, refetched with `sp` when the cached list is stale"""
+        with self._lock:
+            self._reload()
+            if sp is not None and time.time() - self._fetched_at > self.ttl:
+                # Claim the refresh so concurrent requests keep the old list
+                # meanwhile; if it fails, the next try is RETRY_INTERVAL away
+                self._fetched_at = time.time() - self.ttl + RETRY_INTERVAL
+                stale = True
+            else:
+                stale = False
+        if stale:
+            self._fetch(sp)
+            with self._lock:
+                self._reload()
+        return self._available
+
+    def validate(self, genres, sp=None):
+        """Unique valid seeds for free-form genres, in order; genres with no seed are dropped"""
+        available = self.available(sp)
+        seeds = []
+        for genre in genres:
+            with self._lock:
+                seed = self._nearest.get(genre, False)
+                if seed is False:
+                    seed = self._nearest[genre] = nearest(genre, available)
+            if seed and seed not in seeds:
+                seeds.append(seed)
+        return seeds
+
+
+SEEDS = GenreSeeds()
+
+
+def validate(genres, sp=None):
+    """Valid seed genres for `genres`; falls back to the published list and never raises"""
+    try:
+        return SEEDS.validate(genres, sp)
+    except Exception as e:
+        logger.warning("Could not load genre seeds: %s", e)
+        seeds = (nearest(genre, DEFAULT_GENRE_SEEDS) for genre in genres)
+        return [seed for seed in dict.fromkeys(seeds) if seed]
+
+
+def available():
+    """The cached seed genres, else the published list; never raises"""
+    try:
+        return SEEDS.available()
+    except (OSError, ValueError) as e:
+        logger.warning("Could not load genre seeds: %s", e)
+        return frozenset(DEFAULT_GENRE_SEEDS)
+
+
+def seed_weights(genre_weights):
+    """[{'seed', 'weight'}] from [{'genre', 'weight'}], summing the genres that map to each seed"""
+    seeds = available()
+    weights = {}
+    for entry in genre_weights:
+        seed = nearest(entry['genre'], seeds)
+        if seed:
+            weights[seed] = weights.get(seed, 0.0) + entry['weight']
+    return [{'seed': seed, 'weight': round(weight, 4)}
+            for seed, weight in sorted(weights.items(), key=lambda item: item[1], reverse=True)]
+
+
+os.register_at_fork(after_in_child=SEEDS.reset)
@@ -0,0 +1,18 @@
+# Gunicorn settings, picked up automatically from the working directory.
+# Bind address and worker count come from the command line or the PORT and
+# WEB_CONCURRENCY environment variables.
+import os
+import shutil
+
+# Build the app once in the master and fork it into the workers. Per-worker
+# state (metrics, log listener, profiling locks) re-initializes after fork.
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+
+
+def on_starting(arbiter):
+    # Every deployment starts with fresh per-worker metric snapshots
+    shutil.rmtree(os.getenv('MOOSIC_METRICS_DIR', '/tmp/moosic_metrics'), ignore_errors=True)
+    if arbiter.cfg.preload_app:
+        # Import the heavy client libraries once so workers share them copy-on-write
+        import server
+        server.warm_imports()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Hedged requests for idempotent Spotify reads (search, albums, audio
+features). When a call has not answered within the rolling p95 latency of
+its kind, a duplicate is sent and whichever answers first wins. The slower
+attempt is left to finish in the background and its result is dropped.
+
+A token bucket caps hedges at MOOSIC_HEDGE_BUDGET of all calls (5% by
+default), so a slow Spotify is not hit with twice the load. Hedges sent,
+won and suppressed by the budget are exported as moosic_hedges_total.
+"""
+
+import os
+import time
+import logging
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv('MOOSIC_HEDGING', 'false').lower() in ('1', 'true', 'yes')
+BUDGET = float(os.getenv('MOOSIC_HEDGE_BUDGET', '0.05'))
+# Hedge delay until a call kind has MIN_SAMPLES latencies of its own
+DEFAULT_DELAY = float(os.getenv('MOOSIC_HEDGE_DEFAULT_DELAY_MS', '500')) / 1000
+MIN_DELAY = 0.02
+MIN_SAMPLES = 20
+WINDOW = 500
+# Unused budget carried over, in hedges
+MAX_TOKENS = 10.0
+MAX_WORKERS = int(os.getenv('MOOSIC_HEDGE_WORKERS', '32'))
+
+
+class LatencyWindow:
+    """The last WINDOW latencies of one call kind and their p95, recomputed every few samples"""
+
+    def __init__(self, size=WINDOW, min_samples=MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+        self._p95 = None
+        self._stale = 0
+
+    def observe(self, seconds):
+        self._samples.append(seconds)
+        self._stale += 1
+
+    def p95(self):
+        if len(self._samples) < self.min_samples:
+            return None
+        if self._p95 is None or self._stale >= 10:
+            ordered = sorted(self._samples)
+            self._p95 = ordered[int(len(ordered) * 0.95) - 1]
+            self._stale = 0
+        return self._p95
+
+
+class Hedger:
+    def __init__(self, budget=BUDGET, max_workers=MAX_WORKERS):
+        self.budget = budget
+        self.max_workers = max_workers
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._tokens = 1.0
+        self._pool = None
+
+    def delay(self, call):
+        """Seconds to wait before hedging a call of this kind"""
+        with self._lock:
+            window = self._windows.get(call)
+            p95 = window.p95() if window else None
+        return max(MIN_DELAY, p95 if p95 is not None else DEFAULT_DELAY)
+
+    def _observe(self, call, seconds):
+        with self._lock:
+            self._windows.setdefault(call, LatencyWindow()).observe(seconds)
+
+    def _earn(self):
+        with self._lock:
+            self._tokens = min(MAX_TOKENS, self._tokens + self.budget)
+
+    def _spend(self):
+        with self._lock:
+            if self._tokens < 1.0:
+                return False
+            self._tokens -= 1.0
+            return True
+
+    def _submit(self, call, func):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='hedge')
+        start = time.perf_counter()
+        # A copy of the caller's context per attempt, so per-request metrics still apply
+        future = self._pool.submit(contextvars.copy_context().run, func)
+
+        def finished(future):
+            if future.exception() is None:
+                self._observe(call, time.perf_counter() - start)
+
+        future.add_done_callback(finished)
+        return future
+
+    def call(self, call, func):
+        """func(), hedged with a second func() if the first is slower than the p95 for `call`"""
+        self._earn()
+        primary = self._submit(call, func)
+        done, _ = wait([primary], timeout=self.delay(call))
+        if done:
+            return primary.result()
+        if not self._spend():
+            metrics.hedge(call, 'suppressed')
+            return primary.result()
+        metrics.hedge(call, 'sent')
+        hedge = self._submit(call, func)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            # An attempt that failed only loses if the other one succeeds
+            succeeded = [future for future in done if future.exception() is None]
+            if succeeded:
+                winner = primary if primary in succeeded else hedge
+                if winner is hedge:
+                    metrics.hedge(call, 'won')
+                return winner.result()
+        return primary.result()
+
+
+HEDGER = Hedger()
+
+
+def call(name, func):
+    """Run an idempotent upstream read, hedged when MOOSIC_HEDGING is on"""
+    if not ENABLED:
+        return func()
+    return HEDGER.call(name, func)
+
+
+os.register_at_fork(after_in_child=HEDGER.reset)
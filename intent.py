@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Keyword tables used to read moods, genres and eras out of playlist descriptions"""
+
+import re
+
+# Track names containing any of these are almost never the original recording
+SUSPICIOUS_KEYWORDS = ['karaoke', 'tribute', 'cover', 'made famous', 'instrumental', 'remake']
+SUSPICIOUS_PATTERN = re.compile('|'.join(map(re.escape, SUSPICIOUS_KEYWORDS)), re.IGNORECASE)
+
+MOOD_MAPPING = {
+    'happy': {'valence': 0.8, 'energy': 0.7},
+    'sad': {'valence': 0.2, 'energy': 0.4},
+    'energetic': {'energy': 0.9, 'tempo': 140},
+    'chill': {'energy': 0.3, 'acousticness': 0.7, 'tempo': 90},
+    'relaxed': {'energy': 0.3, 'acousticness': 0.6, 'valence': 0.5},
+    'angry': {'energy': 0.8, 'valence': 0.3, 'tempo': 130},
+    'romantic': {'valence': 0.6, 'energy': 0.4, 'acousticness': 0.5},
+    'workout': {'energy': 0.9, 'tempo': 150},
+    'party': {'danceability': 0.8, 'energy': 0.8, 'tempo': 120},
+    'focus': {'energy': 0.4, 'instrumentalness': 0.5, 'acousticness': 0.5},
+    'sleep': {'energy': 0.1, 'acousticness': 0.8, 'instrumentalness': 0.6}
+}
+
+POSSIBLE_GENRES = [
+    'rock', 'pop', 'hip-hop', 'rap', 'r&b', 'country', 'folk', 'jazz',
+    'blues', 'electronic', 'dance', 'indie', 'classical', 'metal',
+    'alternative', 'punk', 'soul', 'reggae', 'funk', 'disco',
+    'techno', 'house', 'ambient', 'edm', 'lo-fi', 'latin'
+]
+
+ERA_PATTERNS = {
+    '50s': {'min_year': 1950, 'max_year': 1959, 'keywords': ['50s', 'fifties', '1950s']},
+    '60s': {'min_year': 1960, 'max_year': 1969, 'keywords': ['60s', 'sixties', '1960s']},
+    '70s': {'min_year': 1970, 'max_year': 1979, 'keywords': ['70s', 'seventies', '1970s']},
+    '80s': {'min_year': 1980, 'max_year': 1989, 'keywords': ['80s', 'eighties', '1980s']},
+    '90s': {'min_year': 1990, 'max_year': 1999, 'keywords': ['90s', 'nineties', '1990s']},
+    '2000s': {'min_year': 2000, 'max_year': 2009, 'keywords': ['00s', '2000s', 'two thousands']},
+    '2010s': {'min_year': 2010, 'max_year': 2019, 'keywords': ['10s', '2010s', 'twenty tens']},
+    '2020s': {'min_year': 2020, 'max_year': 2029, 'keywords': ['20s', '2020s', 'twenty twenties']}
+}
+
+
+# Requests for charts or a specific year want objectively popular songs, not personal taste
+OBJECTIVE_PATTERNS = ['top songs', 'best songs', 'popular songs', 'hit songs', 'billboard', 'chart', 'most played']
+YEAR_PATTERN = re.compile(r'\b(?:19|20)\d{2}\b')
+
+
+# "songs like X" style requests, capturing the reference
+SIMILAR_SONG_PATTERNS = [
+    r'songs? like (.+)',
+    r'similar to (.+)',
+    r'tracks? like (.+)',
+    r'music like (.+)',
+    r'vibes? like (.+)'
+]
+
+
+def objective_reason(description_lower):
+    """The pattern or year that makes a request objective, or None"""
+    for pattern in OBJECTIVE_PATTERNS:
+        if pattern in description_lower:
+            return pattern
+    year = YEAR_PATTERN.search(description_lower)
+    return year.group(0) if year else None
+
+
+def is_suspicious(name):
+    """Whether a track name looks like a karaoke/cover/tribute version"""
+    return SUSPICIOUS_PATTERN.search(name) is not None
+
+
+def mood_profile(description_lower):
+    """Recommendation targets for the moods mentioned in a description"""
+    profile = {'valence': 0.5, 'energy': 0.5, 'tempo': 120, 'danceability': 0.5}
+    for mood, attributes in MOOD_MAPPING.items():
+        if mood in description_lower or f"{mood} music" in description_lower:
+            for attr, value in attributes.items():
+                profile[attr] = value
+    return profile
+
+
+def detect_genres(description_lower):
+    return [genre for genre in POSSIBLE_GENRES
+            if genre in description_lower or f"{genre} music" in description_lower]
+
+
+def detect_era(description_lower):
+    """Return (era, min_year, max_year) for the first era mentioned, or (None, None, None)"""
+    for era, info in ERA_PATTERNS.items():
+        for keyword in info['keywords']:
+            if keyword in description_lower:
+                return era, info['min_year'], info['max_year']
+    return None, None, None
+
+
+def prompt_class(description_lower):
+    """Coarse request class used to track how well suggestions resolve"""
+    if objective_reason(description_lower):
+        return 'objective'
+    if any(re.search(pattern, description_lower) for pattern in SIMILAR_SONG_PATTERNS):
+        return 'similar'
+    if detect_genres(description_lower):
+        return 'genre'
+    if any(mood in description_lower for mood in MOOD_MAPPING):
+        return 'mood'
+    return 'other'
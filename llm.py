@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import os
+import logging
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def get_openai():
+    """Import and configure the OpenAI client on first use"""
+    import openai
+    if openai.api_key is None:
+        openai.api_key = os.getenv('OPENAI_API_KEY')
+        if os.getenv('OPENAI_API_BASE'):
+            openai.api_base = os.getenv('OPENAI_API_BASE')
+    return openai
+
+
+def _estimate_tokens(text):
+    # Rough but stable: ~4 characters per token for English text
+    return max(1, len(text) // 4)
+
+
+def chat_completion(endpoint, messages, model='gpt-3.5-turbo', max_tokens=None, temperature=0.7):
+    """
+    Run one chat completion and return the reply text. Prompt and completion
+    tokens are counted per endpoint and model; when the API does not report
+    usage they are estimated from the text.
+    """
+    openai = get_openai()
+    params = {'model': model, 'messages': messages, 'temperature': temperature}
+    if max_tokens:
+        params['max_tokens'] = max_tokens
+
+    with metrics.upstream('openai_chat'):
+        response = openai.ChatCompletion.create(**params)
+    content = (response.choices[0].message.get('content') or '').strip()
+
+    usage = response.get('usage') or {}
+    prompt_tokens = usage.get('prompt_tokens') or _estimate_tokens(''.join(m['content'] for m in messages))
+    completion_tokens = usage.get('completion_tokens') or _estimate_tokens(content)
+    metrics.llm_tokens(endpoint, model, prompt_tokens, completion_tokens)
+    finish_reason = response.choices[0].get('finish_reason')
+    logger.info("OpenAI %s for %s: %s prompt + %s completion tokens (max %s, finish %s)",
+                model, endpoint, prompt_tokens, completion_tokens, max_tokens, finish_reason)
+    return content
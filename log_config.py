@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import queue
+import random
+import atexit
+import logging
+import contextvars
+from logging.handlers import QueueHandler, QueueListener
+
+# Per-request context, set by the Flask before_request hook
+request_id_var = contextvars.ContextVar('request_id', default='-')
+category_var = contextvars.ContextVar('log_category', default='-')
+sampled_var = contextvars.ContextVar('log_sampled', default=True)
+
+# Hot endpoints only keep a fraction of their INFO/DEBUG lines by default
+DEFAULT_SAMPLE_RATES = {
+    'check_auth': 0.05,
+    'get_me': 0.2,
+    'get_top_tracks': 0.2,
+}
+
+_listener = None
+
+# Attributes every LogRecord has - anything else came in through `extra=`
+_RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class RequestContextFilter(logging.Filter):
+    """Attach the current request id and log category to every record"""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        if not hasattr(record, 'category'):
+            record.category = category_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Drop INFO/DEBUG records of requests that were not sampled. The decision is
+    made once per request (see start_request) so a sampled request keeps all of
+    its lines. Warnings and errors are never dropped.
+    """
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or sampled_var.get()
+
+
+class StructuredQueueHandler(QueueHandler):
+    """
+    Queue handler that only resolves the message on the calling thread and
+    leaves formatting (JSON encoding, tracebacks) and I/O to the listener.
+    """
+
+    def prepare(self, record):
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            # Tracebacks reference frames that must not outlive the request
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'request_id': getattr(record, 'request_id', '-'),
+            'category': getattr(record, 'category', '-'),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS and key not in entry:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def parse_sample_rates(value):
+    """Parse 'check_auth=0.05,get_me=0.2' into a dict"""
+    rates = {}
+    for item in (value or '').split(','):
+        if '=' not in item:
+            continue
+        category, rate = item.split('=', 1)
+        try:
+            rates[category.strip()] = max(0.0, min(1.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+SAMPLE_RATES = dict(DEFAULT_SAMPLE_RATES, **parse_sample_rates(os.getenv('MOOSIC_LOG_SAMPLE_RATES')))
+
+
+def start_request(request_id, category):
+    """Bind a request id and category to the current context and decide sampling"""
+    request_id_var.set(request_id)
+    category_var.set(category or '-')
+    rate = SAMPLE_RATES.get(category, 1.0)
+    sampled_var.set(rate >= 1.0 or random.random() < rate)
+
+
+def setup_logging(level=None, fmt=None):
+    """
+    Route all logging through a non-blocking queue. Records are filtered and
+    sampled on the calling thread; a single listener thread formats and writes
+    them.
+    """
+    global _listener
+
+    level = level or os.getenv('LOG_LEVEL', 'INFO')
+    fmt = fmt or os.getenv('MOOSIC_LOG_FORMAT', 'json')
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    if fmt == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s'
+        ))
+
+    queue_handler = StructuredQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(RequestContextFilter())
+    queue_handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    stop_logging()
+    _listener = QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    return queue_handler
+
+
+def _restart_after_fork():
+    # The listener thread does not survive fork(): give the child its own
+    # queue and listener so a --preload master's setup keeps working
+    global _listener
+    if _listener is None:
+        return
+    handlers = _listener.handlers
+    new_queue = queue.SimpleQueue()
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, StructuredQueueHandler):
+            handler.queue = new_queue
+    _listener = QueueListener(new_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """Flush and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=_restart_after_fork)
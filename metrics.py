@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import glob
+import threading
+import logging
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds - upstream calls range from a few ms (token refresh)
+# to tens of seconds (gpt-4 completions)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRIC_HELP = {
+    'moosic_upstream_request_seconds': ('histogram', 'Latency of upstream Spotify/OpenAI calls'),
+    'moosic_stage_seconds': ('histogram', 'Latency of playlist pipeline stages'),
+    'moosic_retries_total': ('counter', 'Upstream call attempts that were retried'),
+    'moosic_cache_hits_total': ('counter', 'Cache lookups that were served from cache'),
+    'moosic_cache_misses_total': ('counter', 'Cache lookups that missed'),
+    'moosic_fallback_total': ('counter', 'Times a fallback path was used'),
+    'moosic_tracks_total': ('counter', 'Tracks added to playlists by source'),
+    'moosic_candidates_rejected_total': ('counter', 'Candidate tracks rejected by source and filter'),
+    'moosic_admission_wait_seconds': ('histogram', 'Time generation requests waited for a slot'),
+    'moosic_admission_rejected_total': ('counter', 'Generation requests rejected with 503 under load'),
+    'moosic_degraded_total': ('counter', 'Requests that ran with a degradation step'),
+    'moosic_llm_tokens_total': ('counter', 'OpenAI prompt and completion tokens by endpoint'),
+    'moosic_suggestions_total': ('counter', 'LLM song suggestions by prompt class and whether they resolved'),
+    'moosic_analytics_dropped_total': ('counter', 'Analytics records dropped because the write queue was full'),
+    'moosic_hedges_total': ('counter', 'Hedged duplicate upstream reads: sent, won, or suppressed by the budget'),
+    'moosic_suggestion_backend_total': ('counter', 'Suggestion requests per backend: served, combined, empty, failed or skipped'),
+}
+
+
+class Registry:
+    """
+    In-process metric registry that periodically snapshots itself to a shared
+    directory so /metrics can aggregate the values of every gunicorn worker.
+    """
+
+    def __init__(self, directory=None, flush_interval=5.0, buckets=DEFAULT_BUCKETS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._last_flush = 0.0
+        self._pid = os.getpid()
+
+    def inc(self, name, amount=1, **labels):
+        """Increment a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+        self._maybe_flush()
+
+    def observe(self, name, value, **labels):
+        """Record a value in a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                # One slot per bucket plus +Inf, then sum
+                hist = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+                    break
+            else:
+                hist[len(self.buckets)] += 1
+            hist[-1] += value
+        self._maybe_flush()
+
+    def reset(self):
+        """Drop all values, e.g. in a freshly forked worker"""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._last_flush = 0.0
+            self._pid = os.getpid()
+
+    def snapshot(self):
+        """Return a JSON-serializable copy of the current values"""
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, list(labels), list(hist)] for (name, labels), hist in self._histograms.items()],
+            }
+
+    def _snapshot_path(self):
+        return os.path.join(self.directory, f"metrics_{self._pid}.json")
+
+    def _maybe_flush(self):
+        if not self.directory:
+            return
+        now = time.monotonic()
+        if now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+        self.flush()
+
+    def flush(self):
+        """Write this worker's snapshot to the shared directory"""
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._snapshot_path()
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Could not write metrics snapshot: %s", e)
+
+    def collect(self):
+        """Merge the snapshots of all workers, using live values for this one"""
+        snapshots = [self.snapshot()]
+        if self.directory:
+            own_path = self._snapshot_path()
+            for path in glob.glob(os.path.join(self.directory, 'metrics_*.json')):
+                if path == own_path:
+                    continue
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+
+        counters = {}
+        histograms = {}
+        for snap in snapshots:
+            for name, labels, value in snap['counters']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, hist in snap['histograms']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                merged = histograms.get(key)
+                if merged is None or len(merged) != len(hist):
+                    histograms[key] = list(hist)
+                else:
+                    histograms[key] = [a + b for a, b in zip(merged, hist)]
+        return counters, histograms
+
+    def render(self):
+        """Render all workers' metrics in the Prometheus text exposition format"""
+        counters, histograms = self.collect()
+        lines = []
+        families = sorted({name for name, _ in counters} | {name for name, _ in histograms})
+        for family in families:
+            kind, help_text = METRIC_HELP.get(family, ('untyped', family))
+            lines.append(f"# HELP {family} {help_text}")
+            lines.append(f"# TYPE {family} {kind}")
+            for (name, labels), value in sorted(counters.items()):
+                if name == family:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), hist in sorted(histograms.items()):
+                if name != family:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets, hist):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', repr(bound)),))} {cumulative}")
+                cumulative += hist[len(self.buckets)]
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {hist[-1]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+REGISTRY = Registry(
+    directory=os.getenv('MOOSIC_METRICS_DIR', '/tmp/moosic_metrics'),
+    flush_interval=float(os.getenv('MOOSIC_METRICS_FLUSH_SECONDS', '5')),
+)
+
+# A forked worker starts from zero and snapshots under its own pid
+os.register_at_fork(after_in_child=REGISTRY.reset)
+
+
+@contextmanager
+def timer(name, **labels):
+    """Time the enclosed block into a histogram"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe(name, time.perf_counter() - start, **labels)
+
+
+# Upstream calls made by the current request, while something is counting them
+_request_calls = contextvars.ContextVar('moosic_request_calls', default=None)
+
+
+@contextmanager
+def counting_upstream_calls():
+    """Collect {call: count} of the upstream calls made inside the block"""
+    counts = {}
+    token = _request_calls.set(counts)
+    try:
+        yield counts
+    finally:
+        _request_calls.reset(token)
+
+
+def upstream(call):
+    """Time one upstream call, e.g. upstream('spotify_search')"""
+    counts = _request_calls.get()
+    if counts is not None:
+        counts[call] = counts.get(call, 0) + 1
+    return timer('moosic_upstream_request_seconds', call=call)
+
+
+class StageClock:
+    """
+    Times consecutive pipeline stages of one request: each lap() closes the
+    stage that has been running since the previous lap.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.timings = {}
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        elapsed = now - self._last
+        self._last = now
+        self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+        REGISTRY.observe('moosic_stage_seconds', elapsed, endpoint=self.endpoint, stage=stage)
+        return elapsed
+
+
+def retry(call):
+    REGISTRY.inc('moosic_retries_total', call=call)
+
+
+def cache_lookup(cache, hit):
+    REGISTRY.inc('moosic_cache_hits_total' if hit else 'moosic_cache_misses_total', cache=cache)
+
+
+def fallback(path):
+    REGISTRY.inc('moosic_fallback_total', path=path)
+
+
+def tracks_added(source, count=1):
+    if count:
+        REGISTRY.inc('moosic_tracks_total', count, source=source)
+
+
+def candidates_rejected(source, reason, count=1):
+    if count:
+        REGISTRY.inc('moosic_candidates_rejected_total', count, source=source, reason=reason)
+
+
+def admission_wait(endpoint, seconds):
+    REGISTRY.observe('moosic_admission_wait_seconds', seconds, endpoint=endpoint)
+
+
+def admission_rejected(endpoint):
+    REGISTRY.inc('moosic_admission_rejected_total', endpoint=endpoint)
+
+
+def degraded(step):
+    REGISTRY.inc('moosic_degraded_total', step=step)
+
+
+def llm_tokens(endpoint, model, prompt_tokens, completion_tokens):
+    REGISTRY.inc('moosic_llm_tokens_total', prompt_tokens, endpoint=endpoint, model=model, kind='prompt')
+    REGISTRY.inc('moosic_llm_tokens_total', completion_tokens, endpoint=endpoint, model=model, kind='completion')
+
+
+def suggestions(prompt_class, resolved, unresolved):
+    if resolved:
+        REGISTRY.inc('moosic_suggestions_total', resolved, prompt_class=prompt_class, outcome='resolved')
+    if unresolved:
+        REGISTRY.inc('moosic_suggestions_total', unresolved, prompt_class=prompt_class, outcome='unresolved')
+
+
+def analytics_dropped():
+    REGISTRY.inc('moosic_analytics_dropped_total')
+
+
+def hedge(call, outcome):
+    REGISTRY.inc('moosic_hedges_total', call=call, outcome=outcome)
+    counts = _request_calls.get()
+    if counts is not None and outcome == 'sent':
+        counts[f"{call}_hedge"] = counts.get(f"{call}_hedge", 0) + 1
+
+
+def suggestion_backend(endpoint, backend, outcome):
+    REGISTRY.inc('moosic_suggestion_backend_total', endpoint=endpoint, backend=backend, outcome=outcome)
@@ -1,86 +1,146 @@
 #!/usr/bin/env python3
 
 import os
+import csv
 import json
 import time
+import hashlib
+import statistics
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import spotipy
-import openai
 from spotipy.oauth2 import SpotifyOAuth
 from dotenv import load_dotenv
 import argparse
 from typing import List, Dict
 import logging
 
+import llm
+import intent
+import prompts
+import resolution
+import suggestion_backends
+
 # Load environment variables
 load_dotenv()
 
+# Earlier suggestions passed back to the LLM so later rounds bring new songs
+MAX_EXCLUDED = 60
+
+SCOPE = 'playlist-modify-public playlist-modify-private user-read-private user-read-email'
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class ResolutionCache:
+    """Thread-safe song -> Spotify track cache shared by every prompt of a batch (misses are cached too)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tracks = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(song):
+        return (song['title'].strip().lower(), song['artist'].strip().lower())
+
+    def get(self, song):
+        with self._lock:
+            found = self.key(song) in self._tracks
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return found, self._tracks.get(self.key(song))
+
+    def put(self, song, track):
+        with self._lock:
+            self._tracks[self.key(song)] = track
+
+
+def spotify_client():
+    """Authenticated Spotify client for the CLI user"""
+    return spotipy.Spotify(auth_manager=SpotifyOAuth(
+        client_id=os.getenv('SPOTIFY_CLIENT_ID'),
+        client_secret=os.getenv('SPOTIFY_CLIENT_SECRET'),
+        redirect_uri=os.getenv('SPOTIFY_REDIRECT_URI'),
+        scope=SCOPE
+    ))
+
+
 class PlaylistGenerator:
-    def __init__(self, prompt, length=10, name=None, interactive=False):
+    def __init__(self, prompt, length=10, name=None, interactive=False,
+                 sp=None, user=None, resolution_cache=None, search_pool=None, quiet=False):
         self.prompt = prompt
         self.length = length
         self.name = name or prompt
         self.interactive = interactive
+        self.quiet = quiet
         self.blacklisted_artists = set()
         self.blacklisted_songs = set()
+        self.prompt_class = intent.prompt_class(prompt.lower())
+        self.suggested = []
+        self.seen_suggestions = set()
+        # Batch runs share one client, user, cache and search pool across prompts
+        self.resolution_cache = resolution_cache
+        self.search_pool = search_pool
+        self.timings = {'llm': 0.0, 'search': 0.0, 'write': 0.0, 'rounds': 0}
         
         # Initialize Spotify client
-        self.sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
-            client_id=os.getenv('SPOTIFY_CLIENT_ID'),
-            client_secret=os.getenv('SPOTIFY_CLIENT_SECRET'),
-            redirect_uri=os.getenv('SPOTIFY_REDIRECT_URI'),
-            scope='playlist-modify-public playlist-modify-private user-read-private user-read-email'
-        ))
-        
-        # Initialize OpenAI
-        openai.api_key = os.getenv('OPENAI_API_KEY')
+        self.sp = sp or spotify_client()
         
         # Get current user
-        self.user = self.sp.current_user()
+        self.user = user or self.sp.current_user()
         self.user_id = self.user['id']
+
+    def log(self, message):
+        if not self.quiet:
+            print(message)
         
-    def get_song_suggestions(self):
+    def get_song_suggestions(self, count=None):
         """Get song suggestions from ChatGPT"""
-        messages = [
-            {
-                "role": "system",
-                "content": "You are a music expert. Suggest specific songs (with artists) that would fit the given prompt. Format the response as JSON with fields: songSuggestions (array of {title, artist}), description (string explaining the selection)."
-            },
-            {
-                "role": "user",
-                "content": f"Suggest {self.length} songs for: {self.prompt}"
-            }
-        ]
-        
-        if self.blacklisted_artists or self.blacklisted_songs:
-            messages.append({
-                "role": "user",
-                "content": f"Please avoid these artists: {', '.join(self.blacklisted_artists)} and these songs: {', '.join(self.blacklisted_songs)}"
-            })
-        
-        completion = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=messages
-        )
-        
-        try:
-            response = json.loads(completion.choices[0].message.content)
-            return response['songSuggestions']
-        except:
-            print("Error parsing ChatGPT response")
-            return []
+        count = count or self.length
+        exclude = [f"songs by {artist}" for artist in sorted(self.blacklisted_artists)]
+        exclude += sorted(self.blacklisted_songs)
+        exclude += self.suggested[-MAX_EXCLUDED:]
+        start = time.perf_counter()
+        result, backend = suggestion_backends.suggest('playlist_generator', {
+            'description': self.prompt,
+            'count': count,
+            'exclude': exclude,
+            'json_format': True,
+        })
+        self.timings['llm'] += time.perf_counter() - start
+        if backend is None:
+            self.log("No suggestion backend returned songs")
+        return result['songs']
     
     def search_spotify(self, song):
         """Search for a song on Spotify"""
+        if self.resolution_cache is not None:
+            found, track = self.resolution_cache.get(song)
+            if found:
+                return track
+
         query = f"track:{song['title']} artist:{song['artist']}"
         results = self.sp.search(q=query, type='track', limit=1)
+        track = results['tracks']['items'][0] if results['tracks']['items'] else None
         
-        if results['tracks']['items']:
-            return results['tracks']['items'][0]
-        return None
+        if self.resolution_cache is not None:
+            self.resolution_cache.put(song, track)
+        return track
+
+    def resolve_songs(self, songs):
+        """Search for every song, concurrently when a search pool is available"""
+        start = time.perf_counter()
+        if self.search_pool is None:
+            tracks = [self.search_spotify(song) for song in songs]
+        else:
+            tracks = list(self.search_pool.map(self.search_spotify, songs))
+        self.timings['search'] += time.perf_counter() - start
+        return tracks
     
     def create_playlist(self):
         """Create a new playlist"""
@@ -92,36 +152,78 @@ class PlaylistGenerator:
         )
         return playlist['id']
     
+    def playlist_track_uris(self, playlist_id):
+        """URIs of the tracks already in a playlist"""
+        uris = []
+        page = self.sp.playlist_items(playlist_id, fields='items(track(uri)),next', additional_types=('track',))
+        while page:
+            uris += [item['track']['uri'] for item in page['items'] if item.get('track')]
+            page = self.sp.next(page) if page.get('next') else None
+        return uris
+
     def add_songs_to_playlist(self, playlist_id, songs):
         """Add songs to the playlist"""
         track_uris = [song['uri'] for song in songs if song]
         if track_uris:
             self.sp.playlist_add_items(playlist_id, track_uris)
     
-    def generate_playlist(self):
-        """Generate the playlist"""
-        print(f"\nGenerating playlist: {self.name}")
-        print(f"Prompt: {self.prompt}")
-        print(f"Length: {self.length}")
-        print(f"Interactive: {self.interactive}\n")
+    def generate_playlist(self, playlist_id=None, on_created=None):
+        """
+        Generate the playlist. The Spotify playlist is created once the songs
+        are known, so a run that fails earlier leaves none behind; a resumed
+        run passes the `playlist_id` it already created and only tops it up
+        to `length` with tracks it does not have yet. `on_created` is called
+        with a newly created playlist's id before songs are added.
+        """
+        self.log(f"\nGenerating playlist: {self.name}")
+        self.log(f"Prompt: {self.prompt}")
+        self.log(f"Length: {self.length}")
+        self.log(f"Interactive: {self.interactive}\n")
         
-        playlist_id = self.create_playlist()
         added_songs = []
+        # A resumed run may have added its songs before it was interrupted
+        present = set(self.playlist_track_uris(playlist_id)) if playlist_id is not None else set()
+        wanted = self.length - len(present)
         
-        while len(added_songs) < self.length:
-            suggestions = self.get_song_suggestions()
+        while len(added_songs) < wanted:
+            # Over-ask by the measured miss rate so one round usually suffices
+            needed = wanted - len(added_songs)
+            suggestions = self.get_song_suggestions(resolution.suggestion_count(needed, self.prompt_class))
+            self.timings['rounds'] += 1
             
             if not suggestions:
-                print("No more suggestions available")
+                self.log("No more suggestions available")
                 break
-                
+
+            # Skip songs an earlier round already suggested
+            new_songs = []
             for song in suggestions:
-                if len(added_songs) >= self.length:
+                key = f"{song['title']} by {song['artist']}"
+                if key.lower() in self.seen_suggestions:
+                    continue
+                self.seen_suggestions.add(key.lower())
+                self.suggested.append(key)
+                new_songs.append(song)
+            if not new_songs:
+                self.log("No new suggestions available")
+                break
+
+            # Interactive sessions search one song at a time as they are shown
+            tracks = None if self.interactive else self.resolve_songs(new_songs)
+                
+            attempted = resolved = 0
+            for i, song in enumerate(new_songs):
+                if len(added_songs) >= wanted:
                     break
+                attempted += 1
                     
-                spotify_track = self.search_spotify(song)
+                spotify_track = tracks[i] if tracks is not None else self.resolve_songs([song])[0]
                 if not spotify_track:
-                    print(f"Could not find: {song['title']} by {song['artist']}")
+                    self.log(f"Could not find: {song['title']} by {song['artist']}")
+                    continue
+                resolved += 1
+                if spotify_track['uri'] in present:
+                    self.log(f"Already in playlist: {song['title']} by {song['artist']}")
                     continue
                 
                 if self.interactive:
@@ -135,6 +237,7 @@ class PlaylistGenerator:
                     
                     if choice == '1':
                         added_songs.append(spotify_track)
+                        present.add(spotify_track['uri'])
                     elif choice == '2':
                         self.blacklisted_songs.add(song['title'])
                     elif choice == '3':
@@ -143,8 +246,11 @@ class PlaylistGenerator:
                         break
                 else:
                     added_songs.append(spotify_track)
+                    present.add(spotify_track['uri'])
+
+            resolution.record(self.prompt_class, attempted, resolved)
             
-            if self.interactive and len(added_songs) < self.length:
+            if self.interactive and len(added_songs) < wanted:
                 print(f"\nAdded {len(added_songs)} songs so far. Want more?")
                 print("[1] Yes, more songs!")
                 print("[2] No, I'm done")
@@ -152,8 +258,15 @@ class PlaylistGenerator:
                 if input("Your choice: ") != '1':
                     break
         
+        start = time.perf_counter()
+        if playlist_id is None:
+            playlist_id = self.create_playlist()
+            if on_created is not None:
+                on_created(playlist_id)
         self.add_songs_to_playlist(playlist_id, added_songs)
-        print(f"\nPlaylist created with {len(added_songs)} songs!")
+        self.timings['write'] += time.perf_counter() - start
+        self.added = len(present)
+        self.log(f"\nPlaylist created with {len(present)} songs!")
         return playlist_id
 
 def generate_playlist_suggestions(mood: str, genre: str = None, era: str = None) -> List[Dict[str, str]]:
@@ -169,22 +282,18 @@ def generate_playlist_suggestions(mood: str, genre: str = None, era: str = None)
             prompt += f" from the {era} era"
         prompt += ". For each song, provide the exact title and artist name. Format the response as a list of songs with 'Title - Artist' format."
 
-        logger.info(f"Generating playlist with prompt: {prompt}")
+        logger.info("Generating playlist with prompt: %s", prompt)
 
         # Call OpenAI API
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
+        content = llm.chat_completion(
+            'generate_playlist_suggestions',
+            [
                 {"role": "system", "content": "You are a music expert who creates perfect playlists."},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0.7,
-            max_tokens=500
+            max_tokens=prompts.max_tokens_for(10)
         )
-
-        # Parse the response
-        content = response.choices[0].message.content
-        logger.info(f"OpenAI response: {content}")
+        logger.info("OpenAI response: %s", content)
 
         # Split the response into lines and parse each song
         songs = []
@@ -199,21 +308,156 @@ def generate_playlist_suggestions(mood: str, genre: str = None, era: str = None)
                         'artist': artist
                     })
 
-        logger.info(f"Generated {len(songs)} songs")
+        logger.info("Generated %s songs", len(songs))
         return songs
 
     except Exception as e:
-        logger.error(f"Error generating playlist: {str(e)}")
+        logger.error("Error generating playlist: %s", str(e))
         raise
 
+def load_batch(path):
+    """Read batch prompts from a .jsonl or .csv file with prompt, length and name columns"""
+    entries = []
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    repeats = {}
+    for row in rows:
+        if not row.get('prompt'):
+            continue
+        entry = {
+            'prompt': row['prompt'],
+            'length': int(row.get('length') or 10),
+            'name': row.get('name') or None,
+        }
+        # Stable id for the progress file: the same entry resumes even if lines
+        # move, and the nth copy of a repeated line gets its own id
+        key = json.dumps(entry, sort_keys=True)
+        repeat = repeats[key] = repeats.get(key, -1) + 1
+        if repeat:
+            key += f"#{repeat}"
+        entry['id'] = hashlib.sha1(key.encode()).hexdigest()[:16]
+        entries.append(entry)
+    return entries
+
+
+def load_progress(path):
+    """
+    The latest progress record per entry id: a completed entry, or one whose
+    playlist was created ({'status': 'created'}) but not filled yet
+    """
+    done = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by an interruption
+                done[record['id']] = record
+    return done
+
+
+def run_batch(path, concurrency=4, search_concurrency=8, progress_path=None):
+    """
+    Generate every playlist in a batch file with one authenticated client.
+    Prompts run `concurrency` at a time; their Spotify searches share a pool
+    of `search_concurrency` threads and one resolution cache. Created
+    playlists and finished entries are appended to the progress file, so a
+    rerun skips finished entries and tops up the playlists of interrupted ones
+    instead of creating new ones.
+    """
+    entries = load_batch(path)
+    progress_path = progress_path or f"{path}.progress.jsonl"
+    progress = load_progress(progress_path)
+    created = {entry_id: record['playlist_id'] for entry_id, record in progress.items()
+               if record.get('status') == 'created'}
+    pending = [entry for entry in entries if entry['id'] not in progress or entry['id'] in created]
+    print(f"{len(entries)} prompts, {len(entries) - len(pending)} already done, {len(pending)} to generate")
+    if not pending:
+        return []
+
+    sp = spotify_client()
+    user = sp.current_user()
+    cache = ResolutionCache()
+    progress_lock = threading.Lock()
+    results = []
+
+    def save_progress(record):
+        with progress_lock:
+            with open(progress_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def generate(entry, search_pool):
+        start = time.perf_counter()
+        generator = PlaylistGenerator(
+            prompt=entry['prompt'], length=entry['length'], name=entry['name'],
+            sp=sp, user=user, resolution_cache=cache, search_pool=search_pool, quiet=True
+        )
+        playlist_id = generator.generate_playlist(
+            created.get(entry['id']),
+            lambda playlist_id: save_progress({'id': entry['id'], 'playlist_id': playlist_id, 'status': 'created'}))
+        record = dict(
+            id=entry['id'], prompt=entry['prompt'], playlist_id=playlist_id, tracks=generator.added,
+            seconds=round(time.perf_counter() - start, 3),
+            **{key: round(value, 3) for key, value in generator.timings.items()}
+        )
+        save_progress(record)
+        return record
+
+    with ThreadPoolExecutor(max_workers=search_concurrency, thread_name_prefix='search') as search_pool:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='prompt') as prompt_pool:
+            futures = {prompt_pool.submit(generate, entry, search_pool): entry for entry in pending}
+            for future in as_completed(futures):
+                entry = futures[future]
+                try:
+                    record = future.result()
+                except Exception as e:
+                    logger.error("Failed to generate '%s': %s", entry['prompt'], e)
+                    continue
+                results.append(record)
+                print(f"[{len(results)}/{len(pending)}] {record['seconds']:7.2f}s  "
+                      f"llm {record['llm']:6.2f}s  search {record['search']:6.2f}s  write {record['write']:5.2f}s  "
+                      f"rounds {record['rounds']}  tracks {record['tracks']:3d}/{entry['length']:<3d} {entry['prompt'][:40]}")
+
+    print_batch_summary(results, cache)
+    return results
+
+
+def print_batch_summary(results, cache):
+    if not results:
+        print("\nNo playlists generated")
+        return
+    seconds = sorted(record['seconds'] for record in results)
+    print(f"\nGenerated {len(results)} playlists")
+    print(f"  per prompt  median {statistics.median(seconds):.2f}s  max {seconds[-1]:.2f}s  "
+          f"mean llm {statistics.mean(r['llm'] for r in results):.2f}s  "
+          f"mean search {statistics.mean(r['search'] for r in results):.2f}s")
+    lookups = cache.hits + cache.misses
+    if lookups:
+        print(f"  resolution cache  {cache.hits}/{lookups} hits ({cache.hits / lookups:.0%})")
+
 def main():
     parser = argparse.ArgumentParser(description='Generate Spotify playlists using ChatGPT')
-    parser.add_argument('-p', '--prompt', required=True, help='Prompt for playlist generation')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-p', '--prompt', help='Prompt for playlist generation')
+    source.add_argument('-b', '--batch', help='JSONL or CSV file of prompts (prompt, length, name) to generate')
     parser.add_argument('-l', '--length', type=int, default=10, help='Number of songs in playlist')
     parser.add_argument('-n', '--name', help='Playlist name (defaults to prompt)')
     parser.add_argument('-i', '--interactive', action='store_true', help='Enable interactive mode')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='Batch mode: playlists generated at once')
+    parser.add_argument('--search-concurrency', type=int, default=8, help='Batch mode: concurrent Spotify searches')
+    parser.add_argument('--progress', help='Batch mode: progress file (default: <batch>.progress.jsonl)')
     
     args = parser.parse_args()
+
+    if args.batch:
+        run_batch(args.batch, args.concurrency, args.search_concurrency, args.progress)
+        return
     
     generator = PlaylistGenerator(
         prompt=args.prompt,
@@ -225,4 +469,4 @@ def main():
     generator.generate_playlist()
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()
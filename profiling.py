@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import hmac
+import time
+import hashlib
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+from functools import wraps
+
+from flask import request
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'X-Moosic-Profile'
+PROFILE_SECRET = os.getenv('PROFILE_SECRET')
+PROFILES_DIR = os.getenv('MOOSIC_PROFILES_DIR', '/tmp/moosic_profiles')
+SAMPLE_INTERVAL = float(os.getenv('MOOSIC_PROFILE_INTERVAL_MS', '5')) / 1000.0
+MAX_PROFILES = int(os.getenv('MOOSIC_MAX_PROFILES', '50'))
+SIGNATURE_MAX_AGE = 300  # seconds
+
+# Requests left to profile without a signed header, armed by an admin
+_armed = 0
+_armed_lock = threading.Lock()
+# tracemalloc is process-wide, so only one request is profiled at a time
+_profile_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global _armed, _armed_lock, _profile_lock
+    _armed = 0
+    _armed_lock = threading.Lock()
+    _profile_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def sign(path, timestamp=None, secret=None):
+    """Build a header value that authorizes profiling one request to `path`"""
+    timestamp = str(int(timestamp or time.time()))
+    secret = secret or PROFILE_SECRET
+    digest = hmac.new(secret.encode(), f"{timestamp}:{path}".encode(), hashlib.sha256).hexdigest()
+    return f"{timestamp}.{digest}"
+
+
+def _valid_signature(value, path):
+    try:
+        timestamp, _ = value.split('.', 1)
+        if abs(time.time() - int(timestamp)) > SIGNATURE_MAX_AGE:
+            return False
+    except ValueError:
+        return False
+    return hmac.compare_digest(value, sign(path, timestamp))
+
+
+def is_admin(req):
+    """Admin requests carry the profiling secret as a bearer token"""
+    if not PROFILE_SECRET:
+        return False
+    return hmac.compare_digest(req.headers.get('Authorization', ''), f"Bearer {PROFILE_SECRET}")
+
+
+def arm(count):
+    """Profile the next `count` profiled-endpoint requests in this worker"""
+    global _armed
+    with _armed_lock:
+        _armed = max(0, int(count))
+        return _armed
+
+
+def _should_profile():
+    global _armed
+    if _armed:
+        with _armed_lock:
+            if _armed:
+                _armed -= 1
+                return True
+    header = request.headers.get(PROFILE_HEADER)
+    return bool(header and PROFILE_SECRET and _valid_signature(header, request.path))
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread at a fixed interval from a background
+    thread and aggregates the samples as collapsed stacks (flamegraph format).
+    """
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return '\n'.join(f"{stack} {count}" for stack, count in self.samples.most_common()) + '\n'
+
+
+def _write_profile(name, profiler, snapshot, started, elapsed):
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    base = os.path.join(PROFILES_DIR, name)
+    with open(f"{base}.collapsed", 'w') as f:
+        f.write(profiler.collapsed())
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ])
+    snapshot.dump(f"{base}.tracemalloc")
+    current, peak = tracemalloc.get_traced_memory()
+    with open(f"{base}.memory.txt", 'w') as f:
+        f.write(f"endpoint: {request.endpoint}\nstarted: {started}\nelapsed_seconds: {elapsed:.3f}\n")
+        f.write(f"cpu_samples: {sum(profiler.samples.values())}\n")
+        f.write(f"traced_current_bytes: {current}\ntraced_peak_bytes: {peak}\n\n")
+        for stat in snapshot.statistics('lineno')[:50]:
+            f.write(f"{stat}\n")
+    _prune()
+
+
+def _prune():
+    """Keep only the newest MAX_PROFILES profiles"""
+    names = sorted({entry.split('.', 1)[0] for entry in os.listdir(PROFILES_DIR)})
+    for stale in names[:-MAX_PROFILES] if len(names) > MAX_PROFILES else []:
+        for entry in os.listdir(PROFILES_DIR):
+            if entry.startswith(f"{stale}."):
+                os.remove(os.path.join(PROFILES_DIR, entry))
+
+
+def profiled(view):
+    """
+    Profile a view when the request carries a valid signed X-Moosic-Profile
+    header or profiling was armed by an admin. Otherwise the view runs as is.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not (_armed or PROFILE_HEADER in request.headers) or not _should_profile():
+            return view(*args, **kwargs)
+        if not _profile_lock.acquire(blocking=False):
+            logger.info("Another request is being profiled, skipping profile for %s", request.path)
+            return view(*args, **kwargs)
+
+        try:
+            started = time.strftime('%Y%m%dT%H%M%S')
+            name = f"{started}-{view.__name__}-{os.getpid()}-{threading.get_ident() % 100000}"
+            tracemalloc.start(25)
+            profiler = SamplingProfiler(threading.get_ident())
+            profiler.start()
+            start = time.perf_counter()
+            try:
+                response = view(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                profiler.stop()
+                snapshot = tracemalloc.take_snapshot()
+                try:
+                    _write_profile(name, profiler, snapshot, started, elapsed)
+                    logger.info("Wrote profile %s (%.3fs)", name, elapsed)
+                except OSError as e:
+                    logger.warning("Could not write profile %s: %s", name, e)
+                tracemalloc.stop()
+            return response
+        finally:
+            _profile_lock.release()
+
+    return wrapper
+
+
+def list_profiles():
+    """Describe the stored profile files, newest first"""
+    if not os.path.isdir(PROFILES_DIR):
+        return []
+    profiles = []
+    for entry in os.listdir(PROFILES_DIR):
+        path = os.path.join(PROFILES_DIR, entry)
+        stat = os.stat(path)
+        profiles.append({'file': entry, 'bytes': stat.st_size, 'modified': int(stat.st_mtime)})
+    profiles.sort(key=lambda p: (p['modified'], p['file']), reverse=True)
+    return profiles
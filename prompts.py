@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Compact prompt templates for every OpenAI call. Static system prompts are
+built once at import, parametrized ones once per distinct argument set.
+"""
+
+from functools import lru_cache
+
+# Completion budget per suggested song: a "Song Name by Artist Name" line is
+# ~10 tokens, a {"title", "artist"} JSON object ~20. The rest is headroom for
+# long titles, plus a fixed allowance for the JSON description.
+TOKENS_PER_SONG_LINE = 16
+TOKENS_PER_SONG_JSON = 28
+JSON_OVERHEAD_TOKENS = 120
+LINE_OVERHEAD_TOKENS = 20
+
+_CURATION_RULES = (
+    "Real, well-known original recordings likely on Spotify; no covers, karaoke, tributes, remixes or novelty songs. "
+    "Match the request's era, genres, mood, activity and any referenced artists or songs "
+    "(for \"songs like X\", match X's style, tempo and era). "
+    "For \"top/best songs\" or a specific year, pick the biggest global chart hits of that period, not regional or niche ones."
+)
+
+SONG_LIST_SYSTEM = (
+    "You are a music curator. " + _CURATION_RULES + "\n"
+    "Reply only with songs, one per line, formatted \"Song Name by Artist Name\". No numbering or commentary."
+)
+
+SONG_LISTS_SYSTEM = (
+    "You are a music curator. " + _CURATION_RULES + "\n"
+    "Answer each numbered request under a line with just its number, like \"#1\", "
+    "then its songs, one per line, formatted \"Song Name by Artist Name\". No other commentary."
+)
+
+SONG_JSON_SYSTEM = (
+    "You are a music curator. " + _CURATION_RULES + "\n"
+    "Reply with JSON: {\"songSuggestions\": [{\"title\", \"artist\"}], "
+    "\"description\": one or two sentences on why the songs fit}."
+)
+
+
+def max_tokens_for(count, json_format=False):
+    """Completion token budget for a reply listing `count` songs"""
+    if json_format:
+        return count * TOKENS_PER_SONG_JSON + JSON_OVERHEAD_TOKENS
+    return count * TOKENS_PER_SONG_LINE + LINE_OVERHEAD_TOKENS
+
+
+@lru_cache(maxsize=64)
+def _listener_line(artists, genres, tracks, traits):
+    parts = []
+    if artists:
+        parts.append(f"artists {', '.join(artists)}")
+    if genres:
+        parts.append(f"genres {', '.join(genres)}")
+    if tracks:
+        parts.append(f"tracks {', '.join(tracks)}")
+    if traits:
+        parts.append(f"traits {', '.join(traits)}")
+    return f"\nListener likes: {'; '.join(parts)}." if parts else ""
+
+
+def song_list_request(description, count, artists=(), genres=(), tracks=(), traits=(), exclude=()):
+    """User message asking for `count` songs as plain lines"""
+    prompt = f"{count} songs for: \"{description}\""
+    prompt += _listener_line(tuple(artists[:5]), tuple(genres[:5]), tuple(tracks[:5]), tuple(traits))
+    if exclude:
+        prompt += f"\nDo not include: {'; '.join(exclude)}."
+    return prompt
+
+
+def song_lists_request(requests):
+    """User message asking for several numbered song lists in one reply; `requests` are song_list_request arguments"""
+    return '\n\n'.join(f"#{number} " + song_list_request(**request)
+                         for number, request in enumerate(requests, 1))
+
+
+def song_json_request(description, count, exclude=()):
+    """User message asking for `count` songs as JSON"""
+    prompt = f"{count} songs for: {description}"
+    if exclude:
+        prompt += f"\nDo not include: {'; '.join(exclude)}."
+    return prompt
+
+
+def mood_genre_description(mood, genres):
+    return f"a {mood} playlist of {', '.join(genres)}"
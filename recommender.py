@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""
+Local track recommender built from the playlists Moosic has generated.
+
+Every generated playlist is appended to playlists.log as a line of track
+ids. `python recommender.py build` compacts the log into matrix.bin, a
+sparse track-track co-occurrence matrix in CSR form (top neighbours per
+track only), which workers memory-map. Playlists logged after the last
+build are tailed into a small in-memory delta, so recommendations pick up
+new playlists without a rebuild. The delta is capped at
+MOOSIC_RECOMMENDER_MAX_DELTA_PAIRS co-occurrences; past that, a worker
+starts `recommender.py build` as a child process (under build.lock, so
+only one runs) and every worker waits for it without growing its delta.
+
+Given resolved seed tracks, recommend() scores neighbours by cosine
+similarity of their playlist memberships and returns the top K in-process;
+callers fall back to Spotify's recommendations when it comes up short.
+"""
+
+import os
+import sys
+import math
+import mmap
+import time
+import fcntl
+import heapq
+import struct
+import logging
+import argparse
+import itertools
+import threading
+import subprocess
+from bisect import bisect_left
+
+import metrics
+import track_store
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.getenv('MOOSIC_RECOMMENDER_DIR', '/tmp/moosic_recommender')
+ENABLED = os.getenv('MOOSIC_LOCAL_RECOMMENDER', 'true').lower() in ('1', 'true', 'yes')
+
+# magic, version, rows, non-zero entries, log bytes folded into the matrix
+HEADER = struct.Struct('<4sIIIQ')
+VERSION = 1
+ID_BYTES = 22
+MAX_NEIGHBOURS = 100
+MAX_PLAYLIST_TRACKS = 100
+MAX_DELTA_PAIRS = int(os.getenv('MOOSIC_RECOMMENDER_MAX_DELTA_PAIRS', '250000'))
+REBUILD_RETRY_INTERVAL = 300
+
+
+class _Ids:
+    """Sorted, fixed-width track ids in the mapped matrix, indexable for bisect"""
+
+    def __init__(self, view, rows):
+        self._view = view
+        self._rows = rows
+
+    def __len__(self):
+        return self._rows
+
+    def __getitem__(self, row):
+        return bytes(self._view[row * ID_BYTES:(row + 1) * ID_BYTES])
+
+
+def _parse(line):
+    return [track_id for track_id in line.split() if len(track_id) == ID_BYTES]
+
+
+class CooccurrenceModel:
+    def __init__(self, directory=DATA_DIR):
+        self.directory = directory
+        self.log_path = os.path.join(directory, 'playlists.log')
+        self.matrix_path = os.path.join(directory, 'matrix.bin')
+        self._lock = threading.Lock()
+        self._matrix_inode = None
+        self._rows = 0
+        self._log_offset = 0
+        self._rebuild_process = None
+        self._rebuild_requested = 0.0
+        self._reset_delta()
+
+    def _reset_delta(self):
+        self._delta = {}              # track id -> {neighbour id: count}
+        self._delta_occurrences = {}  # track id -> playlists it appeared in
+        self._delta_pairs = 0
+        self._delta_full = False
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._rebuild_process = None
+
+    # -- loading ---------------------------------------------------------
+
+    def _load_matrix(self):
+        """Map matrix.bin if it was (re)built since we last looked"""
+        try:
+            inode = os.stat(self.matrix_path).st_ino
+        except OSError:
+            inode = None
+        if inode == self._matrix_inode:
+            return
+        self._matrix_inode = inode
+        self._rows, self._log_offset = 0, 0
+        self._reset_delta()
+        if inode is None:
+            return
+        with open(self.matrix_path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, rows, nnz, log_offset = HEADER.unpack_from(mapped, 0)
+        if magic != b'MCOO' or version != VERSION:
+            logger.warning("Ignoring %s: not a version %s co-occurrence matrix", self.matrix_path, VERSION)
+            return
+        view = memoryview(mapped)
+        start = HEADER.size
+        sections = {}
+        for name, length in (('occurrences', rows), ('offsets', rows + 1), ('neighbours', nnz), ('counts', nnz)):
+            sections[name] = view[start:start + 4 * length].cast('I')
+            start += 4 * length
+        self._occurrences = sections['occurrences']
+        self._offsets = sections['offsets']
+        self._neighbours = sections['neighbours']
+        self._counts = sections['counts']
+        self._ids = _Ids(view[start:start + rows * ID_BYTES], rows)
+        self._rows, self._log_offset = rows, log_offset
+        logger.info("Loaded co-occurrence matrix: %s tracks, %s pairs", rows, nnz)
+
+    def _tail_log(self):
+        """Fold playlists appended since the matrix was built into the delta"""
+        try:
+            size = os.stat(self.log_path).st_size
+        except OSError:
+            return
+        if size < self._log_offset:
+            # Log was replaced; start over from the matrix
+            self._matrix_inode = None
+            self._load_matrix()
+        if size <= self._log_offset:
+            return
+        if self._delta_full:
+            self._start_rebuild()
+            return
+        with open(self.log_path, 'rb') as f:
+            f.seek(self._log_offset)
+            chunk = f.read(size - self._log_offset)
+        position, complete = 0, chunk.rfind(b'\n') + 1
+        while position < complete:
+            line_end = chunk.index(b'\n', position) + 1
+            track_ids = _parse(chunk[position:line_end].decode('ascii', 'ignore'))
+            pairs = len(track_ids) * (len(track_ids) - 1)
+            if self._delta_pairs + pairs > MAX_DELTA_PAIRS:
+                # Later playlists wait for the rebuild that folds them into the matrix
+                self._delta_full = True
+                self._start_rebuild()
+                break
+            for track_id in track_ids:
+                self._delta_occurrences[track_id] = self._delta_occurrences.get(track_id, 0) + 1
+            for a, b in itertools.permutations(track_ids, 2):
+                row = self._delta.setdefault(a, {})
+                row[b] = row.get(b, 0) + 1
+            self._delta_pairs += pairs
+            position = line_end
+        self._log_offset += position
+
+    def _rebuilding(self):
+        """Whether our build child is still running; reaps it once it exits"""
+        if self._rebuild_process is None:
+            return False
+        if self._rebuild_process.poll() is None:
+            return True
+        if self._rebuild_process.returncode:
+            logger.warning("Co-occurrence matrix rebuild exited with status %s", self._rebuild_process.returncode)
+        self._rebuild_process = None
+        return False
+
+    def _start_rebuild(self):
+        """Rebuild the matrix in a child process, so the build's memory and CPU stay out of this worker"""
+        if self._rebuilding() or time.time() - self._rebuild_requested < REBUILD_RETRY_INTERVAL:
+            return
+        self._rebuild_requested = time.time()
+        logger.warning("Co-occurrence delta is full (%s pairs); rebuilding the matrix", self._delta_pairs)
+        try:
+            self._rebuild_process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), 'build', '--dir', self.directory,
+                 '--if-older-than', str(self._rebuild_requested)],
+                stdin=subprocess.DEVNULL, start_new_session=True)
+        except OSError as e:
+            logger.warning("Could not start co-occurrence matrix rebuild: %s", e)
+
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        self._rebuilding()
+        self._load_matrix()
+        self._tail_log()
+
+    # -- querying --------------------------------------------------------
+
+    def _row(self, track_id):
+        if not self._rows:
+            return None
+        key = track_id.encode('ascii', 'ignore')[:ID_BYTES].ljust(ID_BYTES, b'\x00')
+        row = bisect_left(self._ids, key)
+        return row if row < self._rows and self._ids[row] == key else None
+
+    def _track_id(self, row):
+        return self._ids[row].rstrip(b'\x00').decode('ascii')
+
+    def occurrences(self, track_id):
+        row = self._row(track_id)
+        base = self._occurrences[row] if row is not None else 0
+        return base + self._delta_occurrences.get(track_id, 0)
+
+    def neighbours(self, track_id):
+        """{neighbour id: [playlists shared with the track, playlists of the neighbour]}"""
+        found = {}
+        row = self._row(track_id)
+        if row is not None:
+            for i in range(self._offsets[row], self._offsets[row + 1]):
+                neighbour_row = self._neighbours[i]
+                neighbour = self._track_id(neighbour_row)
+                found[neighbour] = [self._counts[i],
+                                    self._occurrences[neighbour_row] + self._delta_occurrences.get(neighbour, 0)]
+        for neighbour, count in self._delta.get(track_id, {}).items():
+            if neighbour in found:
+                found[neighbour][0] += count
+            else:
+                found[neighbour] = [count, self.occurrences(neighbour)]
+        return found
+
+    def recommend(self, seed_ids, k, exclude=()):
+        """Top `k` (track id, score) pairs for a set of seed tracks, best first"""
+        seeds = set(seed_ids)
+        skip = seeds | set(exclude)
+        scores = {}
+        with self._lock:
+            self._refresh()
+            for seed in seeds:
+                seed_occurrences = self.occurrences(seed)
+                if not seed_occurrences:
+                    continue
+                for neighbour, (count, occurrences) in self.neighbours(seed).items():
+                    if neighbour not in skip:
+                        similarity = count / math.sqrt(seed_occurrences * max(1, occurrences))
+                        scores[neighbour] = scores.get(neighbour, 0.0) + similarity
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    # -- writing ---------------------------------------------------------
+
+    def record(self, track_ids):
+        """Append one playlist to the log; readers pick it up on their next query"""
+        track_ids = [t for t in dict.fromkeys(track_ids) if len(t) == ID_BYTES][:MAX_PLAYLIST_TRACKS]
+        if len(track_ids) < 2:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        line = (' '.join(track_ids) + '\n').encode('ascii')
+        # O_APPEND keeps concurrent workers' lines whole
+        fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+
+def build(directory=DATA_DIR, min_count=1, max_neighbours=MAX_NEIGHBOURS):
+    """Compact the playlist log into matrix.bin; returns (tracks, pairs)"""
+    log_path = os.path.join(directory, 'playlists.log')
+    matrix_path = os.path.join(directory, 'matrix.bin')
+    occurrences = {}
+    pairs = {}
+    log_offset = 0
+    with open(log_path, 'rb') as f:
+        for raw in f:
+            if not raw.endswith(b'\n'):
+                break  # a playlist still being written
+            log_offset += len(raw)
+            track_ids = sorted(set(_parse(raw.decode('ascii', 'ignore'))))
+            for track_id in track_ids:
+                occurrences[track_id] = occurrences.get(track_id, 0) + 1
+            for pair in itertools.combinations(track_ids, 2):
+                pairs[pair] = pairs.get(pair, 0) + 1
+
+    ids = sorted(occurrences)
+    row_of = {track_id: row for row, track_id in enumerate(ids)}
+    rows = [[] for _ in ids]
+    for (a, b), count in pairs.items():
+        if count >= min_count:
+            rows[row_of[a]].append((count, row_of[b]))
+            rows[row_of[b]].append((count, row_of[a]))
+    del pairs
+
+    offsets, neighbours, counts = [0], [], []
+    for row in rows:
+        for count, neighbour in heapq.nlargest(max_neighbours, row):
+            neighbours.append(neighbour)
+            counts.append(count)
+        offsets.append(len(neighbours))
+
+    tmp_path = f"{matrix_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(b'MCOO', VERSION, len(ids), len(neighbours), log_offset))
+        for values in ([occurrences[track_id] for track_id in ids], offsets, neighbours, counts):
+            f.write(struct.pack(f'<{len(values)}I', *values))
+        f.write(b''.join(track_id.encode('ascii') for track_id in ids))
+    os.replace(tmp_path, matrix_path)
+    return len(ids), len(neighbours)
+
+
+MODEL = CooccurrenceModel(DATA_DIR)
+
+
+def record_playlist(track_ids):
+    """Log a generated playlist for the recommender; never raises"""
+    if not ENABLED:
+        return
+    try:
+        MODEL.record(track_ids)
+    except OSError as e:
+        logger.warning("Could not record playlist for recommendations: %s", e)
+
+
+def recommend_tracks(seed_ids, limit, exclude=(), sp=None):
+    """
+    Up to `limit` Spotify-shaped tracks that co-occur with the seeds, best
+    first. Metadata comes from the shared track store; tracks it does not
+    know are fetched in one batch with `sp`, or skipped without a client.
+    """
+    if not ENABLED or not seed_ids or limit <= 0:
+        return []
+    try:
+        ranked = MODEL.recommend(seed_ids, limit, exclude)
+    except (OSError, ValueError, struct.error) as e:
+        logger.warning("Local recommendations failed: %s", e)
+        return []
+
+    store = track_store.get_store()
+    found = {}
+    missing = []
+    for track_id, _ in ranked:
+        track = store.get(track_id) if store is not None else None
+        if track is not None:
+            found[track_id] = track
+        else:
+            missing.append(track_id)
+    if missing and sp is not None:
+        try:
+            with metrics.upstream('spotify_tracks'):
+                fetched = sp.tracks(missing[:50])
+            for track in fetched.get('tracks') or []:
+                if track:
+                    found[track['id']] = track
+                    track_store.remember(track)
+        except Exception as e:
+            logger.warning("Could not fetch metadata for %s recommended tracks: %s", len(missing), e)
+
+    tracks = [found[track_id] for track_id, _ in ranked if track_id in found]
+    metrics.cache_lookup('local_recommendations', bool(tracks))
+    return tracks
+
+
+def _after_fork():
+    MODEL.after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the local co-occurrence recommender')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Compact the playlist log into matrix.bin')
+    build_parser.add_argument('--dir', default=DATA_DIR, help='Recommender data directory')
+    build_parser.add_argument('--min-count', type=int, default=1,
+                              help='Drop pairs that shared fewer playlists than this')
+    build_parser.add_argument('--neighbours', type=int, default=MAX_NEIGHBOURS,
+                              help='Neighbours kept per track')
+    build_parser.add_argument('--if-older-than', type=float, metavar='EPOCH',
+                              help='Skip the build if matrix.bin was written at or after this time')
+    query_parser = subparsers.add_parser('query', help='Print recommendations for seed track ids')
+    query_parser.add_argument('seeds', nargs='+', help='Spotify track ids')
+    query_parser.add_argument('--dir', default=DATA_DIR, help='Recommender data directory')
+    query_parser.add_argument('-k', type=int, default=20, help='Recommendations to print')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.command == 'build':
+        matrix_path = os.path.join(args.dir, 'matrix.bin')
+        with open(os.path.join(args.dir, 'build.lock'), 'a') as lock:
+            # One build at a time, whether a worker or cron started it
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print("Another build is running")
+                return 0
+            try:
+                if args.if_older_than and os.stat(matrix_path).st_mtime >= args.if_older_than:
+                    print("matrix.bin is already up to date")
+                    return 0
+            except FileNotFoundError:
+                pass
+            started = time.perf_counter()
+            tracks, pairs = build(args.dir, args.min_count, args.neighbours)
+        size = os.path.getsize(matrix_path)
+        print(f"Built co-occurrence matrix in {time.perf_counter() - started:.1f}s: "
+              f"{tracks} tracks, {pairs} neighbour entries, {size / 1e6:.1f} MB")
+    else:
+        model = CooccurrenceModel(args.dir)
+        for track_id, score in model.recommend(args.seeds, args.k):
+            print(f"{track_id}  {score:.3f}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import math
+import logging
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Share of suggestions assumed to resolve before a prompt class has history
+PRIOR_HIT_RATE = float(os.getenv('MOOSIC_PRIOR_HIT_RATE', '0.8'))
+# Weight of the newest round in the moving average
+SMOOTHING = 0.2
+# z-score of the confidence that one round fills the target (1.28 ~ 90%)
+CONFIDENCE_Z = float(os.getenv('MOOSIC_OVERGENERATION_Z', '1.28'))
+MAX_FACTOR = 2.0
+# Fuzzy ratio above which a search result's artist counts as the suggested one
+ARTIST_MATCH_RATIO = 70
+
+_NON_WORD = re.compile(r'[^\w\s]')
+
+
+class HitRates:
+    """
+    Moving average of the fraction of LLM suggestions that resolve to a
+    Spotify track, per prompt class (objective, similar, genre, mood, other).
+    """
+
+    def __init__(self, prior=PRIOR_HIT_RATE, smoothing=SMOOTHING):
+        self.prior = prior
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self._rates = {}
+
+    def rate(self, prompt_class):
+        return self._rates.get(prompt_class, self.prior)
+
+    def record(self, prompt_class, attempted, resolved):
+        """Fold one round of `attempted` suggestions, `resolved` of which were found, into the average"""
+        if attempted <= 0:
+            return
+        metrics.suggestions(prompt_class, resolved, attempted - resolved)
+        observed = resolved / attempted
+        with self._lock:
+            previous = self._rates.get(prompt_class)
+            if previous is None:
+                # Blend the first round with the prior so one bad round does not dominate
+                previous = self.prior
+            self._rates[prompt_class] = previous + self.smoothing * (observed - previous)
+        logger.debug("Hit rate for %s: %s/%s this round, %.2f average",
+                     prompt_class, resolved, attempted, self._rates[prompt_class])
+
+    def suggestion_count(self, target, prompt_class):
+        """
+        Suggestions to ask for so that, at the class's hit rate, at least
+        `target` resolve with ~90% confidence (binomial lower bound).
+        """
+        if target <= 0:
+            return 0
+        p = min(0.99, max(0.05, self.rate(prompt_class)))
+        limit = int(math.ceil(target * MAX_FACTOR))
+        n = target
+        while n < limit and n * p - CONFIDENCE_Z * math.sqrt(n * p * (1 - p)) < target:
+            n += 1
+        return n
+
+
+HIT_RATES = HitRates()
+
+
+def suggestion_count(target, prompt_class):
+    return HIT_RATES.suggestion_count(target, prompt_class)
+
+
+def record(prompt_class, attempted, resolved):
+    HIT_RATES.record(prompt_class, attempted, resolved)
+
+
+def search_terms(song):
+    """
+    (track, artist) with punctuation stripped for searching, from a "Song
+    Name by Artist Name" suggestion; None when it names no artist
+    """
+    track_name, by, artist_name = song.rpartition(' by ')
+    if not by:
+        return None
+    return _NON_WORD.sub('', track_name).strip(), _NON_WORD.sub('', artist_name).strip()
+
+
+def best_artist_match(items, artist_name):
+    """The first search result by the suggested artist (contained or fuzzy match), else the first result"""
+    from fuzzywuzzy import fuzz
+    artist_name = artist_name.lower()
+    for item in items:
+        track_artist = item['artists'][0]['name'].lower()
+        if (track_artist in artist_name or artist_name in track_artist
+                or fuzz.ratio(track_artist, artist_name) > ARTIST_MATCH_RATIO):
+            return item
+    return items[0] if items else None
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+import os
+import gzip
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from flask import jsonify, request
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is always available
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL = float(os.getenv('MOOSIC_HTTP_CACHE_TTL', '60'))
+CACHE_MAX_ENTRIES = int(os.getenv('MOOSIC_HTTP_CACHE_ENTRIES', '2048'))
+# Bodies smaller than this are sent as is - compressing them costs more than it saves
+MIN_COMPRESS_BYTES = int(os.getenv('MOOSIC_MIN_COMPRESS_BYTES', '512'))
+
+# Spotify serves album art at 640, 300 and 64 px
+IMAGE_SIZES = {'small': 64, 'medium': 300, 'large': 640}
+DEFAULT_IMAGE_SIZE = 'medium'
+
+
+class ResponseCache:
+    """
+    Short-lived per-user cache of JSON payloads. Each entry keeps the ETag and
+    the time its content last changed, so a refresh that returns the same data
+    still answers conditional requests with 304.
+    """
+
+    def __init__(self, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Return the entry for `key` if it is still fresh, else None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['expires'] < time.time():
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, payload):
+        body = json.dumps(payload, sort_keys=True, separators=(',', ':')).encode()
+        etag = hashlib.sha1(body).hexdigest()
+        now = time.time()
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            last_modified = previous['last_modified'] if previous and previous['etag'] == etag else int(now)
+            entry = self._entries[key] = {
+                'payload': payload,
+                'etag': etag,
+                'last_modified': last_modified,
+                'expires': now + self.ttl,
+            }
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return entry
+
+    def invalidate(self, user_id, name=None):
+        """Drop every entry of one user (e.g. on logout), or only those of one payload"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id and name in (None, key[1])]:
+                del self._entries[key]
+
+
+CACHE = ResponseCache()
+
+
+def cached_json(name, user_id, build, variant=None):
+    """
+    Serve build()'s JSON payload from the per-user cache with ETag,
+    Last-Modified and Cache-Control headers, answering 304 when the client's
+    copy is current. build() is only called on a cache miss.
+    """
+    key = (user_id, name, variant)
+    entry = CACHE.get(key)
+    metrics.cache_lookup(name, entry is not None)
+    if entry is None:
+        entry = CACHE.put(key, build())
+
+    response = jsonify(entry['payload'])
+    response.set_etag(entry['etag'], weak=True)
+    response.last_modified = datetime.fromtimestamp(entry['last_modified'], tz=timezone.utc)
+    response.headers['Cache-Control'] = f"private, max-age={int(CACHE.ttl)}"
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+
+def image_size():
+    """The album art size the client asked for with ?imageSize= (small, medium, large or pixels)"""
+    value = request.args.get('imageSize')
+    if value is None and request.is_json:
+        value = (request.get_json(silent=True) or {}).get('imageSize')
+    value = str(value or DEFAULT_IMAGE_SIZE).lower()
+    if value.isdigit():
+        return int(value)
+    return IMAGE_SIZES.get(value, IMAGE_SIZES[DEFAULT_IMAGE_SIZE])
+
+
+def pick_image(images, size):
+    """URL of the smallest image at least `size` px wide, else the largest one"""
+    if not images:
+        return None
+    by_width = sorted(images, key=lambda image: image.get('width') or 0)
+    for image in by_width:
+        if (image.get('width') or 0) >= size:
+            return image['url']
+    return by_width[-1]['url']
+
+
+def track_summary(track, size):
+    """
+    {'name', 'artist', 'album_image'} as the client shows a track, from a
+    Spotify track or a compact one (track_pools.compact_track)
+    """
+    if 'artist' in track:
+        return {'name': track['name'], 'artist': track['artist'], 'album_image': pick_image(track['images'], size)}
+    return {
+        'name': track['name'],
+        'artist': track['artists'][0]['name'],
+        'album_image': pick_image(track['album']['images'], size),
+    }
+
+
+def _accepted_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(response):
+    """Compress JSON bodies with brotli or gzip when the client accepts it"""
+    if (response.direct_passthrough or response.status_code < 200 or response.status_code in (204, 304)
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = _accepted_encoding()
+    body = response.get_data()
+    if encoding is None or len(body) < MIN_COMPRESS_BYTES:
+        return response
+
+    if encoding == 'br':
+        compressed = brotli.compress(body, quality=5)
+    else:
+        compressed = gzip.compress(body, compresslevel=6)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
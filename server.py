@@ -3,21 +3,42 @@
 import os
 import json
 import time
-from flask import Flask, request, jsonify, redirect, session
-from flask_cors import CORS
-from flask_session import Session
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
-import openai
+import logging
+from flask import Flask, Blueprint, current_app, request, jsonify, redirect, session, send_from_directory
 from dotenv import load_dotenv
 import requests
 import secrets
+import hashlib
 import urllib.parse
 import re
-from fuzzywuzzy import fuzz
+import metrics
+import log_config
+import profiling
+import admission
+import responses
+import intent
+import track_pools
+import llm
+import prompts
+import resolution
+import track_store
+import recommender
+import generation_state
+import snapshots
+import charts
+import analytics
+import batch
+import checkpoints
+import taste
+import hedging
+import suggestion_backends
+import genre_seeds
+import candidate_filter
+
+# openai, spotipy and fuzzywuzzy are imported lazily on first use so workers
+# start fast; warm_imports() loads them up front in a gunicorn --preload master.
 
-# Load environment variables
-load_dotenv()
+logger = logging.getLogger(__name__)
 
 # Required environment variables
 required_env_vars = [
@@ -29,69 +50,120 @@ required_env_vars = [
     'BACKEND_URL'
 ]
 
-# Check for required environment variables
-missing_vars = [var for var in required_env_vars if not os.getenv(var)]
-if missing_vars:
-    raise EnvironmentError(f"Missing required environment variables: {', '.join(missing_vars)}")
-
-# Configure environment variables
-os.environ['SPOTIFY_REDIRECT_URI'] = os.getenv('SPOTIFY_REDIRECT_URI')
-os.environ['SPOTIFY_CLIENT_ID'] = os.getenv('SPOTIFY_CLIENT_ID')
-os.environ['SPOTIFY_CLIENT_SECRET'] = os.getenv('SPOTIFY_CLIENT_SECRET')
-os.environ['FRONTEND_URL'] = os.getenv('FRONTEND_URL')
-os.environ['BACKEND_URL'] = os.getenv('BACKEND_URL')
-os.environ['PORT'] = '3001'  # Force port 3001
-os.environ['HOST'] = os.getenv('HOST', '0.0.0.0')
-
 # SSL certificate paths
 ssl_context = (
     '/opt/moosic/ssl/fullchain.pem',  # Certificate path
     '/opt/moosic/ssl/privkey.pem'     # Private key path
 )
 
-app = Flask(__name__)
-app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'some_random_key')
+# Upstream base URLs - overridable so benchmarks can point at local stand-ins.
+# Set by create_app() once the environment has been loaded.
+SPOTIFY_ACCOUNTS_URL = 'https://accounts.spotify.com'
+SPOTIFY_API_URL = 'https://api.spotify.com/v1/'
 
-# Configure logging
-import logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Sent as the recommendations min_popularity and applied to what comes back
+RECOMMENDATION_MIN_POPULARITY = 40
+
+api = Blueprint('api', __name__)
+
+def create_app():
+    """Validate the environment and build the Flask application"""
+    global SPOTIFY_ACCOUNTS_URL, SPOTIFY_API_URL
+
+    # Load environment variables
+    load_dotenv()
+
+    # Check for required environment variables
+    missing_vars = [var for var in required_env_vars if not os.getenv(var)]
+    if missing_vars:
+        raise EnvironmentError(f"Missing required environment variables: {', '.join(missing_vars)}")
+
+    # Configure environment variables
+    os.environ['PORT'] = '3001'  # Force port 3001
+    os.environ['HOST'] = os.getenv('HOST', '0.0.0.0')
+
+    SPOTIFY_ACCOUNTS_URL = os.getenv('SPOTIFY_ACCOUNTS_URL', 'https://accounts.spotify.com').rstrip('/')
+    SPOTIFY_API_URL = os.getenv('SPOTIFY_API_URL', 'https://api.spotify.com/v1').rstrip('/') + '/'
+
+    # Configure logging
+    log_config.setup_logging()
+
+    # Genre/era fallback pools, refreshed in the background once a worker uses them
+    track_pools.configure(SPOTIFY_ACCOUNTS_URL, SPOTIFY_API_URL)
+
+    app = Flask(__name__)
+    app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'some_random_key')
+
+    # Configure session
+    app.config['SESSION_TYPE'] = 'filesystem'
+    app.config['SESSION_COOKIE_SECURE'] = True
+    app.config['SESSION_COOKIE_HTTPONLY'] = True
+    app.config['SESSION_COOKIE_SAMESITE'] = 'None'  # Must be 'None' for cross-site requests
+    app.config['SESSION_COOKIE_DOMAIN'] = None
+    app.config['PERMANENT_SESSION_LIFETIME'] = 86400  # 24 hours
+    app.config['SESSION_COOKIE_PATH'] = '/'
+    app.config['SESSION_COOKIE_NAME'] = 'moosic_session'
+    app.config['SESSION_REFRESH_EACH_REQUEST'] = True
+    app.config['SESSION_FILE_DIR'] = '/tmp/flask_session'
+    app.config['SESSION_USE_SIGNER'] = True
+    app.config['SESSION_PERMANENT'] = True  # Make all sessions permanent by default
+    app.config['PREFERRED_URL_SCHEME'] = 'https'
+
+    # Initialize Flask-Session
+    from flask_session import Session
+    Session(app)
+
+    # Configure CORS
+    from flask_cors import CORS
+    CORS(app, 
+         origins="*", 
+         supports_credentials=True,
+         allow_headers=["Content-Type", "Authorization", "Accept"],
+         methods=["GET", "POST", "OPTIONS"],
+         expose_headers=["Content-Type", "Authorization", "Set-Cookie", "X-Request-ID"]
+    )
+
+    app.register_blueprint(api)
+    return app
+
+_app = None
+
+def get_app():
+    """Return the process-wide application, creating it on first use"""
+    global _app
+    if _app is None:
+        _app = create_app()
+    return _app
+
+def __getattr__(name):
+    # Keeps `gunicorn server:app` and `from server import app` working while
+    # importing this module stays free of side effects
+    if name == 'app':
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def warm_imports():
+    """Import the heavy client libraries now, e.g. in a preloading gunicorn master"""
+    llm.get_openai()
+    import spotipy  # noqa: F401
+    from fuzzywuzzy import fuzz  # noqa: F401
 
-# Configure session
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['SESSION_COOKIE_SECURE'] = True
-app.config['SESSION_COOKIE_HTTPONLY'] = True
-app.config['SESSION_COOKIE_SAMESITE'] = 'None'  # Must be 'None' for cross-site requests
-app.config['SESSION_COOKIE_DOMAIN'] = None
-app.config['PERMANENT_SESSION_LIFETIME'] = 86400  # 24 hours
-app.config['SESSION_COOKIE_PATH'] = '/'
-app.config['SESSION_COOKIE_NAME'] = 'moosic_session'
-app.config['SESSION_REFRESH_EACH_REQUEST'] = True
-app.config['SESSION_FILE_DIR'] = '/tmp/flask_session'
-app.config['SESSION_USE_SIGNER'] = True
-app.config['SESSION_PERMANENT'] = True  # Make all sessions permanent by default
+@api.before_app_request
+def bind_request_context():
+    # Tie all log lines of one request together and decide log sampling once
+    request_id = request.headers.get('X-Request-ID') or secrets.token_hex(8)
+    # Categories are bare view names ('check_auth'), without the blueprint prefix
+    log_config.start_request(request_id, (request.endpoint or '').rpartition('.')[2])
 
 # Make sessions permanent by default
-@app.before_request
+@api.before_app_request
 def setup_session():
     session.permanent = True
     # Force the session to be saved immediately
     if request.path.startswith('/api/callback'):
         logger.info("Callback route detected, ensuring session persistence")
 
-# Initialize Flask-Session
-Session(app)
-
-# Configure CORS
-CORS(app, 
-     origins="*", 
-     supports_credentials=True,
-     allow_headers=["Content-Type", "Authorization", "Accept"],
-     methods=["GET", "POST", "OPTIONS"],
-     expose_headers=["Content-Type", "Authorization", "Set-Cookie"]
-)
-
-@app.after_request
+@api.after_app_request
 def after_request(response):
     origin = request.headers.get('Origin', '')
     # Apply CORS headers to all origins during debugging
@@ -101,34 +173,26 @@ def after_request(response):
     response.headers.add('Access-Control-Allow-Credentials', 'true')
     response.headers.add('Access-Control-Expose-Headers', 'Set-Cookie')
     response.headers.add('Access-Control-Max-Age', '3600')
+    response.headers['X-Request-ID'] = log_config.request_id_var.get()
     
     # Log response cookies for debugging
-    if 'Set-Cookie' in response.headers:
-        logger.info(f"Setting cookies in response: {response.headers.getlist('Set-Cookie')}")
+    if 'Set-Cookie' in response.headers and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Setting cookies in response: %s", response.headers.getlist('Set-Cookie'))
     
     # Set additional headers for SameSite=None to work properly
-    if app.config['SESSION_COOKIE_SAMESITE'] == 'None' and app.config['SESSION_COOKIE_NAME'] in request.cookies:
-        cookie = f"{app.config['SESSION_COOKIE_NAME']}={request.cookies[app.config['SESSION_COOKIE_NAME']]}; Path=/; SameSite=None; Secure; HttpOnly"
+    config = current_app.config
+    if config['SESSION_COOKIE_SAMESITE'] == 'None' and config['SESSION_COOKIE_NAME'] in request.cookies:
+        cookie = f"{config['SESSION_COOKIE_NAME']}={request.cookies[config['SESSION_COOKIE_NAME']]}; Path=/; SameSite=None; Secure; HttpOnly"
         response.headers.add('Set-Cookie', cookie)
         
-    return response
-
-# Configure for environment
-is_production = os.getenv('ENVIRONMENT') == 'production'
-app.config['PREFERRED_URL_SCHEME'] = 'https'
-
-# Initialize Spotify OAuth with state parameter
-sp_oauth = SpotifyOAuth(
-    client_id=os.getenv('SPOTIFY_CLIENT_ID'),
-    client_secret=os.getenv('SPOTIFY_CLIENT_SECRET'),
-    redirect_uri=os.getenv('SPOTIFY_REDIRECT_URI'),
-    scope='playlist-modify-public playlist-modify-private user-read-private user-read-email user-top-read',
-    state='moosic_state',  # Add state parameter for security
-    show_dialog=True  # Force user to approve the app each time
-)
+    return responses.compress(response)
 
-# Configure OpenAI API key
-openai.api_key = os.getenv('OPENAI_API_KEY')
+def spotify_client(access_token):
+    """Create a spotipy client for an access token"""
+    import spotipy
+    sp = spotipy.Spotify(auth=access_token)
+    sp.prefix = SPOTIFY_API_URL
+    return sp
 
 def get_spotify_client():
     """Get a Spotify client with a valid token"""
@@ -136,7 +200,7 @@ def get_spotify_client():
     
     if not token_info:
         logger.error('No token found in session')
-        logger.info(f"Available session keys: {list(session.keys())}")
+        logger.info("Available session keys: %s", list(session.keys()))
         raise Exception('No token found in session')
     
     # Check if token is expired
@@ -148,22 +212,23 @@ def get_spotify_client():
             logger.info('Token expired, refreshing...')
             # Directly use requests instead of spotipy for token refresh
             refresh_token = token_info['refresh_token']
-            token_url = 'https://accounts.spotify.com/api/token'
-            response = requests.post(
-                token_url,
-                data={
-                    'grant_type': 'refresh_token',
-                    'refresh_token': refresh_token,
-                    'client_id': os.environ['SPOTIFY_CLIENT_ID'],
-                    'client_secret': os.environ['SPOTIFY_CLIENT_SECRET']
-                },
-                headers={
-                    'Content-Type': 'application/x-www-form-urlencoded'
-                }
-            )
+            token_url = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
+            with metrics.upstream('spotify_token_refresh'):
+                response = requests.post(
+                    token_url,
+                    data={
+                        'grant_type': 'refresh_token',
+                        'refresh_token': refresh_token,
+                        'client_id': os.environ['SPOTIFY_CLIENT_ID'],
+                        'client_secret': os.environ['SPOTIFY_CLIENT_SECRET']
+                    },
+                    headers={
+                        'Content-Type': 'application/x-www-form-urlencoded'
+                    }
+                )
             
             if response.status_code != 200:
-                logger.error(f"Error refreshing token: {response.status_code} - {response.text}")
+                logger.error("Error refreshing token: %s - %s", response.status_code, response.text)
                 raise Exception('Failed to refresh token')
                 
             new_token_info = response.json()
@@ -176,12 +241,12 @@ def get_spotify_client():
             session.modified = True
             logger.info('Token refreshed successfully')
         except Exception as e:
-            logger.error(f"Error refreshing token: {str(e)}")
+            logger.error("Error refreshing token: %s", str(e))
             raise Exception('Failed to refresh token')
     
-    return spotipy.Spotify(auth=token_info['access_token'])
+    return spotify_client(token_info['access_token'])
 
-@app.route('/api/login')
+@api.route('/api/login')
 def login():
     try:
         # Get PKCE parameters from request
@@ -198,7 +263,7 @@ def login():
         session.modified = True  # Force session to be saved
         
         # Manually construct authorization URL with PKCE parameters
-        auth_url = "https://accounts.spotify.com/authorize"
+        auth_url = f"{SPOTIFY_ACCOUNTS_URL}/authorize"
         params = {
             'client_id': os.getenv('SPOTIFY_CLIENT_ID'),
             'response_type': 'code',
@@ -211,50 +276,50 @@ def login():
         }
         
         auth_url = f"{auth_url}?{urllib.parse.urlencode(params)}"
-        logger.info(f"Generated authorization URL: {auth_url[:100]}...")
+        logger.info("Generated authorization URL: %s...", auth_url[:100])
         
         return redirect(auth_url)
     except Exception as e:
-        logger.error(f"Error in login route: {str(e)}")
+        logger.error("Error in login route: %s", str(e))
         return redirect(f"{os.environ['FRONTEND_URL']}/auth?auth=error&message=Failed%20to%20initialize%20login")
 
-@app.route('/api/callback', methods=['GET', 'POST'])
+@api.route('/api/callback', methods=['GET', 'POST'])
 def callback():
     try:
         if request.method == 'POST':
             # Log the content type and body for debugging
-            logger.info(f"Received POST request with Content-Type: {request.headers.get('Content-Type')}")
-            logger.info(f"Request body format: {type(request.data)}")
+            logger.info("Received POST request with Content-Type: %s", request.headers.get('Content-Type'))
+            logger.info("Request body format: %s", type(request.data))
             
             # Handle different content types
             if request.is_json:
                 data = request.json
-                logger.info(f"Parsed JSON data: {data.keys() if data else 'None'}")
+                logger.info("Parsed JSON data: %s", data.keys() if data else 'None')
             else:
                 # Try to parse JSON from raw data
                 try:
                     data = json.loads(request.data.decode('utf-8'))
-                    logger.info(f"Manually parsed JSON data: {data.keys() if data else 'None'}")
+                    logger.info("Manually parsed JSON data: %s", data.keys() if data else 'None')
                 except Exception as e:
-                    logger.error(f"Failed to parse request body: {e}")
+                    logger.error("Failed to parse request body: %s", e)
                     data = {}
             
             code = data.get('code')
             state = data.get('state')
             code_verifier = data.get('code_verifier')
             
-            logger.info(f"POST params: code={code[:10] if code else None}..., state={state}, verifier={code_verifier[:10] if code_verifier else None}...")
+            logger.info("POST params: code=%s..., state=%s, verifier=%s...", code[:10] if code else None, state, code_verifier[:10] if code_verifier else None)
         else:
             # For GET requests (initial Spotify redirect), just redirect to frontend
             code = request.args.get('code')
             state = request.args.get('state')
-            logger.info(f"GET params: code={code[:10] if code else None}..., state={state}")
+            logger.info("GET params: code=%s..., state=%s", code[:10] if code else None, state)
             return redirect(f"{os.environ['FRONTEND_URL']}/auth?code={code}&state={state}")
         
         error = request.args.get('error')
         
         if error:
-            logger.error(f"Spotify auth error: {error}")
+            logger.error("Spotify auth error: %s", error)
             if request.method == 'POST':
                 return jsonify({"status": "error", "message": error}), 400
             return redirect(f"{os.environ['FRONTEND_URL']}/auth?auth=error&message={error}")
@@ -270,10 +335,10 @@ def callback():
             return jsonify({"status": "error", "message": "No code verifier received"}), 400
 
         # Log the received code and state for debugging
-        logger.info(f"Received code: {code[:10] if code else 'None'}...")
-        logger.info(f"Received state: {state}")
+        logger.info("Received code: %s...", code[:10] if code else 'None')
+        logger.info("Received state: %s", state)
         if code_verifier:
-            logger.info(f"Received code_verifier: {code_verifier[:10]}...")
+            logger.info("Received code_verifier: %s...", code_verifier[:10])
 
         # Clear any existing session first to prevent conflicts
         session.clear()
@@ -282,7 +347,7 @@ def callback():
         try:
             # Manual token exchange using requests since SpotifyOAuth doesn't support PKCE
             logger.info("Performing manual token exchange with PKCE")
-            token_url = 'https://accounts.spotify.com/api/token'
+            token_url = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
             payload = {
                 'grant_type': 'authorization_code',
                 'code': code,
@@ -291,13 +356,14 @@ def callback():
                 'code_verifier': code_verifier
             }
             
-            response = requests.post(
-                token_url,
-                data=payload,
-                headers={
-                    'Content-Type': 'application/x-www-form-urlencoded'
-                }
-            )
+            with metrics.upstream('spotify_token_exchange'):
+                response = requests.post(
+                    token_url,
+                    data=payload,
+                    headers={
+                        'Content-Type': 'application/x-www-form-urlencoded'
+                    }
+                )
             
             if response.status_code != 200:
                 error_msg = f"Token exchange failed: {response.status_code} - {response.text}"
@@ -309,7 +375,7 @@ def callback():
             token_info = response.json()
             logger.info("Successfully obtained token info")
         except Exception as e:
-            logger.error(f"Error getting access token: {str(e)}")
+            logger.error("Error getting access token: %s", str(e))
             if request.method == 'POST':
                 return jsonify({"status": "error", "message": f"Failed to get access token: {str(e)}"}), 400
             return redirect(f"{os.environ['FRONTEND_URL']}/auth?auth=error&message=Failed%20to%20get%20access%20token")
@@ -329,11 +395,12 @@ def callback():
         
         # Get user info using spotipy
         try:
-            sp = spotipy.Spotify(auth=token_info['access_token'])
-            user_info = sp.current_user()
-            logger.info(f"Successfully obtained user info for user: {user_info.get('id')}")
+            sp = spotify_client(token_info['access_token'])
+            with metrics.upstream('spotify_current_user'):
+                user_info = sp.current_user()
+            logger.info("Successfully obtained user info for user: %s", user_info.get('id'))
         except Exception as e:
-            logger.error(f"Error getting user info: {str(e)}")
+            logger.error("Error getting user info: %s", str(e))
             if request.method == 'POST':
                 return jsonify({"status": "error", "message": f"Failed to get user info: {str(e)}"}), 400
             return redirect(f"{os.environ['FRONTEND_URL']}/auth?auth=error&message=Failed%20to%20get%20user%20info")
@@ -358,13 +425,13 @@ def callback():
         session.modified = True
         
         # Log successful authentication
-        logger.info(f"User {user_info.get('id')} authenticated successfully")
-        logger.info(f"Session keys after auth: {list(session.keys())}")
+        logger.info("User %s authenticated successfully", user_info.get('id'))
+        logger.info("Session keys after auth: %s", list(session.keys()))
         
         # Set a specific cookie to help with session persistence
         response = jsonify({"status": "success", "user": session['user']}) if request.method == 'POST' else redirect(f"{os.environ['FRONTEND_URL']}/auth?auth=success")
         response.set_cookie(
-            app.config['SESSION_COOKIE_NAME'],
+            current_app.config['SESSION_COOKIE_NAME'],
             session.sid if hasattr(session, 'sid') else 'session-active',
             max_age=86400,  # 24 hours
             secure=True,
@@ -375,20 +442,16 @@ def callback():
         
         return response
     except Exception as e:
-        logger.error(f"Unexpected error in callback: {str(e)}")
+        logger.error("Unexpected error in callback: %s", str(e))
         if request.method == 'POST':
             return jsonify({"status": "error", "message": str(e)}), 500
         return redirect(f"{os.environ['FRONTEND_URL']}/auth?auth=error&message=An%20error%20occurred%20during%20authentication")
 
-@app.route('/api/check-auth')
+@api.route('/api/check-auth')
 def check_auth():
     try:
-        logger.info(f"Checking auth, session keys: {list(session.keys())}")
-        logger.info(f"Session cookie name: {app.config['SESSION_COOKIE_NAME']}")
-        logger.info(f"Session ID: {session.sid if hasattr(session, 'sid') else 'No session ID'}")
-        logger.info(f"Request cookies: {request.cookies}")
-        logger.info(f"Request origin: {request.headers.get('Origin', 'No origin')}")
-        logger.info(f"Request headers: {dict(request.headers)}")
+        logger.info("Checking auth, session keys: %s", session.keys())
+        logger.debug("Request origin: %s", request.headers.get('Origin', 'No origin'))
         
         # First, check if we have the authenticated flag and user data
         if 'authenticated' in session and 'user' in session and 'token_info' in session:
@@ -399,19 +462,20 @@ def check_auth():
                 logger.info("Token is expired, attempting to refresh")
                 try:
                     # Refresh the token
-                    token_url = 'https://accounts.spotify.com/api/token'
-                    response = requests.post(
-                        token_url,
-                        data={
-                            'grant_type': 'refresh_token',
-                            'refresh_token': session['token_info']['refresh_token'],
-                            'client_id': os.environ['SPOTIFY_CLIENT_ID'],
-                            'client_secret': os.environ['SPOTIFY_CLIENT_SECRET']
-                        },
-                        headers={
-                            'Content-Type': 'application/x-www-form-urlencoded'
-                        }
-                    )
+                    token_url = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
+                    with metrics.upstream('spotify_token_refresh'):
+                        response = requests.post(
+                            token_url,
+                            data={
+                                'grant_type': 'refresh_token',
+                                'refresh_token': session['token_info']['refresh_token'],
+                                'client_id': os.environ['SPOTIFY_CLIENT_ID'],
+                                'client_secret': os.environ['SPOTIFY_CLIENT_SECRET']
+                            },
+                            headers={
+                                'Content-Type': 'application/x-www-form-urlencoded'
+                            }
+                        )
                     
                     if response.status_code == 200:
                         token_data = response.json()
@@ -426,7 +490,7 @@ def check_auth():
                         # Update session cookie 
                         resp = jsonify({"authenticated": True, "user": session['user']})
                         resp.set_cookie(
-                            app.config['SESSION_COOKIE_NAME'],
+                            current_app.config['SESSION_COOKIE_NAME'],
                             session.sid if hasattr(session, 'sid') else 'session-active',
                             max_age=86400,  # 24 hours
                             secure=True,
@@ -436,12 +500,12 @@ def check_auth():
                         )
                         return resp
                     else:
-                        logger.error(f"Error refreshing token: {response.status_code} - {response.text}")
+                        logger.error("Error refreshing token: %s - %s", response.status_code, response.text)
                         # If refresh fails, session is invalid
                         session.clear()
                         return jsonify({"authenticated": False, "reason": "Token refresh failed"})
                 except Exception as e:
-                    logger.error(f"Exception during token refresh: {str(e)}")
+                    logger.error("Exception during token refresh: %s", str(e))
                     # If refresh fails, session is invalid
                     session.clear()
                     return jsonify({"authenticated": False, "reason": "Token refresh failed"})
@@ -449,7 +513,7 @@ def check_auth():
             # Update session cookie 
             resp = jsonify({"authenticated": True, "user": session['user']})
             resp.set_cookie(
-                app.config['SESSION_COOKIE_NAME'],
+                current_app.config['SESSION_COOKIE_NAME'],
                 session.sid if hasattr(session, 'sid') else 'session-active',
                 max_age=86400,  # 24 hours
                 secure=True,
@@ -459,16 +523,17 @@ def check_auth():
             )
             return resp
         else:
-            logger.warning(f"No valid session found. Session keys: {list(session.keys())}")
+            logger.info("No valid session found. Session keys: %s", session.keys())
             return jsonify({"authenticated": False, "reason": "No session"})
     except Exception as e:
-        logger.error(f"Error checking authentication: {str(e)}")
+        logger.error("Error checking authentication: %s", str(e))
         return jsonify({"authenticated": False, "reason": str(e)})
 
-@app.route('/api/logout')
+@api.route('/api/logout')
 def logout():
     try:
-        logger.info(f"Logging out user. Session keys before logout: {list(session.keys())}")
+        logger.info("Logging out user. Session keys before logout: %s", list(session.keys()))
+        responses.CACHE.invalidate(session_cache_key())
         # Clear session data
         session.clear()
         session.modified = True
@@ -480,128 +545,160 @@ def logout():
         })
         
         # Explicitly expire the session cookie
-        response.set_cookie(app.config['SESSION_COOKIE_NAME'], '', expires=0, 
+        response.set_cookie(current_app.config['SESSION_COOKIE_NAME'], '', expires=0, 
                            secure=True, httponly=True, samesite='None', path='/')
         
         return response
     except Exception as e:
-        logger.error(f"Error during logout: {str(e)}")
+        logger.error("Error during logout: %s", str(e))
         return jsonify({
             "success": False,
             "message": f"Error during logout: {str(e)}"
         }), 500
 
-@app.route('/api/me')
+def session_cache_key():
+    """Per-user key for the response cache: the Spotify user id, else a token hash"""
+    user = session.get('user') or {}
+    if user.get('id'):
+        return user['id']
+    token = (session.get('token_info') or {}).get('access_token', '')
+    return hashlib.sha1(token.encode()).hexdigest()
+
+@api.route('/api/me')
 def get_me():
     try:
         sp = get_spotify_client()
-        user = retry_with_backoff(lambda: sp.current_user())
-        return jsonify(user)
+        return responses.cached_json(
+            'me', session_cache_key(),
+            lambda: retry_with_backoff(lambda: sp.current_user(), call='spotify_current_user')
+        )
     except Exception as e:
-        logger.error(f'Error getting user profile: {e}')
+        logger.error('Error getting user profile: %s', e)
         return jsonify({'error': 'Failed to get user profile', 'details': str(e)}), 500
 
-@app.route('/api/create-playlist', methods=['POST'])
+@api.route('/api/create-playlist', methods=['POST'])
+@analytics.recorded
+@admission.admitted
+@profiling.profiled
 def create_playlist():
     try:
+        stages = metrics.StageClock('create_playlist')
         sp = get_spotify_client()
         data = request.json
         mood = data['mood']
         genres = data['genres']
         playlist_name = data['playlistName']
+        image_size = responses.image_size()
 
-        # Get song suggestions from GPT
-        openai.api_key = os.getenv('OPENAI_API_KEY')
-        completion = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "system",
-                    "content": """You are a professional music curator with extensive knowledge of music history, chart hits, and cultural trends across different time periods.
-
-Your task is to suggest 10 specific songs (with artists) that perfectly match the requested mood and genres.
-
-Follow these guidelines:
-1. For year or era-specific requests (e.g., '2016 vibes', '90s rock'), prioritize actual popular/charting songs from that time period.
-2. Suggest only original songs, NO parodies, karaoke, covers, tributes, or remixes unless specifically requested.
-3. Include well-known, high-quality songs that match the requested mood and genres.
-4. Prioritize songs that were commercially successful or critically acclaimed.
-5. Never include novelty songs, joke songs, or parodies unless explicitly requested.
-6. When given a year or decade, focus on songs that were actually popular or influential during that time.
-7. Ensure all suggestions are legitimate songs by real artists, not fabricated.
-8. Format the response as JSON with fields:
-   - songSuggestions (array of {title, artist})
-   - description (string explaining why these songs fit the request and how they connect to any specified time period)"""
-                },
-                {
-                    "role": "user",
-                    "content": f"Suggest songs for a {mood} playlist with these genres: {', '.join(genres)}"
-                }
-            ],
-            temperature=0.7
-        )
-        suggestions_content = completion.choices[0].message['content']
-        
-        suggestions = json.loads(suggestions_content)
-        logger.info('Got song suggestions')
-        logger.debug(f'Suggestions: {suggestions}')
+        # Get song suggestions from GPT, over-asking by the measured miss rate
+        target_count = 10
+        description = prompts.mood_genre_description(mood, genres)
+        prompt_class = intent.prompt_class(description.lower())
+        analytics.note(prompt_class=prompt_class, stages=stages.timings)
+        suggestion_count = resolution.suggestion_count(target_count, prompt_class)
+        suggestions, backend = suggestion_backends.suggest('create_playlist', {
+            'description': description,
+            'count': suggestion_count,
+            'json_format': True,
+        })
+        logger.info('Got %s song suggestions from %s', len(suggestions['songs']), backend)
+        logger.debug('Suggestions: %s', suggestions)
+        stages.lap('llm_suggestions')
 
         # Create playlist
-        user_id = retry_with_backoff(lambda: sp.current_user()['id'])
+        user_id = retry_with_backoff(lambda: sp.current_user()['id'], call='spotify_current_user')
         playlist = retry_with_backoff(lambda: sp.user_playlist_create(
             user_id,
             playlist_name,
             public=False,
             description=f"A playlist created based on {mood} mood and {', '.join(genres)} genres"
-        ))
+        ), call='spotify_playlist_create')
+        stages.lap('create_playlist')
 
         # Search and add tracks
         added_tracks = []
-        for song in suggestions['songSuggestions']:
+        attempted = 0
+        for song in suggestions['songs']:
+            if len(added_tracks) >= target_count:
+                break
+            attempted += 1
             try:
+                stored = track_store.find(song['title'], song['artist'])
+                if stored is not None:
+                    added_tracks.append(stored)
+                    continue
+
                 # Include original artist in search to avoid covers and karaoke versions
                 query = f"artist:{song['artist']} track:{song['title']}"
-                results = retry_with_backoff(lambda: sp.search(q=query, type='track', limit=1))
+                results = retry_with_backoff(
+                    lambda: hedging.call('spotify_search', lambda: sp.search(q=query, type='track', limit=1)),
+                    call='spotify_search')
                 
                 if results['tracks']['items']:
                     track = results['tracks']['items'][0]
                     added_tracks.append(track)
-                    logger.info(f"Found track: {track['name']} by {track['artists'][0]['name']}")
+                    track_store.remember(track, song['title'], song['artist'])
+                    logger.info("Found track: %s by %s", track['name'], track['artists'][0]['name'])
                 else:
                     # Try a more general search if the specific search failed
+                    metrics.fallback('create_general_search')
                     query = f"{song['artist']} {song['title']}"
-                    results = retry_with_backoff(lambda: sp.search(q=query, type='track', limit=1))
+                    results = retry_with_backoff(
+                        lambda: hedging.call('spotify_search', lambda: sp.search(q=query, type='track', limit=1)),
+                        call='spotify_search')
                     if results['tracks']['items']:
                         track = results['tracks']['items'][0]
                         added_tracks.append(track)
-                        logger.info(f"Found track (general search): {track['name']} by {track['artists'][0]['name']}")
+                        track_store.remember(track, song['title'], song['artist'])
+                        logger.info("Found track (general search): %s by %s", track['name'], track['artists'][0]['name'])
             except Exception as e:
-                logger.warning(f"Error searching for track: {song['title']}, error: {e}")
+                logger.warning("Error searching for track: %s, error: %s", song['title'], e)
+        resolution.record(prompt_class, attempted, len(added_tracks))
+        analytics.note(llm_attempted=attempted, llm_resolved=len(added_tracks))
+        stages.lap('resolve_suggestions')
 
         # Add tracks to playlist
         if added_tracks:
             track_uris = [track['uri'] for track in added_tracks]
-            retry_with_backoff(lambda: sp.playlist_add_items(playlist['id'], track_uris))
-            logger.info(f'Added {len(track_uris)} initial tracks to playlist')
+            retry_with_backoff(lambda: sp.playlist_add_items(playlist['id'], track_uris), call='spotify_playlist_add')
+            logger.info('Added %s initial tracks to playlist', len(track_uris))
+            metrics.tracks_added('llm', len(track_uris))
+            sources = {'llm': len(track_uris)}
+            analytics.note(sources=sources)
+            stages.lap('add_tracks')
 
             try:
-                seed_tracks = [track['id'] for track in added_tracks[:2]]
-                seed_params = {
-                    'limit': 20,
-                    'seed_tracks': ','.join(seed_tracks),
-                    'target_valence': 0.7 if mood.lower() == 'happy' else 0.3,
-                    'target_energy': 0.8 if mood.lower() in ['happy', 'energetic'] else 0.4
-                }
-                recommendations = retry_with_backoff(lambda: sp._get('recommendations', params=seed_params))
-                
-                if recommendations and recommendations.get('tracks'):
-                    rec_uris = [track['uri'] for track in recommendations['tracks']]
-                    retry_with_backoff(lambda: sp.playlist_add_items(playlist['id'], rec_uris))
-                    logger.info(f'Added {len(rec_uris)} recommended tracks to playlist')
-                    added_tracks.extend(recommendations['tracks'])
+                # Tracks that shared past playlists with these come from the local
+                # recommender; Spotify's recommendations only fill the rest
+                recommended = [track for track in recommender.recommend_tracks(
+                    [track['id'] for track in added_tracks], 20, sp=sp) if not intent.is_suspicious(track['name'])]
+                metrics.tracks_added('local_recommendations', len(recommended))
+                sources['local_recommendations'] = len(recommended)
+                if len(recommended) < 20:
+                    seed_tracks = [track['id'] for track in added_tracks[:2]]
+                    seed_params = {
+                        'limit': 20 - len(recommended),
+                        'seed_tracks': ','.join(seed_tracks),
+                        'target_valence': 0.7 if mood.lower() == 'happy' else 0.3,
+                        'target_energy': 0.8 if mood.lower() in ['happy', 'energetic'] else 0.4
+                    }
+                    recommendations = retry_with_backoff(lambda: sp._get('recommendations', params=seed_params), call='spotify_recommendations')
+                    if recommendations and recommendations.get('tracks'):
+                        metrics.tracks_added('recommendations', len(recommendations['tracks']))
+                        sources['recommendations'] = len(recommendations['tracks'])
+                        recommended.extend(recommendations['tracks'])
+
+                if recommended:
+                    rec_uris = [track['uri'] for track in recommended]
+                    retry_with_backoff(lambda: sp.playlist_add_items(playlist['id'], rec_uris), call='spotify_playlist_add')
+                    logger.info('Added %s recommended tracks to playlist', len(rec_uris))
+                    added_tracks.extend(recommended)
             except Exception as e:
-                logger.warning(f'Error getting recommendations: {str(e)}')
+                logger.warning('Error getting recommendations: %s', str(e))
                 logger.info('Continuing with initial tracks only')
+            stages.lap('recommendations')
+            recommender.record_playlist([track['id'] for track in added_tracks])
+            analytics.note(tracks=len(added_tracks))
 
             return jsonify({
                 'playlistId': playlist['id'],
@@ -611,23 +708,87 @@ Follow these guidelines:
                     'suggestedTracks': [{
                         'name': track['name'],
                         'artist': track['artists'][0]['name'],
-                        'image': track['album']['images'][0]['url'] if track['album']['images'] else None
+                        'image': responses.pick_image(track['album']['images'], image_size)
                     } for track in added_tracks[:10]],
-                    'description': suggestions['description']
+                    'description': suggestions['description'] or description
                 }
             })
         else:
             raise Exception('No tracks found to add to playlist')
 
     except Exception as e:
-        logger.error(f'Error creating playlist: {e}')
+        logger.error('Error creating playlist: %s', e)
         return jsonify({'error': 'Failed to create playlist', 'details': str(e)}), 500
 
-@app.route('/api/generate-playlist', methods=['POST'])
+def ensure_fresh_token():
+    """Refresh the session's Spotify token if it expires in the next 10 minutes"""
+    now = int(time.time())
+    token_info = session['token_info']
+
+    # Force refresh if token will expire in the next 10 minutes (600 seconds)
+    if token_info['expires_at'] - now < 600:
+        logger.info("Token expires soon, refreshing before playlist generation")
+        token_url = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
+        with metrics.upstream('spotify_token_refresh'):
+            response = requests.post(
+                token_url,
+                data={
+                    'grant_type': 'refresh_token',
+                    'refresh_token': token_info['refresh_token'],
+                    'client_id': os.environ['SPOTIFY_CLIENT_ID'],
+                    'client_secret': os.environ['SPOTIFY_CLIENT_SECRET']
+                },
+                headers={
+                    'Content-Type': 'application/x-www-form-urlencoded'
+                }
+            )
+
+        if response.status_code == 200:
+            token_data = response.json()
+            session['token_info'] = {
+                'access_token': token_data['access_token'],
+                'refresh_token': token_info['refresh_token'],
+                'expires_at': int(time.time()) + token_data['expires_in']
+            }
+            session.modified = True
+            logger.info("Successfully refreshed token before playlist generation")
+        else:
+            logger.error("Failed to refresh token: %s - %s", response.status_code, response.text)
+
+
+def taste_personalization(sp):
+    """
+    (top artist names, genres, artist ids, track ids, seed genres) from the
+    user's cached taste profile (top artists and tracks over every time
+    range); Spotify is only called when it is stale. Empty lists on failure.
+    """
+    try:
+        profile = taste.get(session_cache_key(), sp)
+        top_artist_names, top_artist_genres, top_artist_ids, top_track_ids = taste.personalization(profile)
+        top_seed_genres = [entry['seed'] for entry in profile.get('seed_genres', [])]
+        logger.info("User's top artists: %s...", ', '.join(top_artist_names[:3]))
+        logger.info("User's preferred genres: %s...", ', '.join(top_artist_genres[:5]))
+        return top_artist_names, top_artist_genres, top_artist_ids, top_track_ids, top_seed_genres
+    except Exception as e:
+        logger.warning("Could not fetch user's top artists or tracks: %s", str(e))
+        return [], [], [], [], []
+
+
+def _hedged_read(call, func):
+    with metrics.upstream(call):
+        return hedging.call(call, func)
+
+
+@api.route('/api/generate-playlist', methods=['POST'])
+@analytics.recorded
+@admission.admitted
+@profiling.profiled
 def generate_playlist():
     try:
+        stages = metrics.StageClock('generate_playlist')
+
         # Check authentication
-        logger.info(f"Generate playlist request received. Session keys: {list(session.keys())}")
+        logger.info("Generate playlist request received. Session keys: %s", session.keys())
         if 'token_info' not in session or 'user' not in session:
             logger.error("User not authenticated - missing session data")
             return jsonify({"error": "User not authenticated"}), 401
@@ -638,592 +799,513 @@ def generate_playlist():
         if not playlist_description:
             logger.error("Missing playlist description")
             return jsonify({"error": "Playlist description is required"}), 400
+
+        # Retries send back the generation id of the failed attempt to resume it
+        generation_id = data.get('generation_id') or checkpoints.new_id()
+        if not checkpoints.valid_id(generation_id):
+            return jsonify({"error": "Invalid generation id"}), 400
         
-        logger.info(f"Generating playlist with description: {playlist_description[:50]}...")
+        logger.info("Generating playlist with description: %s...", playlist_description[:50])
+        image_size = responses.image_size()
 
         # Ensure we have a valid token by forcing a refresh if it's close to expiration
         try:
-            now = int(time.time())
-            token_info = session['token_info']
-            
-            # Force refresh if token will expire in the next 10 minutes (600 seconds)
-            if token_info['expires_at'] - now < 600:
-                logger.info("Token expires soon, refreshing before playlist generation")
-                token_url = 'https://accounts.spotify.com/api/token'
-                response = requests.post(
-                    token_url,
-                    data={
-                        'grant_type': 'refresh_token',
-                        'refresh_token': token_info['refresh_token'],
-                        'client_id': os.environ['SPOTIFY_CLIENT_ID'],
-                        'client_secret': os.environ['SPOTIFY_CLIENT_SECRET']
-                    },
-                    headers={
-                        'Content-Type': 'application/x-www-form-urlencoded'
-                    }
-                )
-                
-                if response.status_code == 200:
-                    token_data = response.json()
-                    session['token_info'] = {
-                        'access_token': token_data['access_token'],
-                        'refresh_token': token_info['refresh_token'],
-                        'expires_at': int(time.time()) + token_data['expires_in']
-                    }
-                    session.modified = True
-                    logger.info("Successfully refreshed token before playlist generation")
-                else:
-                    logger.error(f"Failed to refresh token: {response.status_code} - {response.text}")
-            
+            ensure_fresh_token()
             # Get client with fresh token
             sp = get_spotify_client()
             logger.info("Successfully created Spotify client with fresh token")
         except Exception as e:
-            logger.error(f"Failed to ensure valid token: {str(e)}")
+            logger.error("Failed to ensure valid token: %s", str(e))
             return jsonify({"error": "Authentication error", "details": str(e)}), 401
-            
-        # Get user's top artists to improve recommendations
+        stages.lap('token')
+
+        personalization = taste_personalization(sp)
+        stages.lap('personalization')
+
         try:
-            top_artists = sp.current_user_top_artists(limit=5, time_range='medium_term')
-            top_artist_names = []
-            top_artist_genres = []
-            top_artist_ids = []
-            
-            for artist in top_artists['items']:
-                top_artist_names.append(artist['name'])
-                top_artist_genres.extend(artist['genres'])
-                top_artist_ids.append(artist['id'])
-            
-            # Get unique genres
-            top_artist_genres = list(set(top_artist_genres))
-            
-            logger.info(f"User's top artists: {', '.join(top_artist_names[:3])}...")
-            logger.info(f"User's preferred genres: {', '.join(top_artist_genres[:5])}...")
-            
-            # Get user's top tracks for better seed data
-            top_tracks = sp.current_user_top_tracks(limit=5, time_range='medium_term')
-            top_track_ids = []
-            
-            for track in top_tracks['items']:
-                top_track_ids.append(track['id'])
-            
-        except Exception as e:
-            logger.warning(f"Could not fetch user's top artists or tracks: {str(e)}")
-            top_artist_names = []
-            top_artist_genres = []
-            top_artist_ids = []
-            top_track_ids = []
+            with checkpoints.claimed(generation_id, session['user']['id'], playlist_description) as checkpoint:
+                body, status = run_generation(playlist_description, sp, session['token_info']['access_token'],
+                                              session['user']['id'], image_size, personalization, stages,
+                                              checkpoint=checkpoint)
+        except checkpoints.Conflict as e:
+            return jsonify({"error": str(e), "generation_id": generation_id}), 409
+        return jsonify(dict(body, generation_id=generation_id)), status
+
+    except Exception as e:
+        logger.error("Error in generate-playlist route: %s", str(e))
+        logger.exception(e)
+        return jsonify({"error": "Internal server error", "details": str(e)}), 500
+
+
+def run_generation(playlist_description, sp, access_token, user_id, image_size, personalization, stages,
+                   note=analytics.note, suggest=suggestion_backends.suggest, reads=None, checkpoint=None):
+    """
+    Generate one playlist for a description and save it to the user's
+    account; (response body, status). The batch endpoint passes its own
+    `note`, a combined `suggest` and the batch's SharedReads as `reads`.
+    With a claimed `checkpoint` (see checkpoints.py) each expensive stage is
+    saved and a retry resumes after the last one.
+    """
+    checkpoint = checkpoint or checkpoints.Checkpoint()
+    try:
+        if checkpoint.reached('done'):
+            logger.info("Generation %s already finished; returning its playlist", checkpoint.generation_id)
+            return checkpoint.get('response'), 200
+
+        top_artist_names, top_artist_genres, top_artist_ids, top_track_ids, top_seed_genres = personalization
+        # Tracks added per source, for the metrics and the saved snapshot
+        sources = {}
+        note(stages=stages.timings, sources=sources)
+
+        def count_tracks(source, count=1):
+            metrics.tracks_added(source, count)
+            if count:
+                sources[source] = sources.get(source, 0) + count
+
+        def read(key, fetch):
+            # Within a batch, identical reads are made once
+            return reads.get(key, fetch) if reads is not None else fetch()
+        
+        # Ask for enough suggestions that, at this kind of request's measured
+        # resolution rate, one LLM round fills the first 25 slots
+        llm_target = 25
+        prompt_class = intent.prompt_class(playlist_description.lower())
+        note(prompt_class=prompt_class)
+
+        # Extract mood, genres and era from playlist description for better recommendations
+        description_lower = playlist_description.lower()
         
-        # Generate song suggestions using OpenAI
-        try:
-            openai.api_key = os.getenv('OPENAI_API_KEY')
-            
-            # Build a more personalized prompt using the user's top artists and genres
-            personalization = ""
-            
-            # Check if this is a request for objective "top songs" or a specific year
-            is_objective_request = False
-            objective_patterns = [
-                r'top songs',
-                r'best songs',
-                r'popular songs',
-                r'hit songs',
-                r'billboard',
-                r'chart',
-                r'most played'
-            ]
-            
-            # Check if request is for objective top songs
-            for pattern in objective_patterns:
-                if pattern in playlist_description.lower():
-                    is_objective_request = True
-                    logger.info(f"Detected objective request pattern: '{pattern}'")
-                    break
-                    
-            # Also check if request is specifically for a year (e.g. "2016 songs")
-            year_pattern = r'\b(19|20)\d{2}\b'
-            if re.search(year_pattern, playlist_description.lower()):
-                is_objective_request = True
-                year_match = re.search(year_pattern, playlist_description.lower()).group(0)
-                logger.info(f"Detected year in request: {year_match}")
-            
-            # Only add personalization if this is not an objective request
-            if not is_objective_request and (top_artist_names or top_artist_genres):
-                personalization = "\n\n## USER PROFILE:"
-                if top_artist_names:
-                    personalization += f"\n- Favorite Artists: {', '.join(top_artist_names[:5])}"
-                if top_artist_genres:
-                    personalization += f"\n- Preferred Genres: {', '.join(top_artist_genres[:5])}"
-                logger.info("Adding personalization based on user preferences")
-            else:
-                logger.info("Skipping personalization for objective request")
-            
-            # Extract key aspects from the playlist description
-            prompt_analysis = f"""
-## PLAYLIST REQUEST:
-"{playlist_description}"
-
-{personalization}
-
-## FIRST, ANALYZE THIS REQUEST:
-1. Identify specific era/decade mentions (e.g., "90s", "2010s summer")
-2. Extract genre keywords (e.g., "rock", "hip-hop", "indie folk")
-3. Identify mood/vibe descriptors (e.g., "chill", "upbeat", "melancholic")
-4. Note any activity contexts (e.g., "workout", "studying", "road trip")
-5. Identify any specific artist influences mentioned
-6. Check if the request mentions specific songs to use as references (e.g., "songs like Shape of You")
-7. Determine if this is a request for objective popularity (e.g., "top songs of 2016", "best hits from 90s")
-
-## RESPONSE STRATEGY:
-- If the request mentions "songs like [song title]", focus on providing songs with similar style, tempo, mood, and from similar artists or genres.
-- For any reference songs mentioned, try to identify their key characteristics (genre, mood, era) and use those to guide your selections.
-- If the request is for "top songs" or "best songs" from a specific year or era, prioritize the most globally popular and commercially successful songs from that period, NOT niche or regional songs. Focus on mainstream global hits.
-- When a specific year is mentioned (e.g., "2016 songs"), provide the most popular international/global hits from that year based on charts like Billboard, not regional preferences.
-
-## THEN, GENERATE SONG SELECTIONS:
-Based on your analysis, provide EXACTLY 25 highly relevant songs that precisely match the request. Focus on quality, variety, and accuracy.
-Prioritize well-known, mainstream songs that are likely available on Spotify.
-"""
-            
-            # Create the user prompt
-            artists_text = f"Some artists you might consider: {', '.join(top_artist_names[:5])}. " if top_artist_names and not is_objective_request else ""
-            genres_text = f"Some genres to consider: {', '.join(top_artist_genres[:5])}. " if top_artist_genres and not is_objective_request else ""
-            tracks_text = f"Some tracks to consider: {', '.join(top_track_ids[:5])}. " if top_track_ids and not is_objective_request else ""
-            
-            # Add special instructions for objective requests
-            objective_instruction = ""
-            if is_objective_request:
-                objective_instruction = """
-                Focus on globally popular and commercially successful songs, not regional hits.
-                For year-specific requests, provide the biggest international chart hits from that year.
-                """
-            
-            user_prompt = f"""
-            I need you to create a playlist with at least 25 songs based on this request: "{playlist_description}".
-            {artists_text}
-            {genres_text}
-            {tracks_text}
-            {objective_instruction}
-            Do not include any explanations - only respond with a list of real songs in the format "Song Name by Artist Name", one per line.
-            """
-            
-            logger.info(f"Sending prompt to OpenAI: {user_prompt[:100]}...")
-            
-            # Call OpenAI API - handle both old and new API versions
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": prompt_analysis},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.7,
-                max_tokens=2000
-            )
-            # Parse the response
-            content = response.choices[0].message.content.strip()
-            
-            logger.info(f"Received response from OpenAI: {len(content)} characters")
-            
-            # Split the response into individual songs
-            songs = [song.strip() for song in content.split('\n') if song.strip()]
-            logger.info(f"Extracted {len(songs)} songs from OpenAI response")
-            
-        except Exception as e:
-            logger.error(f"Error in OpenAI API call: {str(e)}")
-            logger.exception(e)
-            songs = []
-            
-        # Search for each song on Spotify and collect track URIs
-        track_uris = []
+        # Detect mood, genres and era from the description
+        mood_profile = intent.mood_profile(description_lower)
+        detected_genres = intent.detect_genres(description_lower)
+        detected_era, min_year, max_year = intent.detect_era(description_lower)
+
+        # Search for each song on Spotify and collect track URIs. Every source's
+        # candidates go through one filter: duplicates, covers, popularity, era, cap
+        selection = candidate_filter.CandidateFilter(min_year=min_year, max_year=max_year)
+        track_uris = selection.uris
+        added_artists = selection.artists  # Track artists we've already added to avoid duplicates
         tracks = []
-        added_artists = set()  # Track artists we've already added to avoid duplicates
+
+        def add_tracks(candidates, source, **options):
+            accepted = selection.accept(candidates, source, **options)
+            tracks.extend(responses.track_summary(candidate, image_size) for candidate in accepted)
+            return accepted
         
         # Helper for finding tracks
         def search_and_add_tracks(search_query, limit=3):
-            search_url = "https://api.spotify.com/v1/search"
-            headers = {"Authorization": f"Bearer {session['token_info']['access_token']}"}
+            search_url = f"{SPOTIFY_API_URL}search"
+            headers = {"Authorization": f"Bearer {access_token}"}
             params = {"q": search_query, "type": "track", "limit": limit, "market": "US"}
+
+            def search():
+                res = _hedged_read('spotify_search', lambda: requests.get(search_url, headers=headers, params=params))
+                return res.json() if res.status_code == 200 else {}
+
+            items = read(('search', search_query, limit, 'US'), search).get('tracks', {}).get('items', [])
+
+            # The most popular result that passes the filter
+            ranked = sorted(items, key=lambda x: x.get('popularity', 0), reverse=True)
+            accepted = add_tracks(ranked, 'llm', limit=llm_target, take=1)
+            return accepted[0] if accepted else None
+        
+        def restore():
+            selection.restore(checkpoint.get('track_uris'), checkpoint.get('added_artists'))
+            tracks[:] = checkpoint.get('tracks')
+            sources.clear()
+            sources.update(checkpoint.get('sources'))
+
+        def progress():
+            return {'track_uris': track_uris, 'tracks': tracks, 'added_artists': sorted(added_artists),
+                    'sources': sources}
+
+        def selected():
+            return dict(progress(), target_tracks=target_tracks,
+                        spare_candidates=generation_state.compact_candidates(spare_candidates, track_uris))
+
+        # A retry resumes after the last checkpoint instead of resolving again
+        if checkpoint.reached('resolution'):
+            restore()
+        else:
+            # Objective requests about a year or decade are answered from the local
+            # chart index first; the LLM only covers what the chart cannot
+            chart = charts.chart_key(playlist_description.lower())
+            chart_tracks = [t for t in charts.lookup(chart) if not intent.is_suspicious(t['name'])]
+            llm_needed = max(0, llm_target - len({t['artist'].lower() for t in chart_tracks}))
+            if chart_tracks:
+                logger.info("Chart index has %s tracks for %s %s", len(chart_tracks), *chart)
+
+            # Generate song suggestions using OpenAI. Only a stage whose suggestions
+            # came through is checkpointed; after a failed LLM call a retry asks again.
+            songs = []
+            suggested = not llm_needed
+            try:
+                if checkpoint.reached('suggestions'):
+                    songs = checkpoint.get('songs')
+                    suggested = True
+                    logger.info("Reusing %s suggestions from the checkpoint", len(songs))
+                elif llm_needed:
+                    # Check if this is a request for objective "top songs" or a specific year
+                    objective_reason = intent.objective_reason(playlist_description.lower())
+                    is_objective_request = objective_reason is not None
+                    if is_objective_request:
+                        logger.info("Detected objective request: '%s'", objective_reason)
             
-            res = requests.get(search_url, headers=headers, params=params)
-            if res.status_code == 200:
-                search_results = res.json()
-                items = search_results.get('tracks', {}).get('items', [])
-                
-                # Filter out suspicious tracks
-                filtered_items = [
-                    item for item in items 
-                    if not any(keyword in item['name'].lower() for keyword in 
-                              ['karaoke', 'tribute', 'cover', 'made famous', 'instrumental', 'remake'])
-                ]
-                
-                if filtered_items:
-                    # Sort by popularity
-                    filtered_items.sort(key=lambda x: x.get('popularity', 0), reverse=True)
-                    
-                    for item in filtered_items:
-                        # Check for duplicate artists
-                        track_artist = item['artists'][0]['name'].lower()
-                        if track_artist in added_artists:
-                            continue
-                            
-                        added_artists.add(track_artist)
-                        track_uris.append(item['uri'])
-                        tracks.append({
-                            'name': item['name'],
-                            'artist': item['artists'][0]['name'],
-                            'album_image': item['album']['images'][0]['url'] if item['album']['images'] else None
-                        })
-                        return True
-            return False
-        
-        # Process songs from OpenAI suggestions
-        if songs:
-            for song in songs:
-                # Skip if we already have enough tracks
-                if len(tracks) >= 25:
-                    break
-                    
-                if "by" in song:
-                    track_name, artist_name = song.split("by", 1)
-                    track_name = track_name.strip()
-                    artist_name = artist_name.strip()
+                    # Only add personalization if this is not an objective request
+                    if not is_objective_request and (top_artist_names or top_artist_genres):
+                        logger.info("Adding personalization based on user preferences")
+                        artists, genres = top_artist_names, top_artist_genres
+                    else:
+                        logger.info("Skipping personalization for objective request")
+                        artists, genres = [], []
+
+                    suggestion_count = resolution.suggestion_count(llm_needed, prompt_class)
+                    logger.info("Requesting %s suggestions for %s %s request", suggestion_count, llm_needed, prompt_class)
+                    result, backend = suggest('generate_playlist', {
+                        'description': playlist_description,
+                        'count': suggestion_count,
+                        'artists': artists,
+                        'genres': genres,
+                    })
+                    songs = suggestion_backends.song_lines(result['songs'])
+                    logger.info("Extracted %s songs from %s", len(songs), backend)
+                    if songs:
+                        checkpoint.save('suggestions', songs=songs)
+                        suggested = True
+            
+            except Exception as e:
+                logger.error("Error in OpenAI API call: %s", str(e))
+                logger.exception(e)
+                songs = []
+            stages.lap('llm_suggestions')
+            
+            # Chart tracks go first, in chart order
+            add_tracks(chart_tracks, 'chart', limit=llm_target)
+            chart_count = len(tracks)
+            count_tracks('chart', chart_count)
+
+            # Process songs from OpenAI suggestions
+            attempted = 0
+            resolved_items = []
+            if songs:
+                for song in songs:
+                    # Skip if we already have enough tracks
+                    if len(tracks) >= llm_target:
+                        break
+                    attempted += 1
                     
-                    # Clean the strings to improve search accuracy
-                    clean_track_name = re.sub(r'[^\w\s]', '', track_name).strip()
-                    clean_artist_name = re.sub(r'[^\w\s]', '', artist_name).strip()
+                    terms = resolution.search_terms(song)
+                    if terms:
+                        # Cleaned of punctuation to improve search accuracy
+                        clean_track_name, clean_artist_name = terms
                     
-                    # Try multiple search strategies
-                    specific_query = f"artist:{clean_artist_name} track:{clean_track_name}"
-                    found = search_and_add_tracks(specific_query)
+                        # Suggestions resolved before, by any worker, skip Spotify search
+                        stored = track_store.find(clean_track_name, clean_artist_name)
+                        if stored is not None:
+                            if add_tracks([stored], 'llm', limit=llm_target, take=1):
+                                resolved_items.append(stored)
+                            continue
+
+                        # Try multiple search strategies
+                        specific_query = f"artist:{clean_artist_name} track:{clean_track_name}"
+                        found = search_and_add_tracks(specific_query)
                     
-                    if not found:
-                        general_query = f"{clean_track_name} {clean_artist_name}"
-                        found = search_and_add_tracks(general_query)
-                        
                         if not found:
-                            quoted_query = f"\"{clean_track_name}\" \"{clean_artist_name}\" NOT karaoke NOT cover NOT tribute"
-                            search_and_add_tracks(quoted_query)
-                else:
-                    # Handle malformatted songs without "by"
-                    search_and_add_tracks(song.strip())
+                            metrics.fallback('general_search')
+                            general_query = f"{clean_track_name} {clean_artist_name}"
+                            found = search_and_add_tracks(general_query)
+                        
+                            if not found and not admission.degraded('skip_quoted_search'):
+                                metrics.fallback('quoted_search')
+                                quoted_query = f"\"{clean_track_name}\" \"{clean_artist_name}\" NOT karaoke NOT cover NOT tribute"
+                                found = search_and_add_tracks(quoted_query)
+
+                        if found:
+                            resolved_items.append(found)
+                            track_store.remember(found, clean_track_name, clean_artist_name)
+                    else:
+                        # Handle malformatted songs without "by"
+                        search_and_add_tracks(song.strip())
                         
+            resolution.record(prompt_class, attempted, len(tracks) - chart_count)
+            note(llm_attempted=attempted, llm_resolved=len(tracks) - chart_count)
+            count_tracks('llm', len(tracks) - chart_count)
+            if chart:
+                charts.learn(chart, resolved_items)
+            stages.lap('resolve_suggestions')
+            if suggested:
+                checkpoint.save('resolution', **progress())
+
         # Log what we found so far
         if tracks:
-            logger.info(f"Successfully found {len(tracks)} tracks from OpenAI suggestions")
-            logger.info("First few tracks: " + ", ".join([f"{t['name']} by {t['artist']}" for t in tracks[:3]]))
+            logger.info("Successfully found %s tracks from OpenAI suggestions", len(tracks))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("First few tracks: %s", ", ".join(f"{t['name']} by {t['artist']}" for t in tracks[:3]))
         else:
             logger.warning("No tracks found from OpenAI suggestions")
             
-        # Extract mood, genres and era from playlist description for better recommendations
-        description_lower = playlist_description.lower()
-        
-        # Check if the user is asking for songs similar to a specific song
-        similar_song_patterns = [
-            r'songs? like (.+)',
-            r'similar to (.+)',
-            r'tracks? like (.+)',
-            r'music like (.+)',
-            r'vibes? like (.+)'
-        ]
-        
-        specific_seed_tracks = []
-        for pattern in similar_song_patterns:
-            matches = re.findall(pattern, description_lower)
-            if matches:
-                for match in matches:
-                    # Clean up the extracted song title
-                    song_title = match.strip()
-                    # Remove trailing "by" if present
-                    if " by " in song_title:
-                        song_title = song_title.split(" by ")[0].strip()
+        if checkpoint.reached('tracks'):
+            restore()
+            target_tracks = checkpoint.get('target_tracks')
+            spare_candidates = checkpoint.get('spare_candidates')
+        else:
+            # Check if the user is asking for songs similar to a specific song
+            specific_seed_tracks = []
+            for pattern in intent.SIMILAR_SONG_PATTERNS:
+                matches = re.findall(pattern, description_lower)
+                if matches:
+                    for match in matches:
+                        # Clean up the extracted song title
+                        song_title = match.strip()
+                        # Remove trailing "by" if present
+                        if " by " in song_title:
+                            song_title = song_title.split(" by ")[0].strip()
                     
-                    logger.info(f"Detected reference to specific song: '{song_title}'")
+                        logger.info("Detected reference to specific song: '%s'", song_title)
                     
-                    # Search for this song on Spotify
-                    try:
-                        search_results = sp.search(q=song_title, type='track', limit=1)
-                        if search_results['tracks']['items']:
-                            track = search_results['tracks']['items'][0]
-                            specific_seed_tracks.append({
-                                'id': track['id'],
-                                'name': track['name'],
-                                'artist': track['artists'][0]['name'],
-                                'uri': track['uri']
-                            })
-                            logger.info(f"Found seed track: {track['name']} by {track['artists'][0]['name']}")
-                            
-                            # Add this first match to our tracks if we don't have any yet
-                            if not tracks and track['uri'] not in track_uris:
-                                track_artist = track['artists'][0]['name'].lower()
-                                added_artists.add(track_artist)
-                                track_uris.append(track['uri'])
-                                tracks.append({
+                        # Search for this song on Spotify
+                        try:
+                            search_results = read(('search', song_title, 1, None), lambda: _hedged_read(
+                                'spotify_search', lambda: sp.search(q=song_title, type='track', limit=1)))
+                            if search_results['tracks']['items']:
+                                track = search_results['tracks']['items'][0]
+                                specific_seed_tracks.append({
+                                    'id': track['id'],
                                     'name': track['name'],
                                     'artist': track['artists'][0]['name'],
-                                    'album_image': track['album']['images'][0]['url'] if track['album']['images'] else None
+                                    'uri': track['uri']
                                 })
-                    except Exception as e:
-                        logger.warning(f"Error searching for seed track '{song_title}': {str(e)}")
-        
-        # Detect mood from description
-        mood_mapping = {
-            'happy': {'valence': 0.8, 'energy': 0.7},
-            'sad': {'valence': 0.2, 'energy': 0.4},
-            'energetic': {'energy': 0.9, 'tempo': 140},
-            'chill': {'energy': 0.3, 'acousticness': 0.7, 'tempo': 90},
-            'relaxed': {'energy': 0.3, 'acousticness': 0.6, 'valence': 0.5},
-            'angry': {'energy': 0.8, 'valence': 0.3, 'tempo': 130},
-            'romantic': {'valence': 0.6, 'energy': 0.4, 'acousticness': 0.5},
-            'workout': {'energy': 0.9, 'tempo': 150},
-            'party': {'danceability': 0.8, 'energy': 0.8, 'tempo': 120},
-            'focus': {'energy': 0.4, 'instrumentalness': 0.5, 'acousticness': 0.5},
-            'sleep': {'energy': 0.1, 'acousticness': 0.8, 'instrumentalness': 0.6}
-        }
-        
-        # Build mood profile based on keywords in description
-        mood_profile = {'valence': 0.5, 'energy': 0.5, 'tempo': 120, 'danceability': 0.5}
-        
-        for mood, attributes in mood_mapping.items():
-            if mood in description_lower or f"{mood} music" in description_lower:
-                for attr, value in attributes.items():
-                    mood_profile[attr] = value
-                    
-        # Extract genres and era
-        possible_genres = [
-            'rock', 'pop', 'hip-hop', 'rap', 'r&b', 'country', 'folk', 'jazz',
-            'blues', 'electronic', 'dance', 'indie', 'classical', 'metal',
-            'alternative', 'punk', 'soul', 'reggae', 'funk', 'disco',
-            'techno', 'house', 'ambient', 'edm', 'lo-fi', 'latin'
-        ]
-        
-        detected_genres = []
-        for genre in possible_genres:
-            if genre in description_lower or f"{genre} music" in description_lower:
-                detected_genres.append(genre)
-                
-        # Extract era/decade
-        era_patterns = {
-            '50s': {'min_year': 1950, 'max_year': 1959, 'keywords': ['50s', 'fifties', '1950s']},
-            '60s': {'min_year': 1960, 'max_year': 1969, 'keywords': ['60s', 'sixties', '1960s']},
-            '70s': {'min_year': 1970, 'max_year': 1979, 'keywords': ['70s', 'seventies', '1970s']},
-            '80s': {'min_year': 1980, 'max_year': 1989, 'keywords': ['80s', 'eighties', '1980s']},
-            '90s': {'min_year': 1990, 'max_year': 1999, 'keywords': ['90s', 'nineties', '1990s']},
-            '2000s': {'min_year': 2000, 'max_year': 2009, 'keywords': ['00s', '2000s', 'two thousands']},
-            '2010s': {'min_year': 2010, 'max_year': 2019, 'keywords': ['10s', '2010s', 'twenty tens']},
-            '2020s': {'min_year': 2020, 'max_year': 2029, 'keywords': ['20s', '2020s', 'twenty twenties']}
-        }
-        
-        detected_era = None
-        min_year = None
-        max_year = None
+                                logger.info("Found seed track: %s by %s", track['name'], track['artists'][0]['name'])
+                            
+                                # Add this first match to our tracks if we don't have any yet
+                                if not tracks and add_tracks([track], 'seed'):
+                                    count_tracks('seed')
+                        except Exception as e:
+                            logger.warning("Error searching for seed track '%s': %s", song_title, str(e))
+            stages.lap('seed_tracks')
         
-        for era, info in era_patterns.items():
-            for keyword in info['keywords']:
-                if keyword in description_lower:
-                    detected_era = era
-                    min_year = info['min_year']
-                    max_year = info['max_year']
-                    break
-            if detected_era:
-                break
-                
-        # Now use all this information to get additional tracks from Spotify recommendations
-        remaining_slots = 50 - len(tracks)
+            # Under load the ladder trims the playlist to 25 tracks
+            target_tracks = 25 if admission.degraded('reduce_target') else 50
+
+            # Tracks that shared past playlists with the ones resolved so far come
+            # from the local recommender, without an upstream call
+            # Candidates generation did not use are kept for extending the playlist later
+            spare_candidates = []
+            remaining_slots = target_tracks - len(tracks)
+            if remaining_slots > 0 and track_uris:
+                tracks_before_local = len(tracks)
+                seed_ids = [uri.rsplit(':', 1)[-1] for uri in track_uris]
+                local_candidates = recommender.recommend_tracks(seed_ids, remaining_slots * 2, sp=sp)
+                spare_candidates.extend(local_candidates)
+                add_tracks(local_candidates, 'local_recommendations', limit=target_tracks, check_era=True)
+                count_tracks('local_recommendations', len(tracks) - tracks_before_local)
+
+            # Now use all this information to get additional tracks from Spotify recommendations
+            remaining_slots = target_tracks - len(tracks)
         
-        if remaining_slots > 0 and (len(tracks) > 0 or top_track_ids or top_artist_ids or detected_genres):
-            logger.info(f"Need {remaining_slots} more tracks to reach 50 total")
+            if remaining_slots > 0 and (len(tracks) > 0 or top_track_ids or top_artist_ids or detected_genres):
+                logger.info("Need %s more tracks to reach %s total", remaining_slots, target_tracks)
+                metrics.fallback('recommendations')
             
-            # Prepare seed data for recommendations
-            # Prioritize specific seed tracks if we found any from the user's request
-            if specific_seed_tracks:
-                seed_tracks = [track['id'] for track in specific_seed_tracks]
-                logger.info(f"Using specific requested tracks as seeds: {', '.join([t['name'] for t in specific_seed_tracks])}")
-            else:
-                seed_tracks = track_uris[:2] if track_uris else top_track_ids[:2]
+                # Prepare seed data for recommendations
+                # Prioritize specific seed tracks if we found any from the user's request
+                if specific_seed_tracks:
+                    seed_tracks = [track['id'] for track in specific_seed_tracks]
+                    logger.info("Using specific requested tracks as seeds: %s", ', '.join([t['name'] for t in specific_seed_tracks]))
+                else:
+                    seed_tracks = [uri.rsplit(':', 1)[-1] for uri in track_uris[:2]] if track_uris else top_track_ids[:2]
                 
-            seed_artists = top_artist_ids[:2] if top_artist_ids else []
-            seed_genres = detected_genres[:1] if detected_genres else top_artist_genres[:1] if top_artist_genres else []
+                seed_artists = top_artist_ids[:2] if top_artist_ids else []
+                # Only genres Spotify accepts as seeds - an unknown one makes the call return nothing
+                seed_genres = (genre_seeds.validate(detected_genres, sp) or top_seed_genres)[:1]
             
-            # Make sure we have at least one seed
-            if not seed_tracks and not seed_artists and not seed_genres:
-                # If we really have nothing, use a popular genre
-                seed_genres = ['pop']
+                # Make sure we have at least one seed
+                if not seed_tracks and not seed_artists and not seed_genres:
+                    # If we really have nothing, use a popular genre
+                    seed_genres = ['pop']
                 
-            # Build recommendations parameters based on our analysis
-            rec_params = {
-                'limit': min(100, remaining_slots * 2),  # Request more than needed to allow filtering
-                'market': 'US'
-            }
+                # Build recommendations parameters based on our analysis
+                rec_params = {
+                    'limit': min(100, remaining_slots * 2),  # Request more than needed to allow filtering
+                    'market': 'US'
+                }
             
-            # Add seed parameters - we can use up to 5 seeds total
-            remaining_seeds = 5
+                # Add seed parameters - we can use up to 5 seeds total
+                remaining_seeds = 5
             
-            # Add seed tracks (up to 2)
-            if seed_tracks:
-                use_tracks = seed_tracks[:min(2, remaining_seeds)]
-                rec_params['seed_tracks'] = ','.join(use_tracks)
-                remaining_seeds -= len(use_tracks)
+                # Add seed tracks (up to 2)
+                if seed_tracks:
+                    use_tracks = seed_tracks[:min(2, remaining_seeds)]
+                    rec_params['seed_tracks'] = ','.join(use_tracks)
+                    remaining_seeds -= len(use_tracks)
                 
-            # Add seed artists (up to 2)
-            if seed_artists and remaining_seeds > 0:
-                use_artists = seed_artists[:min(2, remaining_seeds)]
-                rec_params['seed_artists'] = ','.join(use_artists)
-                remaining_seeds -= len(use_artists)
+                # Add seed artists (up to 2)
+                if seed_artists and remaining_seeds > 0:
+                    use_artists = seed_artists[:min(2, remaining_seeds)]
+                    rec_params['seed_artists'] = ','.join(use_artists)
+                    remaining_seeds -= len(use_artists)
                 
-            # Add seed genres (at least 1, up to remaining slots)
-            if seed_genres and remaining_seeds > 0:
-                use_genres = seed_genres[:min(remaining_seeds, len(seed_genres))]
-                rec_params['seed_genres'] = ','.join(use_genres)
+                # Add seed genres (at least 1, up to remaining slots)
+                if seed_genres and remaining_seeds > 0:
+                    use_genres = seed_genres[:min(remaining_seeds, len(seed_genres))]
+                    rec_params['seed_genres'] = ','.join(use_genres)
                 
-            # Add mood parameters
-            for param, value in mood_profile.items():
-                rec_params[f'target_{param}'] = value
+                # Add mood parameters
+                for param, value in mood_profile.items():
+                    rec_params[f'target_{param}'] = value
                 
-            # Add era parameters if detected
-            if min_year and max_year:
-                # Unfortunately Spotify doesn't have a direct year filter, so we have to filter results afterward
-                pass
+                # Add era parameters if detected
+                if min_year and max_year:
+                    # Unfortunately Spotify doesn't have a direct year filter, so we have to filter results afterward
+                    pass
                 
-            # Add popularity filter for better-known tracks
-            rec_params['min_popularity'] = 40
+                # Add popularity filter for better-known tracks
+                rec_params['min_popularity'] = RECOMMENDATION_MIN_POPULARITY
                 
-            # Get recommendations
-            logger.info(f"Recommendation parameters: {rec_params}")
+                # Get recommendations
+                logger.debug("Recommendation parameters: %s", rec_params)
             
-            try:
-                recommendations = sp._get('recommendations', params=rec_params)
+                try:
+                    with metrics.upstream('spotify_recommendations'):
+                        recommendations = sp._get('recommendations', params=rec_params)
                 
-                if recommendations and recommendations.get('tracks'):
-                    # Sort results by popularity for better quality tracks
-                    recommended_tracks = recommendations['tracks']
-                    recommended_tracks.sort(key=lambda x: x.get('popularity', 0), reverse=True)
+                    if recommendations and recommendations.get('tracks'):
+                        # Sort results by popularity for better quality tracks
+                        recommended_tracks = recommendations['tracks']
+                        recommended_tracks.sort(key=lambda x: x.get('popularity', 0), reverse=True)
                     
-                    # Filter for era if needed
-                    if min_year and max_year:
-                        try:
-                            # Get detailed album info for each track to check release year
-                            era_filtered_tracks = []
-                            for track in recommended_tracks:
-                                # Skip this checking if we already have enough tracks
-                                if len(tracks) + len(era_filtered_tracks) >= 50:
-                                    break
+                        # Filter for era if needed - one album lookup per track, skipped under load
+                        if min_year and max_year and not admission.degraded('skip_era_filter'):
+                            try:
+                                # Get detailed album info for each track to check release year
+                                era_filtered_tracks = []
+                                for track in recommended_tracks:
+                                    # Skip this checking if we already have enough tracks
+                                    if len(tracks) + len(era_filtered_tracks) >= target_tracks:
+                                        break
                                     
-                                album_id = track['album']['id']
-                                album_details = sp.album(album_id)
+                                    album_id = track['album']['id']
+                                    album_details = read(('album', album_id), lambda: _hedged_read(
+                                        'spotify_album', lambda: sp.album(album_id)))
                                 
-                                # Parse release year from release_date
-                                release_date = album_details['release_date']
-                                release_year = int(release_date.split('-')[0])
+                                    # Parse release year from release_date
+                                    release_date = album_details['release_date']
+                                    release_year = int(release_date.split('-')[0])
                                 
-                                if min_year <= release_year <= max_year:
-                                    era_filtered_tracks.append(track)
+                                    if min_year <= release_year <= max_year:
+                                        era_filtered_tracks.append(track)
                                     
-                            # Replace our recommendations with the filtered list
-                            if era_filtered_tracks:
-                                recommended_tracks = era_filtered_tracks
-                        except Exception as e:
-                            logger.warning(f"Error filtering by era: {str(e)}")
+                                # Replace our recommendations with the filtered list
+                                if era_filtered_tracks:
+                                    recommended_tracks = era_filtered_tracks
+                            except Exception as e:
+                                logger.warning("Error filtering by era: %s", str(e))
                     
-                    # Add tracks from recommendations
-                    for rec_track in recommended_tracks:
-                        # Only add more tracks if we haven't reached 50
-                        if len(tracks) >= 50:
-                            break
-                            
-                        rec_artist = rec_track['artists'][0]['name'].lower()
-                        # Skip if we already have this artist
-                        if rec_artist in added_artists:
-                            continue
-                            
-                        # Verify the track isn't a cover, remix, etc.
-                        if not any(keyword in rec_track['name'].lower() for keyword in 
-                                ['karaoke', 'tribute', 'cover', 'made famous', 'instrumental', 'remake']):
-                            
-                            added_artists.add(rec_artist)
-                            track_uris.append(rec_track['uri'])
-                            tracks.append({
-                                'name': rec_track['name'],
-                                'artist': rec_track['artists'][0]['name'],
-                                'album_image': rec_track['album']['images'][0]['url'] if rec_track['album']['images'] else None
-                            })
+                        spare_candidates.extend(recommended_tracks)
+                        # Add tracks from recommendations
+                        add_tracks(recommended_tracks, 'recommendations', limit=target_tracks,
+                                   min_popularity=RECOMMENDATION_MIN_POPULARITY)
                     
-                    logger.info(f"Added {len(tracks) - (50 - remaining_slots)} tracks from recommendations")
-                else:
-                    logger.warning("No recommendation tracks returned from Spotify API")
-            except Exception as e:
-                logger.error(f"Error getting Spotify recommendations: {str(e)}")
-                logger.exception(e)
-        
-        # If we STILL don't have enough tracks, search for generic popular tracks in the detected genres or user's top genres
-        remaining_slots = 50 - len(tracks)
-        if remaining_slots > 0:
-            logger.warning(f"Still need {remaining_slots} more tracks - searching for popular genre tracks")
-            
-            # Determine which genres to use
-            search_genres = detected_genres if detected_genres else top_artist_genres[:3] if top_artist_genres else ['pop']
+                        logger.info("Added %s tracks from recommendations", len(tracks) - (target_tracks - remaining_slots))
+                        count_tracks('recommendations', len(tracks) - (target_tracks - remaining_slots))
+                    else:
+                        logger.warning("No recommendation tracks returned from Spotify API")
+                except Exception as e:
+                    logger.error("Error getting Spotify recommendations: %s", str(e))
+                    logger.exception(e)
+            stages.lap('recommendations')
+        
+            # If we STILL don't have enough tracks, search for generic popular tracks in the detected genres or user's top genres
+            remaining_slots = target_tracks - len(tracks)
+            if remaining_slots > 0:
+                logger.warning("Still need %s more tracks - searching for popular genre tracks", remaining_slots)
+                metrics.fallback('genre_search')
+                tracks_before_genre_search = len(tracks)
             
-            for genre in search_genres:
-                # Only continue if we need more tracks
-                if len(tracks) >= 50:
-                    break
+                # Determine which genres to use
+                search_genres = detected_genres if detected_genres else top_artist_genres[:3] if top_artist_genres else ['pop']
+
+                # Fill from the in-memory genre/era pools first. Genres without a pool
+                # (niche top-artist genres, or before the first refresh) are searched live.
+                pools = []
+                live_genres = []
+                for genre in search_genres:
+                    pool = track_pools.get('genre', genre)
+                    if pool is None:
+                        live_genres.append(genre)
+                    else:
+                        pools.append(pool)
+                if detected_era:
+                    pools.append(track_pools.get('era', detected_era) or [])
+
+                for pool in pools:
+                    add_tracks(pool, 'track_pool', limit=target_tracks, check_era=True)
+                count_tracks('track_pool', len(tracks) - tracks_before_genre_search)
+                tracks_before_live_search = len(tracks)
+
+                for genre in live_genres:
+                    # Only continue if we need more tracks
+                    if len(tracks) >= target_tracks:
+                        break
                     
-                # Search for popular tracks in this genre
-                try:
-                    genre_query = f"genre:{genre}"
-                    search_params = {
-                        "q": genre_query,
-                        "type": "track",
-                        "limit": min(50, 50 - len(tracks)),
-                        "market": "US"
-                    }
+                    # Search for popular tracks in this genre
+                    try:
+                        genre_query = f"genre:{genre}"
+                        search_params = {
+                            "q": genre_query,
+                            "type": "track",
+                            "limit": min(50, target_tracks - len(tracks)),
+                            "market": "US"
+                        }
                     
-                    search_results = sp.search(**search_params)
+                        search_results = read(('search', genre_query, search_params['limit'], 'US'), lambda: _hedged_read(
+                            'spotify_search', lambda: sp.search(**search_params)))
                     
-                    if search_results and search_results['tracks']['items']:
-                        # Filter and add tracks
-                        for item in search_results['tracks']['items']:
-                            if len(tracks) >= 50:
-                                break
-                                
-                            track_artist = item['artists'][0]['name'].lower()
-                            if track_artist in added_artists:
-                                continue
-                                
-                            # Skip suspicious tracks
-                            if any(keyword in item['name'].lower() for keyword in 
-                                  ['karaoke', 'tribute', 'cover', 'made famous', 'instrumental', 'remake']):
-                                continue
-                                
-                            added_artists.add(track_artist)
-                            track_uris.append(item['uri'])
-                            tracks.append({
-                                'name': item['name'],
-                                'artist': item['artists'][0]['name'],
-                                'album_image': item['album']['images'][0]['url'] if item['album']['images'] else None
-                            })
-                except Exception as e:
-                    logger.warning(f"Error searching for {genre} tracks: {str(e)}")
+                        if search_results and search_results['tracks']['items']:
+                            # Filter and add tracks
+                            add_tracks(search_results['tracks']['items'], 'genre_search', limit=target_tracks)
+                    except Exception as e:
+                        logger.warning("Error searching for %s tracks: %s", genre, str(e))
             
-            logger.info(f"After genre searches, now have {len(tracks)} of 50 tracks")
+                logger.info("After genre searches, now have %s of %s tracks", len(tracks), target_tracks)
+                count_tracks('genre_search', len(tracks) - tracks_before_live_search)
+            stages.lap('genre_search')
+            # Nothing found, or a resolution that will be redone, is not kept
+            if tracks and checkpoint.reached('resolution'):
+                checkpoint.save('tracks', **selected())
         
         # Create playlist if we have any tracks
         if not tracks:
             logger.error("Failed to find any tracks for playlist")
-            return jsonify({"error": "No tracks found for this playlist description. Please try a different description."}), 400
+            return {"error": "No tracks found for this playlist description. Please try a different description."}, 400
             
         # Create the playlist
         playlist_title = f"AI Generated: {playlist_description[:30]}..." if len(playlist_description) > 30 else f"AI Generated: {playlist_description}"
-        playlist_data = None
+        # A playlist created by an earlier attempt is reused, never created twice
+        playlist_data = checkpoint.get('playlist')
         
         try:
-            playlist_data = sp.user_playlist_create(
-                user=session['user']['id'],
-                name=playlist_title,
-                public=False,
-                description=f"Generated by AI based on: {playlist_description}"
-            )
-            
-            logger.info(f"Created playlist: {playlist_data['id']}")
+            if playlist_data is None:
+                with metrics.upstream('spotify_playlist_create'):
+                    playlist_data = sp.user_playlist_create(
+                        user=user_id,
+                        name=playlist_title,
+                        public=False,
+                        description=f"Generated by AI based on: {playlist_description}"
+                    )
+                logger.info("Created playlist: %s", playlist_data['id'])
+                # A retry that does not know about this playlist would create another,
+                # so if it cannot be recorded it is deleted again
+                try:
+                    checkpoint.save('playlist', required=True,
+                                    playlist={key: playlist_data[key] for key in ('id', 'name', 'external_urls')},
+                                    **({} if checkpoint.reached('tracks') else selected()))
+                except OSError:
+                    with metrics.upstream('spotify_playlist_unfollow'):
+                        sp.current_user_unfollow_playlist(playlist_data['id'])
+                    raise
+            else:
+                logger.info("Resuming playlist %s", playlist_data['id'])
             
             # Add tracks to playlist - ensure we only add unique URIs
             unique_track_uris = list(dict.fromkeys(track_uris))
@@ -1233,76 +1315,400 @@ Prioritize well-known, mainstream songs that are likely available on Spotify.
                 for i in range(0, len(lst), n):
                     yield lst[i:i + n]
                     
-            track_uri_chunks = list(chunks(unique_track_uris[:50], 100))  # Only take the first 50
+            track_uri_chunks = list(chunks(unique_track_uris[:target_tracks], 100))  # Only take the target count
             
             for i, chunk in enumerate(track_uri_chunks):
-                sp.playlist_add_items(playlist_data['id'], chunk)
-                logger.info(f"Added chunk {i+1}/{len(track_uri_chunks)} ({len(chunk)} tracks) to playlist {playlist_data['id']}")
+                if i < checkpoint.get('chunks_written', 0):
+                    continue
+                with metrics.upstream('spotify_playlist_add'):
+                    sp.playlist_add_items(playlist_data['id'], chunk)
+                checkpoint.save('chunks', chunks_written=i + 1)
+                logger.debug("Added chunk %s/%s (%s tracks) to playlist %s", i+1, len(track_uri_chunks), len(chunk), playlist_data['id'])
+            stages.lap('write_playlist')
+            recommender.record_playlist([uri.rsplit(':', 1)[-1] for uri in unique_track_uris[:target_tracks]])
+            generation_state.save(playlist_data['id'], {
+                'user_id': user_id,
+                'description': playlist_description,
+                'track_uris': unique_track_uris[:target_tracks],
+                'added_artists': sorted(added_artists),
+                'mood_profile': mood_profile,
+                'genres': detected_genres or top_artist_genres[:3] or ['pop'],
+                'era': detected_era,
+                'min_year': min_year,
+                'max_year': max_year,
+                'seed_artists': top_artist_ids[:2],
+                'candidates': generation_state.compact_candidates(spare_candidates, unique_track_uris),
+            })
+            note(tracks=len(tracks[:target_tracks]))
+            snapshots.save(user_id, playlist_data['id'], {
+                'playlist_name': playlist_data['name'],
+                'playlist_url': playlist_data['external_urls']['spotify'],
+                'description': playlist_description,
+                'tracks': tracks[:target_tracks],
+                'timings_ms': {stage: round(seconds * 1000, 1) for stage, seconds in stages.timings.items()},
+                'sources': sources,
+            })
                 
-            return jsonify({
+            response = {
                 "success": True,
+                "playlist_id": playlist_data['id'],
                 "playlist_url": playlist_data['external_urls']['spotify'],
                 "playlist_name": playlist_data['name'],
-                "tracks": tracks[:50]  # Return only the first 50 tracks to the client
-            })
+                "tracks": tracks[:target_tracks]  # Return only the target count to the client
+            }
+            checkpoint.save('done', response=response)
+            return response, 200
             
         except Exception as e:
-            logger.error(f"Error creating or populating playlist: {str(e)}")
+            logger.error("Error creating or populating playlist: %s", str(e))
             logger.exception(e)
-            return jsonify({"error": f"Failed to create playlist: {str(e)}"}), 500
+            return {"error": f"Failed to create playlist: {str(e)}"}, 500
 
     except Exception as e:
-        logger.error(f"Error in generate-playlist route: {str(e)}")
+        logger.error("Error generating playlist: %s", str(e))
+        logger.exception(e)
+        return {"error": "Internal server error", "details": str(e)}, 500
+
+
+@api.route('/api/generate-playlists', methods=['POST'])
+@analytics.recorded
+@admission.admitted
+@profiling.profiled
+def generate_playlists():
+    """
+    Several playlists from one request: {"descriptions": [...]} ->
+    {"playlists": [...]}, one /api/generate-playlist response (plus its
+    status) per description, in order. The token and taste profile are
+    fetched once and the playlists generated concurrently (see batch.py).
+    A retry passes the returned ids as "generation_ids" to resume them.
+    """
+    try:
+        stages = metrics.StageClock('generate_playlists')
+        if 'token_info' not in session or 'user' not in session:
+            return jsonify({"error": "User not authenticated"}), 401
+
+        data = request.json or {}
+        descriptions = data.get('descriptions') or []
+        if not descriptions or not all(isinstance(description, str) and description.strip()
+                                       for description in descriptions):
+            return jsonify({"error": "At least one playlist description is required, and none may be empty"}), 400
+        if len(descriptions) > batch.MAX_PLAYLISTS:
+            return jsonify({"error": f"At most {batch.MAX_PLAYLISTS} playlists per request"}), 400
+        generation_ids = data.get('generation_ids') or [checkpoints.new_id() for _ in descriptions]
+        if len(generation_ids) != len(descriptions) or not all(map(checkpoints.valid_id, generation_ids)):
+            return jsonify({"error": "generation_ids must be one valid id per description"}), 400
+        logger.info("Generating %s playlists in one batch", len(descriptions))
+        image_size = responses.image_size()
+
+        try:
+            ensure_fresh_token()
+            sp = get_spotify_client()
+        except Exception as e:
+            logger.error("Failed to ensure valid token: %s", str(e))
+            return jsonify({"error": "Authentication error", "details": str(e)}), 401
+        stages.lap('token')
+
+        personalization = taste_personalization(sp)
+        stages.lap('personalization')
+
+        access_token, user_id = session['token_info']['access_token'], session['user']['id']
+        notes = []
+
+        def generate(item, suggest, reads):
+            description, generation_id = item
+            # Each playlist keeps its own stage timings and notes; the batch's
+            # analytics row gets their totals below
+            fields = {}
+            notes.append(fields)
+            try:
+                with checkpoints.claimed(generation_id, user_id, description) as checkpoint:
+                    body, status = run_generation(description, sp, access_token, user_id, image_size, personalization,
+                                                  metrics.StageClock('generate_playlists'), note=fields.update,
+                                                  suggest=suggest, reads=reads, checkpoint=checkpoint)
+            except checkpoints.Conflict as e:
+                body, status = {"error": str(e)}, 409
+            return dict(body, generation_id=generation_id), status
+
+        results = batch.generate_all(list(zip(descriptions, generation_ids)), generate)
+        stages.lap('generation')
+
+        sources = {}
+        for fields in notes:
+            for source, count in (fields.get('sources') or {}).items():
+                sources[source] = sources.get(source, 0) + count
+        analytics.note(stages=stages.timings, sources=sources,
+                       tracks=sum(fields.get('tracks', 0) for fields in notes),
+                       llm_attempted=sum(fields.get('llm_attempted', 0) for fields in notes),
+                       llm_resolved=sum(fields.get('llm_resolved', 0) for fields in notes))
+
+        return jsonify({
+            "success": any(status == 200 for _, status in results),
+            "playlists": [dict(body, status=status) for body, status in results],
+        })
+
+    except Exception as e:
+        logger.error("Error in generate-playlists route: %s", str(e))
+        logger.exception(e)
+        return jsonify({"error": "Internal server error", "details": str(e)}), 500
+
+MAX_EXTEND_TRACKS = 50
+
+
+@api.route('/api/playlist/<playlist_id>/extend', methods=['POST'])
+@analytics.recorded
+@admission.admitted
+@profiling.profiled
+def extend_playlist(playlist_id):
+    """
+    Append `count` more tracks to a playlist made by /api/generate-playlist,
+    from the spare candidates saved with it, then the local recommender,
+    the genre/era pools and finally Spotify recommendations with the saved
+    seeds and mood profile. No LLM call, personalization or searches.
+    """
+    try:
+        stages = metrics.StageClock('extend_playlist')
+        if 'token_info' not in session or 'user' not in session:
+            return jsonify({"error": "User not authenticated"}), 401
+
+        if not generation_state.valid_id(playlist_id):
+            return jsonify({"error": "This playlist can no longer be extended. Please generate a new one."}), 404
+
+        # One extend per playlist at a time, from loading its state to saving it
+        with generation_state.claimed(playlist_id):
+            state = generation_state.load(playlist_id)
+            if state is None or state.get('user_id') != session['user']['id']:
+                return jsonify({"error": "This playlist can no longer be extended. Please generate a new one."}), 404
+
+            data = request.get_json(silent=True) or {}
+            try:
+                count = max(1, min(MAX_EXTEND_TRACKS, int(data.get('count', 25))))
+            except (TypeError, ValueError):
+                return jsonify({"error": "count must be a number"}), 400
+            image_size = responses.image_size()
+
+            try:
+                sp = get_spotify_client()
+            except Exception as e:
+                logger.error("Failed to get Spotify client: %s", str(e))
+                return jsonify({"error": "Authentication error", "details": str(e)}), 401
+            stages.lap('token')
+
+            selection = candidate_filter.CandidateFilter(
+                limit=len(state['track_uris']) + count, uris=state['track_uris'], artists=state['added_artists'],
+                min_year=state.get('min_year'), max_year=state.get('max_year'))
+            tracks = []
+            sources = {}
+            analytics.note(stages=stages.timings, sources=sources)
+
+            def take(candidates, source, **options):
+                accepted = selection.accept(candidates, source, check_era=True, **options)
+                tracks.extend(responses.track_summary(candidate, image_size) for candidate in accepted)
+                metrics.tracks_added(source, len(accepted))
+                if accepted:
+                    sources[source] = sources.get(source, 0) + len(accepted)
+
+            take(state['candidates'], 'generation_state')
+            stages.lap('saved_candidates')
+
+            if len(tracks) < count:
+                seed_ids = [uri.rsplit(':', 1)[-1] for uri in state['track_uris']]
+                local_candidates = recommender.recommend_tracks(seed_ids, (count - len(tracks)) * 2, sp=sp)
+                take(generation_state.compact_candidates(local_candidates), 'local_recommendations')
+            stages.lap('recommendations')
+
+            if len(tracks) < count:
+                pools = [track_pools.get('genre', genre) or [] for genre in state['genres']]
+                if state.get('era'):
+                    pools.append(track_pools.get('era', state['era']) or [])
+                for pool in pools:
+                    take(pool, 'track_pool')
+            stages.lap('genre_search')
+
+            if len(tracks) < count:
+                metrics.fallback('recommendations')
+                rec_params = {
+                    'limit': min(100, (count - len(tracks)) * 2),
+                    'market': 'US',
+                    'seed_tracks': ','.join(uri.rsplit(':', 1)[-1] for uri in state['track_uris'][:2]),
+                    'min_popularity': RECOMMENDATION_MIN_POPULARITY,
+                }
+                if state.get('seed_artists'):
+                    rec_params['seed_artists'] = ','.join(state['seed_artists'][:2])
+                seed_genres = genre_seeds.validate(state['genres'])
+                if seed_genres:
+                    rec_params['seed_genres'] = seed_genres[0]
+                for param, value in state['mood_profile'].items():
+                    rec_params[f'target_{param}'] = value
+                try:
+                    with metrics.upstream('spotify_recommendations'):
+                        recommendations = sp._get('recommendations', params=rec_params)
+                    recommended = sorted(recommendations.get('tracks') or [], key=lambda x: x.get('popularity', 0), reverse=True)
+                    take(generation_state.compact_candidates(recommended), 'recommendations',
+                         min_popularity=RECOMMENDATION_MIN_POPULARITY)
+                except Exception as e:
+                    logger.warning("Error getting Spotify recommendations for extension: %s", str(e))
+            stages.lap('spotify_recommendations')
+
+            if not tracks:
+                return jsonify({"error": "No more tracks found for this playlist"}), 400
+
+            new_uris = selection.uris[len(state['track_uris']):]
+            for i in range(0, len(new_uris), 100):
+                with metrics.upstream('spotify_playlist_add'):
+                    sp.playlist_add_items(playlist_id, new_uris[i:i + 100])
+            stages.lap('write_playlist')
+            logger.info("Extended playlist %s with %s tracks", playlist_id, len(new_uris))
+            analytics.note(tracks=len(new_uris))
+
+            state['track_uris'] = state['track_uris'] + new_uris
+            state['added_artists'] = sorted(selection.artists)
+            state['candidates'] = [c for c in state['candidates']
+                                   if c['uri'] not in selection and c['artist'].lower() not in selection.artists]
+            generation_state.save(playlist_id, state)
+
+            snapshot, _ = snapshots.get(session['user']['id'], playlist_id)
+            if snapshot is not None:
+                created = snapshot.pop('created_at', None)
+                snapshot['tracks'] = snapshot['tracks'] + tracks
+                for source, added in sources.items():
+                    snapshot['sources'][source] = snapshot['sources'].get(source, 0) + added
+                snapshot.setdefault('extensions', []).append(
+                    {stage: round(seconds * 1000, 1) for stage, seconds in stages.timings.items()})
+                snapshots.save(session['user']['id'], playlist_id, snapshot, created=created)
+
+            return jsonify({
+                "success": True,
+                "playlist_id": playlist_id,
+                "added": len(tracks),
+                "tracks": tracks
+            })
+
+    except generation_state.Conflict as e:
+        return jsonify({"error": str(e)}), 409
+
+    except Exception as e:
+        logger.error("Error in extend-playlist route: %s", str(e))
         logger.exception(e)
         return jsonify({"error": "Internal server error", "details": str(e)}), 500
 
-@app.route('/api/user/top-tracks')
+
+@api.route('/api/playlists/<playlist_id>')
+def get_playlist(playlist_id):
+    """A generated playlist's tracks, timings and sources, from the local snapshot store"""
+    if 'user' not in session:
+        return jsonify({"error": "User not authenticated"}), 401
+    snapshot, version = snapshots.get(session['user']['id'], playlist_id)
+    if snapshot is None:
+        return jsonify({"error": "Playlist not found"}), 404
+    response = jsonify(dict(snapshot, playlist_id=playlist_id))
+    # Extending a playlist appends a new snapshot, which changes the version
+    response.set_etag(version, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+
+@api.route('/api/playlists')
+def list_playlists():
+    """The user's generated playlists, newest first; pass back next_cursor for the next page"""
+    if 'user' not in session:
+        return jsonify({"error": "User not authenticated"}), 401
+    try:
+        limit = int(request.args.get('limit', 20))
+        cursor = request.args.get('cursor')
+        cursor = snapshots.parse_cursor(cursor) if cursor else None
+    except ValueError:
+        return jsonify({"error": "limit must be a number and cursor a next_cursor value"}), 400
+    items, next_cursor = snapshots.history(session['user']['id'], limit, cursor)
+    return jsonify({"playlists": items, "next_cursor": next_cursor})
+
+
+@api.route('/api/user/taste-profile')
+def get_taste_profile():
+    """
+    The user's merged top artists, tracks and genre frequencies over the
+    short, medium and long term. ?refresh=true refetches from Spotify.
+    """
+    if 'user' not in session:
+        return jsonify({"error": "User not authenticated"}), 401
+    try:
+        sp = get_spotify_client()
+        size = responses.image_size()
+        refresh = request.args.get('refresh', '').lower() in ('1', 'true', 'yes')
+        if refresh:
+            responses.CACHE.invalidate(session_cache_key(), 'taste_profile')
+
+        def build():
+            profile = taste.get(session_cache_key(), sp, refresh=refresh)
+            return {
+                'fetched_at': profile['fetched_at'],
+                'artists': [{'id': a['id'], 'name': a['name'], 'genres': a['genres'], 'score': a['score'],
+                             'ranges': a['ranges'], 'image': responses.pick_image(a['images'], size)}
+                            for a in profile['artists']],
+                'tracks': [{'id': t['id'], 'name': t['name'], 'artist': t['artist'], 'score': t['score'],
+                            'ranges': t['ranges'], 'album_image': responses.pick_image(t['images'], size),
+                            'preview_url': t['preview_url']}
+                           for t in profile['tracks']],
+                'genres': profile['genres'],
+            }
+
+        return responses.cached_json('taste_profile', session_cache_key(), build, variant=size)
+    except Exception as e:
+        logger.error("Error getting taste profile: %s", str(e))
+        return jsonify({'error': str(e)}), 502
+
+@api.route('/api/user/top-tracks')
 def get_top_tracks():
+    from spotipy import SpotifyException
     try:
         logger.info("Getting user's top tracks")
         sp = get_spotify_client()
-        
-        # Get user's top tracks (short_term = ~4 weeks, medium_term = ~6 months, long_term = several years)
+        size = responses.image_size()
+
+        def build():
+            # Get user's top tracks (short_term = ~4 weeks, medium_term = ~6 months, long_term = several years)
+            with metrics.upstream('spotify_top_tracks'):
+                top_tracks_response = sp.current_user_top_tracks(limit=20, time_range='medium_term')
+
+            tracks = []
+            for item in top_tracks_response['items']:
+                track = {
+                    'id': item['id'],
+                    'name': item['name'],
+                    'artist': item['artists'][0]['name'] if item['artists'] else 'Unknown Artist',
+                    'album_image': responses.pick_image(item['album']['images'], size),
+                    'preview_url': item['preview_url']
+                }
+                tracks.append(track)
+            return {'tracks': tracks}
+
         try:
-            top_tracks_response = sp.current_user_top_tracks(limit=20, time_range='medium_term')
-        except spotipy.SpotifyException as spotify_err:
-            logger.error(f"Spotify API error: {spotify_err}")
+            return responses.cached_json('top_tracks', session_cache_key(), build, variant=size)
+        except SpotifyException as spotify_err:
+            logger.error("Spotify API error: %s", spotify_err)
             if "Insufficient client scope" in str(spotify_err):
                 return jsonify({
                     'error': 'Insufficient client scope. Please reauthorize the application with the required permissions.',
                     'code': 'insufficient_scope'
                 }), 403
             return jsonify({'error': str(spotify_err)}), 401
-        
-        tracks = []
-        for item in top_tracks_response['items']:
-            track = {
-                'id': item['id'],
-                'name': item['name'],
-                'artist': item['artists'][0]['name'] if item['artists'] else 'Unknown Artist',
-                'album_image': item['album']['images'][0]['url'] if item['album']['images'] else None,
-                'preview_url': item['preview_url']
-            }
-            tracks.append(track)
-        
-        return jsonify({
-            'tracks': tracks
-        })
     except Exception as e:
-        logger.error(f"Error getting top tracks: {str(e)}")
+        logger.error("Error getting top tracks: %s", str(e))
         return jsonify({'error': str(e)}), 401
 
-def retry_with_backoff(func, max_retries=3, initial_delay=1):
+def retry_with_backoff(func, max_retries=3, initial_delay=1, call='unknown'):
     """Retry a function with exponential backoff"""
     delay = initial_delay
     last_exception = None
 
     for attempt in range(max_retries):
         try:
-            return func()
+            with metrics.upstream(call):
+                return func()
         except Exception as e:
             last_exception = e
             if attempt < max_retries - 1:
+                metrics.retry(call)
                 time.sleep(delay)
                 delay *= 2
     
@@ -1323,7 +1729,7 @@ def search_spotify_track(song_details, sp):
         # Parse song details
         parts = song_details.split(' by ', 1)
         if len(parts) != 2:
-            logger.warning(f"Couldn't parse song details: {song_details}")
+            logger.warning("Couldn't parse song details: %s", song_details)
             return None
             
         song_name, artist_name = parts
@@ -1332,11 +1738,12 @@ def search_spotify_track(song_details, sp):
         
         # Try exact search first with both title and artist
         query = f"track:{song_name} artist:{artist_name}"
-        results = sp.search(q=query, type='track', limit=5)
+        with metrics.upstream('spotify_search'):
+            results = hedging.call('spotify_search', lambda: sp.search(q=query, type='track', limit=5))
         
         if results['tracks']['items']:
             track = results['tracks']['items'][0]
-            logger.info(f"Found track: {track['name']} by {track['artists'][0]['name']} with ID: {track['id']}")
+            logger.info("Found track: %s by %s with ID: %s", track['name'], track['artists'][0]['name'], track['id'])
             return {
                 'id': track['id'],
                 'name': track['name'],
@@ -1349,33 +1756,18 @@ def search_spotify_track(song_details, sp):
         
         # If exact search fails, try a less restrictive search
         query = f"{song_name} {artist_name}"
-        results = sp.search(q=query, type='track', limit=10)
+        with metrics.upstream('spotify_search'):
+            results = hedging.call('spotify_search', lambda: sp.search(q=query, type='track', limit=10))
         
         if not results['tracks']['items']:
-            logger.warning(f"No results found for: {song_details}")
+            logger.warning("No results found for: %s", song_details)
             return None
             
-        # Find the best match by comparing artist names
-        best_match = None
-        for track in results['tracks']['items']:
-            track_artist = track['artists'][0]['name'].lower()
-            
-            # Check if the artist names are similar
-            if (track_artist in artist_name.lower() or 
-                artist_name.lower() in track_artist or
-                fuzz.ratio(track_artist, artist_name.lower()) > 70):
-                
-                # Get the first match
-                if not best_match:
-                    best_match = track
-                    break
-        
-        # If no artist match, just take the first result
-        if not best_match and results['tracks']['items']:
-            best_match = results['tracks']['items'][0]
+        # The first result by the suggested artist, else the first result
+        best_match = resolution.best_artist_match(results['tracks']['items'], artist_name)
             
         if best_match:
-            logger.info(f"Found best match: {best_match['name']} by {best_match['artists'][0]['name']} with ID: {best_match['id']}")
+            logger.info("Found best match: %s by %s with ID: %s", best_match['name'], best_match['artists'][0]['name'], best_match['id'])
             return {
                 'id': best_match['id'],
                 'name': best_match['name'],
@@ -1389,7 +1781,7 @@ def search_spotify_track(song_details, sp):
         return None
         
     except Exception as e:
-        logger.error(f"Error searching for track {song_details}: {str(e)}")
+        logger.error("Error searching for track %s: %s", song_details, str(e))
         logger.exception(e)
         return None
 
@@ -1402,111 +1794,80 @@ def generate_song_suggestions(
 ):
     """Generate song suggestions using OpenAI"""
     try:
-        logger.info(f"Generating song suggestions for prompt: {prompt}")
+        logger.info("Generating song suggestions for prompt: %s", prompt)
         
         # Check if this is a request for objective "top songs" or a specific year
-        is_objective_request = False
-        objective_patterns = [
-            r'top songs',
-            r'best songs',
-            r'popular songs',
-            r'hit songs',
-            r'billboard',
-            r'chart',
-            r'most played'
-        ]
-        
-        # Check if request is for objective top songs
-        for pattern in objective_patterns:
-            if pattern in prompt.lower():
-                is_objective_request = True
-                logger.info(f"Detected objective request pattern: '{pattern}'")
-                break
-                
-        # Also check if request is specifically for a year (e.g. "2016 songs")
-        year_pattern = r'\b(19|20)\d{2}\b'
-        if re.search(year_pattern, prompt.lower()):
-            is_objective_request = True
-            year_match = re.search(year_pattern, prompt.lower()).group(0)
-            logger.info(f"Detected year in request: {year_match}")
-        
-        # Format seed information - only if not an objective request
-        artists_text = f"Some artists you might consider: {', '.join(seed_artists)}. " if seed_artists and not is_objective_request else ""
-        genres_text = f"Some genres to consider: {', '.join(seed_genres)}. " if seed_genres and not is_objective_request else ""
-        tracks_text = f"Some tracks to consider: {', '.join(seed_tracks)}. " if seed_tracks and not is_objective_request else ""
+        objective_reason = intent.objective_reason(prompt.lower())
+        is_objective_request = objective_reason is not None
+        if is_objective_request:
+            logger.info("Detected objective request: '%s'", objective_reason)
         
         # Add personality analysis if available and not an objective request
-        personality_text = ""
+        traits = []
         if not is_objective_request and analysis and isinstance(analysis, dict):
-            traits = []
             for category, score in analysis.items():
                 if score > 0.7:  # High score
                     traits.append(f"high {category}")
                 elif score < 0.3:  # Low score
                     traits.append(f"low {category}")
-            
-            if traits:
-                personality_text = f"Consider that the user's personality analysis shows: {', '.join(traits)}. "
-        
-        # Add special instructions for objective requests
-        objective_instruction = ""
-        if is_objective_request:
-            objective_instruction = """
-            Focus on globally popular and commercially successful songs, not regional hits.
-            For year-specific requests, provide the biggest international chart hits from that year.
-            """
-        
-        # Create a detailed system prompt
-        system_prompt = """
-        You are a music expert. Return a list of 25 songs matching the user's request.
-        Format each song as: "Song Name by Artist Name"
-        Only include real songs. No explanations or additional text.
-        
-        When handling requests about "top songs" from a specific year or era:
-        - Focus on globally popular mainstream hits, not regional or niche songs
-        - Use Billboard, Rolling Stone, and other mainstream charts as reference
-        - For year-specific requests (e.g., "2016 songs"), provide internationally recognized hits
-        """
         
-        # Create the user prompt
-        user_prompt = f"""
-        I need you to create a playlist with at least 25 songs based on this request: "{prompt}".
-        {artists_text}
-        {genres_text}
-        {tracks_text}
-        {personality_text}
-        {objective_instruction}
-        Do not include any explanations - only respond with a list of real songs in the format "Song Name by Artist Name", one per line.
-        """
-        
-        logger.info(f"Sending prompt to OpenAI: {user_prompt[:100]}...")
-        
-        # Call OpenAI API - handle both old and new API versions
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.7,
-            max_tokens=2000
-        )
-        # Parse the response
-        content = response.choices[0].message.content.strip()
-        
-        logger.info(f"Received response from OpenAI: {len(content)} characters")
-        
-        # Split the response into individual songs
-        songs = [song.strip() for song in content.split('\n') if song.strip()]
-        logger.info(f"Extracted {len(songs)} songs from OpenAI response")
+        chart_tracks = charts.lookup(charts.chart_key(prompt.lower()), 25)
+        if len(chart_tracks) >= 25:
+            logger.info("Serving suggestions from the chart index")
+            return [f"{track['name']} by {track['artist']}" for track in chart_tracks]
+
+        # Seed information is only used if this is not an objective request
+        personal = not is_objective_request
+        suggestion_count = resolution.suggestion_count(25, intent.prompt_class(prompt.lower()))
+        result, backend = suggestion_backends.suggest('generate_song_suggestions', {
+            'description': prompt,
+            'count': suggestion_count,
+            'artists': seed_artists if personal and seed_artists else [],
+            'genres': seed_genres if personal and seed_genres else [],
+            'tracks': seed_tracks if personal and seed_tracks else [],
+            'traits': traits,
+        })
+        songs = suggestion_backends.song_lines(result['songs'])
+        logger.info("Extracted %s songs from %s", len(songs), backend)
         
         return songs
         
     except Exception as e:
-        logger.error(f"Error generating song suggestions: {str(e)}")
+        logger.error("Error generating song suggestions: %s", str(e))
         logger.exception(e)
         return None
 
+@api.route('/metrics')
+def prometheus_metrics():
+    """Expose metrics aggregated across all workers in Prometheus text format"""
+    metrics_token = os.getenv('METRICS_TOKEN')
+    if metrics_token and request.headers.get('Authorization') != f"Bearer {metrics_token}":
+        return jsonify({'error': 'Unauthorized'}), 401
+    return metrics.REGISTRY.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@api.route('/api/admin/profiles')
+def list_profiles():
+    """List stored request profiles"""
+    if not profiling.is_admin(request):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({'profiles': profiling.list_profiles()})
+
+@api.route('/api/admin/profiles/<path:filename>')
+def download_profile(filename):
+    """Download one profile file (.collapsed, .tracemalloc or .memory.txt)"""
+    if not profiling.is_admin(request):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return send_from_directory(profiling.PROFILES_DIR, filename, as_attachment=True)
+
+@api.route('/api/admin/profiles/arm', methods=['POST'])
+def arm_profiling():
+    """Profile the next N generate/create requests handled by this worker"""
+    if not profiling.is_admin(request):
+        return jsonify({'error': 'Unauthorized'}), 401
+    count = (request.json or {}).get('count', 1)
+    return jsonify({'armed': profiling.arm(count), 'pid': os.getpid()})
+
 if __name__ == '__main__':
+    app = get_app()
     port = int(os.getenv('PORT', 10000))
     app.run(host='0.0.0.0', port=port) 
\ No newline at end of file
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Append-only store of generation results, so a playlist's tracks, timings
+and source breakdown can be re-fetched and listed without Spotify.
+
+Each user has one log file in MOOSIC_SNAPSHOT_DIR. A record is a small
+uncompressed header (body length, creation time, playlist id) followed by
+the zlib-compressed JSON snapshot. Extending a playlist appends a newer
+snapshot for the same id; the newest one wins. Workers index a log by
+scanning only the bytes appended since their last look.
+
+Retention: when a log holds more than MAX_PER_USER records or its oldest
+record is older than RETENTION_DAYS, it is rewritten with the newest
+snapshot of each playlist that is still within both limits. A read checks
+that the log it opened is the one it indexed and that the record belongs
+to the playlist asked for; after a rewrite it indexes the log again.
+History cursors name a record by creation time and playlist id, not by
+offset, so they survive rewrites.
+"""
+
+import os
+import json
+import time
+import zlib
+import fcntl
+import struct
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = os.getenv('MOOSIC_SNAPSHOT_DIR', '/tmp/moosic_snapshots')
+RETENTION_DAYS = int(os.getenv('MOOSIC_SNAPSHOT_RETENTION_DAYS', '90'))
+MAX_PER_USER = int(os.getenv('MOOSIC_SNAPSHOT_MAX_PER_USER', '200'))
+
+RECORD_HEADER = struct.Struct('<IIB')  # body length, created (unix seconds), playlist id length
+MAX_PAGE_SIZE = 50
+
+
+def _read_records(data, start=0):
+    """Yield (offset, created, playlist_id, body_start, body_end) for complete records from `start`"""
+    offset = start
+    while offset + RECORD_HEADER.size <= len(data):
+        length, created, id_length = RECORD_HEADER.unpack_from(data, offset)
+        body_start = offset + RECORD_HEADER.size + id_length
+        body_end = body_start + length
+        if body_end > len(data):
+            break
+        playlist_id = data[offset + RECORD_HEADER.size:body_start].decode('ascii')
+        yield offset, created, playlist_id, body_start, body_end
+        offset = body_end
+
+
+def parse_cursor(cursor):
+    """(created, playlist_id) from a history cursor; raises ValueError"""
+    created, _, playlist_id = cursor.partition('-')
+    if not playlist_id:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return int(created), playlist_id
+
+
+def _encode(playlist_id, created, snapshot):
+    body = zlib.compress(json.dumps(snapshot, separators=(',', ':')).encode('utf-8'))
+    playlist_id = playlist_id.encode('ascii')
+    return RECORD_HEADER.pack(len(body), created, len(playlist_id)) + playlist_id + body
+
+
+class SnapshotStore:
+    def __init__(self, directory=SNAPSHOT_DIR, retention_days=RETENTION_DAYS, max_per_user=MAX_PER_USER):
+        self.directory = directory
+        self.retention = retention_days * 86400
+        self.max_per_user = max_per_user
+        self._lock = threading.Lock()
+        # path -> {'inode', 'size', 'records': count, 'oldest', 'latest': {playlist_id: (offset, created)}}
+        self._indexes = {}
+
+    def _path(self, user_id):
+        name = hashlib.sha1(user_id.encode('utf-8')).hexdigest()[:20]
+        return os.path.join(self.directory, f"{name}.log")
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def _index(self, path):
+        """The (incrementally updated) index of one user's log"""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._indexes.pop(path, None)
+            return None
+        index = self._indexes.get(path)
+        if index is None or index['inode'] != stat.st_ino or stat.st_size < index['size']:
+            # New to us, or rewritten by retention
+            index = {'inode': stat.st_ino, 'size': 0, 'records': 0, 'oldest': None, 'latest': {}}
+            self._indexes[path] = index
+        if stat.st_size > index['size']:
+            with open(path, 'rb') as f:
+                f.seek(index['size'])
+                data = f.read(stat.st_size - index['size'])
+            consumed = 0
+            for offset, created, playlist_id, _, body_end in _read_records(data):
+                index['latest'][playlist_id] = (index['size'] + offset, created)
+                index['records'] += 1
+                if index['oldest'] is None:
+                    index['oldest'] = created
+                consumed = body_end
+            index['size'] += consumed
+        return index
+
+    def _read(self, path, index, offset, playlist_id):
+        """
+        The snapshot at `offset`, or None if the log was rewritten since it
+        was indexed and the record there is not this playlist's
+        """
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_ino != index['inode']:
+                return None
+            f.seek(offset)
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return None
+            length, created, id_length = RECORD_HEADER.unpack(header)
+            if f.read(id_length) != playlist_id.encode('ascii'):
+                return None
+            snapshot = json.loads(zlib.decompress(f.read(length)).decode('utf-8'))
+        snapshot['created_at'] = created
+        return snapshot
+
+    def _live(self, index, now):
+        """Newest-first (created, offset, playlist_id) of the snapshots retention keeps"""
+        entries = sorted(((created, offset, playlist_id) for playlist_id, (offset, created) in index['latest'].items()
+                          if now - created <= self.retention), reverse=True)
+        return entries[:self.max_per_user]
+
+    def get(self, user_id, playlist_id):
+        """The newest snapshot of a user's playlist plus its version, or (None, None)"""
+        path = self._path(user_id)
+        # A second pass indexes a log that retention rewrote after the first
+        for _ in range(2):
+            with self._lock:
+                index = self._index(path)
+                entry = index['latest'].get(playlist_id) if index else None
+            if entry is None or time.time() - entry[1] > self.retention:
+                return None, None
+            offset = entry[0]
+            snapshot = self._read(path, index, offset, playlist_id)
+            if snapshot is not None:
+                return snapshot, f"{index['inode']}-{offset}"
+        return None, None
+
+    def history(self, user_id, limit=20, before=None):
+        """
+        One page of a user's playlists, newest first: summaries plus the
+        cursor for the next page (None on the last page). `before` is a
+        cursor from parse_cursor.
+        """
+        path = self._path(user_id)
+        for _ in range(2):
+            with self._lock:
+                index = self._index(path)
+                entries = self._live(index, time.time()) if index else []
+            if before is not None:
+                # After the cursor's record, or if that is gone, after its creation time
+                created, playlist_id = before
+                position = next((i + 1 for i, entry in enumerate(entries)
+                                 if entry[0] == created and entry[2] == playlist_id), None)
+                entries = entries[position:] if position is not None else [e for e in entries if e[0] < created]
+            page = entries[:limit]
+            found = [self._read(path, index, offset, playlist_id) for _, offset, playlist_id in page]
+            if None not in found:
+                break
+        items = []
+        for (_, _, playlist_id), snapshot in zip(page, found):
+            if snapshot is None:
+                continue  # rewritten again meanwhile
+            items.append({
+                'playlist_id': playlist_id,
+                'playlist_name': snapshot.get('playlist_name'),
+                'playlist_url': snapshot.get('playlist_url'),
+                'description': snapshot.get('description'),
+                'created_at': snapshot['created_at'],
+                'track_count': len(snapshot.get('tracks') or []),
+                'images': [t['album_image'] for t in (snapshot.get('tracks') or [])[:4] if t.get('album_image')],
+            })
+        next_cursor = f"{page[-1][0]}-{page[-1][2]}" if page and len(entries) > limit else None
+        return items, next_cursor
+
+    def append(self, user_id, playlist_id, snapshot, created=None):
+        """
+        Append a snapshot to the user's log, applying retention when it is
+        due. A newer snapshot of an existing playlist passes the playlist's
+        `created` time, so it keeps its place in history and retention.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(user_id)
+        record = _encode(playlist_id, int(created or time.time()), snapshot)
+        while True:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # Retention may have replaced the log while we waited for the lock
+                if os.fstat(fd).st_ino != os.stat(path).st_ino:
+                    continue
+                os.write(fd, record)
+                with self._lock:
+                    index = self._index(path)
+                    if self._retention_due(index):
+                        self._compact(path, index)
+                return
+            finally:
+                os.close(fd)
+
+    def _retention_due(self, index):
+        if index is None:
+            return False
+        if index['records'] > self.max_per_user * 1.5:
+            return True
+        return index['oldest'] is not None and time.time() - index['oldest'] > self.retention
+
+    def _compact(self, path, index):
+        """Rewrite a log with only what retention keeps; caller holds the log's flock"""
+        live = sorted(self._live(index, time.time()), key=lambda entry: entry[1])
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            for _, offset, _ in live:
+                src.seek(offset)
+                length, _, id_length = RECORD_HEADER.unpack(src.read(RECORD_HEADER.size))
+                src.seek(offset)
+                dst.write(src.read(RECORD_HEADER.size + id_length + length))
+        os.replace(tmp_path, path)
+        self._indexes.pop(path, None)
+        logger.info("Compacted snapshot log %s: kept %s of %s records",
+                    os.path.basename(path), len(live), index['records'])
+
+
+STORE = SnapshotStore()
+
+
+def save(user_id, playlist_id, snapshot, created=None):
+    """Append a generation result (`created`: when an earlier snapshot of it was made); never raises"""
+    try:
+        STORE.append(user_id, playlist_id, snapshot, created)
+    except (OSError, ValueError, TypeError, struct.error) as e:
+        logger.warning("Could not save snapshot of playlist %s: %s", playlist_id, e)
+
+
+def get(user_id, playlist_id):
+    """(snapshot, version) of a user's playlist, or (None, None)"""
+    try:
+        return STORE.get(user_id, playlist_id)
+    except (OSError, ValueError, zlib.error, struct.error) as e:
+        # e.g. retention rewrote the log between indexing and reading
+        logger.warning("Could not read snapshot of playlist %s: %s", playlist_id, e)
+        return None, None
+
+
+def history(user_id, limit=20, before=None):
+    """(summaries, next cursor) for one page of a user's playlists"""
+    try:
+        return STORE.history(user_id, max(1, min(MAX_PAGE_SIZE, limit)), before)
+    except (OSError, ValueError, zlib.error, struct.error) as e:
+        logger.warning("Could not read playlist history: %s", e)
+        return [], None
+
+
+def _after_fork():
+    STORE.after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Song suggestion backends and the router that picks one per request.
+
+A backend turns a suggestion request - a dict with description, count and
+optionally artists, genres, tracks, traits, exclude and json_format - into
+{'songs': [{'title', 'artist'}], 'description': str or None}:
+
+  openai:<model>  an OpenAI chat model (see llm.chat_completion)
+  local           the chart index and the genre/era track pools, no network
+  stub            deterministic songs for tests, no network
+
+Each endpoint has a chain of backends in order of preference
+(MOOSIC_SUGGESTION_BACKENDS overrides every chain). The router serves a
+request from the first backend whose recent p95 latency fits the SLO
+(MOOSIC_SUGGESTION_SLO_MS); backends over the SLO are only probed now and
+then so they can recover, and are used as a last resort when nothing
+faster answered.
+"""
+
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+
+import llm
+import charts
+import intent
+import metrics
+import prompts
+import hedging
+import track_pools
+import track_store
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHAINS = {
+    'create_playlist': 'openai:gpt-4,openai:gpt-3.5-turbo,local',
+    'playlist_generator': 'openai:gpt-4,openai:gpt-3.5-turbo,local',
+    'generate_playlist': 'openai:gpt-3.5-turbo,local',
+    'generate_song_suggestions': 'openai:gpt-3.5-turbo,local',
+}
+CHAIN_OVERRIDE = os.getenv('MOOSIC_SUGGESTION_BACKENDS')
+SLO = float(os.getenv('MOOSIC_SUGGESTION_SLO_MS', '8000')) / 1000
+# A backend skipped for being slow still gets one request this often
+PROBE_INTERVAL = 30.0
+# Requests are few and slow, so judge a backend on fewer samples than hedging does
+MIN_SAMPLES = 5
+WINDOW = 100
+# Optional {"tracks": [...]} file the stub draws songs from
+STUB_CATALOGUE = os.getenv('MOOSIC_STUB_SUGGESTIONS')
+# Completion tokens one combined request may ask a model for; larger batches
+# are answered one request at a time
+COMBINED_MAX_TOKENS = {'gpt-3.5-turbo': 3000, 'gpt-4': 6000}
+
+_LINE_PREFIX = re.compile(r'^\s*(?:\d+[.)]\s*|[-*]\s*)')
+_SECTION = re.compile(r'^\s*#\s*(\d+)\s*$')
+
+
+def parse_song_lines(content):
+    """[{'title', 'artist'}] from "Song Name by Artist Name" lines; artist is '' when missing"""
+    songs = []
+    for line in content.split('\n'):
+        line = _LINE_PREFIX.sub('', line).strip()
+        if not line:
+            continue
+        title, by, artist = line.rpartition(' by ')
+        songs.append({'title': title.strip(), 'artist': artist.strip()} if by else {'title': line, 'artist': ''})
+    return songs
+
+
+def parse_song_sections(content, count):
+    """`count` song lists from a reply with "#1", "#2"... lines before each list"""
+    sections = [[] for _ in range(count)]
+    current = None
+    for line in content.split('\n'):
+        match = _SECTION.match(line)
+        if match:
+            number = int(match.group(1))
+            current = sections[number - 1] if 1 <= number <= count else None
+        elif current is not None:
+            current.extend(parse_song_lines(line))
+    return sections
+
+
+def song_lines(songs):
+    """The reverse of parse_song_lines, for code that works on suggestion strings"""
+    return [f"{song['title']} by {song['artist']}" if song['artist'] else song['title'] for song in songs]
+
+
+class OpenAIBackend:
+    def __init__(self, model):
+        self.model = model
+        self.name = f"openai:{model}"
+
+    def suggest(self, endpoint, request):
+        count = request['count']
+        if request.get('json_format'):
+            content = llm.chat_completion(
+                endpoint,
+                [
+                    {"role": "system", "content": prompts.SONG_JSON_SYSTEM},
+                    {"role": "user", "content": prompts.song_json_request(
+                        request['description'], count, exclude=request.get('exclude') or ())}
+                ],
+                model=self.model,
+                max_tokens=prompts.max_tokens_for(count, json_format=True)
+            )
+            data = json.loads(content)
+            return {'songs': data['songSuggestions'], 'description': data.get('description')}
+
+        content = llm.chat_completion(
+            endpoint,
+            [
+                {"role": "system", "content": prompts.SONG_LIST_SYSTEM},
+                {"role": "user", "content": prompts.song_list_request(
+                    request['description'], count,
+                    artists=request.get('artists') or [], genres=request.get('genres') or [],
+                    tracks=request.get('tracks') or [], traits=request.get('traits') or [],
+                    exclude=request.get('exclude') or ())}
+            ],
+            model=self.model,
+            max_tokens=prompts.max_tokens_for(count)
+        )
+        logger.info("Received response from %s: %s characters", self.name, len(content))
+        return {'songs': parse_song_lines(content), 'description': None}
+
+    @staticmethod
+    def _list_arguments(request):
+        return {
+            'description': request['description'],
+            'count': request['count'],
+            'artists': request.get('artists') or [],
+            'genres': request.get('genres') or [],
+            'tracks': request.get('tracks') or [],
+            'traits': request.get('traits') or [],
+            'exclude': request.get('exclude') or (),
+        }
+
+    def _combined_max_tokens(self, requests):
+        return sum(prompts.max_tokens_for(request['count']) for request in requests)
+
+    def can_combine(self, requests):
+        return (not any(request.get('json_format') for request in requests)
+                and self._combined_max_tokens(requests) <= COMBINED_MAX_TOKENS.get(self.model, 0))
+
+    def combine(self, endpoint, requests):
+        """One completion answering every request; [{'songs', 'description'}] in request order"""
+        content = llm.chat_completion(
+            endpoint,
+            [
+                {"role": "system", "content": prompts.SONG_LISTS_SYSTEM},
+                {"role": "user", "content": prompts.song_lists_request(
+                    [self._list_arguments(request) for request in requests])}
+            ],
+            model=self.model,
+            max_tokens=self._combined_max_tokens(requests)
+        )
+        logger.info("Received combined response from %s for %s requests: %s characters",
+                    self.name, len(requests), len(content))
+        return [{'songs': songs, 'description': None} for songs in parse_song_sections(content, len(requests))]
+
+
+def _spotify_shaped(track):
+    """A compact track (track_pools.compact_track) in the shape track_store.put expects"""
+    return {
+        'id': track['uri'].rsplit(':', 1)[-1],
+        'uri': track['uri'],
+        'name': track['name'],
+        'artists': [{'name': track['artist']}],
+        'album': {'images': track.get('images') or [], 'release_date': str(track.get('year') or '')},
+        'popularity': track.get('popularity') or 0,
+    }
+
+
+class LocalBackend:
+    """
+    Suggestions from what is already indexed: the chart index for objective
+    year/decade requests, then the genre and era pools. The tracks are put in
+    the track store, so the caller resolves them without searching.
+    """
+
+    name = 'local'
+
+    def suggest(self, endpoint, request):
+        description_lower = request['description'].lower()
+        era, min_year, max_year = intent.detect_era(description_lower)
+        sources = [charts.lookup(charts.chart_key(description_lower))]
+        for genre in intent.detect_genres(description_lower) or request.get('genres') or []:
+            pool = track_pools.get('genre', genre) or []
+            if era:
+                pool = [t for t in pool if t['year'] and min_year <= t['year'] <= max_year]
+            sources.append(pool)
+        if era:
+            sources.append(track_pools.get('era', era) or [])
+
+        excluded = {line.lower() for line in request.get('exclude') or ()}
+        picked, artists = [], set()
+        # Round-robin over the sources so one genre does not fill the list
+        for position in range(max((len(source) for source in sources), default=0)):
+            for source in sources:
+                if position >= len(source) or len(picked) >= request['count']:
+                    continue
+                track = source[position]
+                artist = track['artist'].lower()
+                if (artist in artists or intent.is_suspicious(track['name'])
+                        or f"songs by {artist}" in excluded
+                        or f"{track['name']} by {track['artist']}".lower() in excluded):
+                    continue
+                artists.add(artist)
+                picked.append(track)
+        for track in picked:
+            track_store.remember(_spotify_shaped(track))
+        return {'songs': [{'title': t['name'], 'artist': t['artist']} for t in picked], 'description': None}
+
+
+class StubBackend:
+    """The same songs for the same request, from MOOSIC_STUB_SUGGESTIONS or made up"""
+
+    name = 'stub'
+
+    def __init__(self, catalogue_path=STUB_CATALOGUE):
+        self.catalogue_path = catalogue_path
+        self._catalogue = None
+
+    def _songs(self):
+        if self._catalogue is None:
+            if self.catalogue_path:
+                with open(self.catalogue_path) as f:
+                    tracks = json.load(f)['tracks']
+                self._catalogue = [{'title': t['name'], 'artist': t['artists'][0]['name']} for t in tracks]
+            else:
+                self._catalogue = [{'title': f"Stub Song {i}", 'artist': f"Stub Artist {i}"} for i in range(500)]
+        return self._catalogue
+
+    def suggest(self, endpoint, request):
+        seed = hashlib.md5(f"{request['description']}|{request['count']}".encode('utf-8')).hexdigest()
+        songs = random.Random(seed).sample(self._songs(), min(request['count'], len(self._songs())))
+        return {'songs': songs, 'description': f"Stub suggestions for {request['description']}"}
+
+
+def make_backend(name):
+    if name.startswith('openai:'):
+        return OpenAIBackend(name.split(':', 1)[1])
+    if name == 'local':
+        return LocalBackend()
+    if name == 'stub':
+        return StubBackend()
+    raise ValueError(f"Unknown suggestion backend: {name}")
+
+
+class Router:
+    def __init__(self, chains, slo=SLO, probe_interval=PROBE_INTERVAL):
+        self.slo = slo
+        self.probe_interval = probe_interval
+        self._backends = {}
+        self.chains = {endpoint: [self._backend(name.strip()) for name in chain.split(',') if name.strip()]
+                       for endpoint, chain in chains.items()}
+        self.reset()
+
+    def _backend(self, name):
+        if name not in self._backends:
+            self._backends[name] = make_backend(name)
+        return self._backends[name]
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._last_probe = {}
+
+    def p95(self, backend):
+        with self._lock:
+            window = self._windows.get(backend.name)
+            return window.p95() if window else None
+
+    def _within_slo(self, backend, slo):
+        p95 = self.p95(backend)
+        if p95 is None or p95 <= slo:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_probe.get(backend.name, 0.0) >= self.probe_interval:
+                self._last_probe[backend.name] = now
+                return True
+        return False
+
+    def _observe(self, backend, seconds):
+        with self._lock:
+            self._windows.setdefault(backend.name, hedging.LatencyWindow(WINDOW, MIN_SAMPLES)).observe(seconds)
+
+    def suggest(self, endpoint, request, slo=None):
+        """
+        Suggestions from the first backend of the endpoint's chain that fits
+        the SLO and returns songs, plus the name of that backend.
+        """
+        slo = self.slo if slo is None else slo
+        chain = self.chains.get(endpoint) or self.chains['generate_playlist']
+        fast = [backend for backend in chain if self._within_slo(backend, slo)]
+        slow = [backend for backend in chain if backend not in fast]
+        for backend in slow:
+            logger.info("Skipping %s for %s: p95 %.1fs over the %.1fs SLO",
+                        backend.name, endpoint, self.p95(backend), slo)
+            metrics.suggestion_backend(endpoint, backend.name, 'skipped')
+
+        for backend in fast + slow:
+            start = time.perf_counter()
+            try:
+                result = backend.suggest(endpoint, request)
+            except Exception as e:
+                logger.warning("Suggestion backend %s failed for %s: %s", backend.name, endpoint, e)
+                metrics.suggestion_backend(endpoint, backend.name, 'failed')
+                continue
+            finally:
+                self._observe(backend, time.perf_counter() - start)
+            if result['songs']:
+                metrics.suggestion_backend(endpoint, backend.name, 'served')
+                return result, backend.name
+            metrics.suggestion_backend(endpoint, backend.name, 'empty')
+        return {'songs': [], 'description': None}, None
+
+    def combine(self, endpoint, requests, slo=None):
+        """
+        [(suggestions, backend name) or None] for several requests answered by
+        one combined call, or None when the first backend that fits the SLO
+        cannot combine them. Requests the reply left empty are None, for the
+        caller to send on their own.
+        """
+        slo = self.slo if slo is None else slo
+        chain = self.chains.get(endpoint) or self.chains['generate_playlist']
+        backend = next((backend for backend in chain if self._within_slo(backend, slo)), None)
+        if backend is None or not getattr(backend, 'can_combine', lambda requests: False)(requests):
+            return None
+        # Not observed: a combined reply is longer than the single ones the SLO is judged on
+        try:
+            results = backend.combine(endpoint, requests)
+        except Exception as e:
+            logger.warning("Combined suggestions from %s failed for %s: %s", backend.name, endpoint, e)
+            metrics.suggestion_backend(endpoint, backend.name, 'failed')
+            return None
+        metrics.suggestion_backend(endpoint, backend.name, 'combined')
+        return [(result, backend.name) if result['songs'] else None for result in results]
+
+
+def _chains():
+    if CHAIN_OVERRIDE:
+        return {endpoint: CHAIN_OVERRIDE for endpoint in DEFAULT_CHAINS}
+    return dict(DEFAULT_CHAINS)
+
+
+ROUTER = Router(_chains())
+
+
+def suggest(endpoint, request, slo=None):
+    """({'songs', 'description'}, backend name) for a suggestion request"""
+    return ROUTER.suggest(endpoint, request, slo)
+
+
+def combine(endpoint, requests, slo=None):
+    """[(suggestions, backend name) or None] per request from one combined call, or None if none was made"""
+    return ROUTER.combine(endpoint, requests, slo)
+
+
+os.register_at_fork(after_in_child=ROUTER.reset)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Per-user taste profile: top artists and tracks over the short (~4 weeks),
+medium (~6 months) and long (several years) term ranges, merged into one
+weighted, deduplicated ranking plus genre frequencies.
+
+The six top-items calls are made concurrently. Profiles are zlib JSON files
+in MOOSIC_TASTE_DIR, one per user, so every worker shares them and
+generation reads personalization without calling Spotify while the profile
+is fresher than MOOSIC_TASTE_TTL_SECONDS.
+"""
+
+import os
+import json
+import time
+import zlib
+import hashlib
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import genre_seeds
+
+logger = logging.getLogger(__name__)
+
+TASTE_DIR = os.getenv('MOOSIC_TASTE_DIR', '/tmp/moosic_taste')
+TASTE_TTL = int(os.getenv('MOOSIC_TASTE_TTL_SECONDS', str(6 * 3600)))
+# Recent listening says more about what someone wants today
+RANGE_WEIGHTS = {'short_term': 1.0, 'medium_term': 0.7, 'long_term': 0.4}
+TOP_LIMIT = 50
+MAX_GENRES = 30
+VERSION = 2
+
+
+def _path(user_key):
+    name = hashlib.sha1(user_key.encode('utf-8')).hexdigest()[:20]
+    return os.path.join(TASTE_DIR, f"{name}.taste")
+
+
+def fetch_top_items(sp):
+    """{(kind, time_range): items} for artists and tracks over every range, fetched concurrently"""
+    def fetch(kind, time_range):
+        with metrics.upstream(f"spotify_top_{kind}"):
+            if kind == 'artists':
+                return sp.current_user_top_artists(limit=TOP_LIMIT, time_range=time_range)['items']
+            return sp.current_user_top_tracks(limit=TOP_LIMIT, time_range=time_range)['items']
+
+    keys = [(kind, time_range) for kind in ('artists', 'tracks') for time_range in RANGE_WEIGHTS]
+    with ThreadPoolExecutor(max_workers=len(keys), thread_name_prefix='taste') as pool:
+        # Each call runs in a copy of the request context so upstream calls are still counted
+        futures = {key: pool.submit(contextvars.copy_context().run, fetch, *key) for key in keys}
+    results, errors = {}, []
+    for key, future in futures.items():
+        try:
+            results[key] = future.result()
+        except Exception as e:
+            logger.warning("Could not fetch top %s (%s): %s", key[0], key[1], e)
+            errors.append(e)
+    if not results:
+        raise errors[0]
+    return results
+
+
+def _rank_score(position, count, time_range):
+    # 1.0 for the top item of a range down to ~0.5 for its last
+    return RANGE_WEIGHTS[time_range] * (1.0 - 0.5 * position / max(1, count))
+
+
+def build_profile(top_items):
+    """Merge per-range top items into one profile, best first"""
+    artists, tracks, genres = {}, {}, {}
+    for (kind, time_range), items in top_items.items():
+        for position, item in enumerate(items):
+            score = _rank_score(position, len(items), time_range)
+            if kind == 'artists':
+                entry = artists.setdefault(item['id'], {
+                    'id': item['id'],
+                    'name': item['name'],
+                    'genres': item.get('genres') or [],
+                    'images': item.get('images') or [],
+                    'score': 0.0,
+                    'ranges': [],
+                })
+                for genre in entry['genres']:
+                    genres[genre] = genres.get(genre, 0.0) + score
+            else:
+                artist = item['artists'][0] if item.get('artists') else {}
+                entry = tracks.setdefault(item['id'], {
+                    'id': item['id'],
+                    'uri': item['uri'],
+                    'name': item['name'],
+                    'artist': artist.get('name', 'Unknown Artist'),
+                    'artist_id': artist.get('id'),
+                    'images': (item.get('album') or {}).get('images') or [],
+                    'preview_url': item.get('preview_url'),
+                    'score': 0.0,
+                    'ranges': [],
+                })
+            entry['score'] = round(entry['score'] + score, 4)
+            entry['ranges'].append(time_range)
+
+    total = sum(genres.values()) or 1.0
+    genre_weights = [{'genre': genre, 'weight': round(weight / total, 4)}
+                     for genre, weight in sorted(genres.items(), key=lambda item: item[1], reverse=True)]
+    return {
+        'version': VERSION,
+        'fetched_at': int(time.time()),
+        'artists': sorted(artists.values(), key=lambda entry: entry['score'], reverse=True),
+        'tracks': sorted(tracks.values(), key=lambda entry: entry['score'], reverse=True),
+        'genres': genre_weights[:MAX_GENRES],
+        # Every artist genre mapped to its recommendation seed, so generation needs no mapping
+        'seed_genres': genre_seeds.seed_weights(genre_weights),
+    }
+
+
+def load(user_key):
+    """The user's cached profile, or None if missing, stale or unreadable"""
+    try:
+        with open(_path(user_key), 'rb') as f:
+            profile = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, zlib.error) as e:
+        logger.warning("Could not read taste profile: %s", e)
+        return None
+    if profile.get('version') != VERSION or time.time() - profile.get('fetched_at', 0) > TASTE_TTL:
+        return None
+    return profile
+
+
+def save(user_key, profile):
+    """Write a user's profile; never raises"""
+    try:
+        path = _path(user_key)
+        os.makedirs(TASTE_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(json.dumps(profile, separators=(',', ':')).encode('utf-8')))
+        os.replace(tmp_path, path)
+    except (OSError, ValueError, TypeError) as e:
+        logger.warning("Could not save taste profile: %s", e)
+
+
+def get(user_key, sp, refresh=False):
+    """The user's profile from the cache, else fetched from Spotify and cached"""
+    profile = None if refresh else load(user_key)
+    metrics.cache_lookup('taste_profile', profile is not None)
+    if profile is None:
+        profile = build_profile(fetch_top_items(sp))
+        save(user_key, profile)
+    return profile
+
+
+def personalization(profile, artists=5, tracks=5, genres=10):
+    """(artist names, genres, artist ids, track ids) used to personalize a generation"""
+    top_artists = profile['artists'][:artists]
+    return ([artist['name'] for artist in top_artists],
+            [genre['genre'] for genre in profile['genres'][:genres]],
+            [artist['id'] for artist in top_artists],
+            [track['id'] for track in profile['tracks'][:tracks]])
@@ -0,0 +1,158 @@
+import time
+import threading
+
+import pytest
+
+import batch
+import suggestion_backends
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    """
+    Records combine/suggest calls. `answered` is the descriptions combine
+    answers (None: all), or an exception it raises, or False: no combined call.
+    """
+    calls = {'combine': [], 'suggest': [], 'answered': None}
+
+    def combine(endpoint, requests):
+        calls['combine'].append([request['description'] for request in requests])
+        answered = calls['answered']
+        if isinstance(answered, Exception):
+            raise answered
+        if answered is False:
+            return None
+        return [({'songs': [request['description']]}, 'combined')
+                if answered is None or request['description'] in answered else None
+                for request in requests]
+
+    def suggest(endpoint, request):
+        calls['suggest'].append(request['description'])
+        return {'songs': [request['description']]}, 'single'
+
+    monkeypatch.setattr(suggestion_backends, 'combine', combine)
+    monkeypatch.setattr(suggestion_backends, 'suggest', suggest)
+    return calls
+
+
+def ask_concurrently(combined, descriptions, closing=0):
+    """Each description asked by its own member; `closing` more members close without asking"""
+    members = [combined.member() for _ in range(len(descriptions) + closing)]
+    results = {}
+
+    def ask(member, description):
+        results[description] = member('generate_playlist', {'description': description})
+        member.close()
+
+    threads = [threading.Thread(target=ask, args=(member, description))
+               for member, description in zip(members, descriptions)]
+    threads += [threading.Thread(target=member.close) for member in members[len(descriptions):]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_shared_reads_fetch_each_key_once():
+    reads = batch.SharedReads()
+    fetched = []
+    gate = threading.Event()
+
+    def fetch():
+        fetched.append(1)
+        gate.wait(1)
+        return 'value'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(reads.get(('search', 'q'), fetch))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    gate.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ['value'] * 4
+    assert len(fetched) == 1
+
+
+def test_shared_reads_retry_a_failed_key():
+    reads = batch.SharedReads()
+
+    def fail():
+        raise RuntimeError('upstream down')
+
+    with pytest.raises(RuntimeError):
+        reads.get('key', fail)
+    assert reads.get('key', lambda: 'recovered') == 'recovered'
+
+
+def test_members_share_one_combined_call(backends):
+    combined = batch.CombinedSuggestions(3, window=5)
+    results = ask_concurrently(combined, ['a', 'b', 'c'])
+    assert len(backends['combine']) == 1
+    assert sorted(backends['combine'][0]) == ['a', 'b', 'c']
+    assert backends['suggest'] == []
+    assert {description: backend for description, (_, backend) in results.items()} == dict.fromkeys('abc', 'combined')
+    assert all(result['songs'] == [description] for description, (result, _) in results.items())
+
+
+def test_closed_members_do_not_hold_the_leader(backends):
+    combined = batch.CombinedSuggestions(4, window=5)
+    start = time.monotonic()
+    results = ask_concurrently(combined, ['a', 'b'], closing=2)
+    assert time.monotonic() - start < 2
+    assert sorted(results) == ['a', 'b']
+    assert sorted(backends['combine'][0]) == ['a', 'b']
+
+
+def test_leader_stops_waiting_after_the_window(backends):
+    combined = batch.CombinedSuggestions(2, window=0.1)
+    member = combined.member()
+    start = time.monotonic()
+    result, backend = member('generate_playlist', {'description': 'alone'})
+    assert time.monotonic() - start < 2
+    # Nothing to combine with: sent on its own
+    assert backends['combine'] == []
+    assert backends['suggest'] == ['alone']
+    assert backend == 'single'
+
+
+@pytest.mark.parametrize('answered, fallbacks', [
+    (False, ['a', 'b']),
+    (RuntimeError('combined call failed'), ['a', 'b']),
+    ({'a'}, ['b']),
+])
+def test_unanswered_requests_fall_back_to_the_router(backends, answered, fallbacks):
+    backends['answered'] = answered
+    combined = batch.CombinedSuggestions(2, window=5)
+    results = ask_concurrently(combined, ['a', 'b'])
+    assert sorted(backends['suggest']) == fallbacks
+    assert sorted(results) == ['a', 'b']
+    assert all(result['songs'] == [description] for description, (result, _) in results.items())
+
+
+def test_close_after_asking_is_a_no_op(backends):
+    combined = batch.CombinedSuggestions(1, window=5)
+    member = combined.member()
+    member('generate_playlist', {'description': 'a'})
+    member.close()
+    member.close()
+    assert combined._outstanding == 0
+
+
+def test_generate_all_keeps_item_order(backends):
+    seen = []
+
+    def generate(item, suggest, reads):
+        time.sleep(0.05 * (3 - item))
+        seen.append(item)
+        if item != 1:
+            suggest('generate_playlist', {'description': str(item)})
+        return item * 10, reads
+
+    results = batch.generate_all([0, 1, 2], generate)
+    assert [value for value, _ in results] == [0, 10, 20]
+    # One SharedReads for the whole batch
+    assert len({id(reads) for _, reads in results}) == 1
+    assert len(backends['combine']) == 1 and sorted(backends['combine'][0]) == ['0', '2']
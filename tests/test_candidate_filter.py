@@ -0,0 +1,101 @@
+import pytest
+
+import metrics
+import candidate_filter
+
+
+def compact(uri, artist, name='Song', year=2005, popularity=50):
+    return {'uri': uri, 'artist': artist, 'name': name, 'year': year, 'popularity': popularity}
+
+
+def spotify(uri, artist, name='Song', release_date='2005-06-01', popularity=50):
+    return {'uri': uri, 'name': name, 'artists': [{'name': artist}],
+            'album': {'release_date': release_date}, 'popularity': popularity}
+
+
+def rejected_total(source, reason):
+    labels = [('reason', reason), ('source', source)]
+    return sum(value for name, counter_labels, value in metrics.REGISTRY.snapshot()['counters']
+               if name == 'moosic_candidates_rejected_total' and list(map(tuple, counter_labels)) == labels)
+
+
+def test_accepts_in_order_and_records_the_playlist():
+    selection = candidate_filter.CandidateFilter()
+    accepted = selection.accept([compact('u1', 'A'), spotify('u2', 'B')], 'chart')
+    assert [c['uri'] for c in accepted] == ['u1', 'u2']
+    assert selection.uris == ['u1', 'u2']
+    assert selection.artists == {'a', 'b'}
+    assert 'u1' in selection and 'u3' not in selection
+    assert len(selection) == 2
+
+
+def test_each_reason_is_counted_once_in_filter_order():
+    selection = candidate_filter.CandidateFilter(uris=['u1'], artists=['Taken'], min_year=2000, max_year=2010)
+    candidates = [
+        # Also suspicious, unpopular and out of era: only the first reason counts
+        compact('u1', 'Other', name='Song (Karaoke Version)', year=1990, popularity=0),
+        compact('u2', 'TAKEN', name='Song (Karaoke Version)', year=1990, popularity=0),
+        compact('u3', 'C', name='Song - Tribute', year=1990, popularity=0),
+        compact('u4', 'D', year=1990, popularity=0),
+        compact('u5', 'E', year=1990),
+        compact('u6', 'F', year=None),
+        compact('u7', 'G'),
+    ]
+    before = {reason: rejected_total('test_order', reason)
+              for reason in ('duplicate_track', 'duplicate_artist', 'suspicious', 'popularity', 'era')}
+    accepted = selection.accept(candidates, 'test_order', check_era=True, min_popularity=40)
+    assert [c['uri'] for c in accepted] == ['u7']
+    assert selection.rejected == {'duplicate_track': 1, 'duplicate_artist': 1, 'suspicious': 1,
+                                  'popularity': 1, 'era': 2}
+    assert {reason: rejected_total('test_order', reason) - count for reason, count in before.items()} == \
+        selection.rejected
+
+
+def test_duplicates_within_one_batch():
+    selection = candidate_filter.CandidateFilter()
+    accepted = selection.accept([compact('u1', 'A'), compact('u1', 'B'), compact('u2', 'a')], 'pool')
+    assert [c['uri'] for c in accepted] == ['u1']
+    assert selection.rejected == {'duplicate_track': 1, 'duplicate_artist': 1}
+
+
+def test_rejections_add_up_across_batches():
+    selection = candidate_filter.CandidateFilter()
+    selection.accept([compact('u1', 'A'), compact('u2', 'A')], 'chart')
+    selection.accept([compact('u3', 'A'), spotify('u1', 'B')], 'llm')
+    assert selection.rejected == {'duplicate_artist': 2, 'duplicate_track': 1}
+
+
+@pytest.mark.parametrize('make', [compact, spotify])
+def test_era_reads_both_shapes(make):
+    selection = candidate_filter.CandidateFilter(min_year=2000, max_year=2010)
+    old = make('u1', 'A', **({'year': 1999} if make is compact else {'release_date': '1999'}))
+    new = make('u2', 'B', **({'year': 2010} if make is compact else {'release_date': '2010-01-01'}))
+    assert selection.accept([old, new], 'recommendations', check_era=True) == [new]
+
+
+def test_era_is_only_checked_when_asked_and_known():
+    candidates = [compact('u1', 'A', year=1970)]
+    assert candidate_filter.CandidateFilter(min_year=2000, max_year=2010).accept(candidates, 'llm') == candidates
+    assert candidate_filter.CandidateFilter().accept(candidates, 'pool', check_era=True) == candidates
+
+
+def test_stops_at_the_limit_and_take():
+    candidates = [compact(f"u{i}", f"A{i}") for i in range(10)]
+    selection = candidate_filter.CandidateFilter(limit=4, uris=['u0'], artists=['a0'])
+    assert [c['uri'] for c in selection.accept(candidates, 'pool', take=2)] == ['u1', 'u2']
+    assert [c['uri'] for c in selection.accept(candidates, 'pool')] == ['u3']
+    assert selection.full()
+    assert selection.accept(candidates, 'pool') == []
+    assert [c['uri'] for c in selection.accept(candidates, 'pool', limit=5)] == ['u4']
+    # Candidates past the stop are neither accepted nor counted as rejected
+    assert selection.rejected == {'duplicate_track': 1 + 3 + 4}
+
+
+def test_restore_replaces_in_place():
+    selection = candidate_filter.CandidateFilter()
+    uris, artists = selection.uris, selection.artists
+    selection.accept([compact('u1', 'A')], 'chart')
+    selection.restore(['u2', 'u3'], ['B', 'C'])
+    assert uris == ['u2', 'u3'] and artists == {'b', 'c'}
+    assert 'u1' not in selection and 'u2' in selection
+    assert selection.accept([compact('u1', 'A'), compact('u4', 'b')], 'llm') == [compact('u1', 'A')]
@@ -0,0 +1,118 @@
+import os
+import time
+
+import pytest
+
+import checkpoints
+
+
+@pytest.fixture(autouse=True)
+def checkpoint_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(checkpoints, 'CHECKPOINT_DIR', str(tmp_path))
+    monkeypatch.setattr(checkpoints, 'ENABLED', True)
+    return tmp_path
+
+
+def test_ids():
+    generation_id = checkpoints.new_id()
+    assert checkpoints.valid_id(generation_id)
+    for invalid in ('../etc/passwd', 'short', '', None, 'x' * 65, 'has space in it'):
+        assert not checkpoints.valid_id(invalid)
+
+
+def test_new_generation_has_reached_nothing():
+    with checkpoints.claimed(checkpoints.new_id(), 'user', 'chill beats') as checkpoint:
+        assert checkpoint.stage is None
+        assert not any(checkpoint.reached(stage) for stage in checkpoints.STAGES)
+
+
+@pytest.mark.parametrize('stage', checkpoints.STAGES)
+def test_retry_resumes_after_the_saved_stage(stage):
+    generation_id = checkpoints.new_id()
+    with checkpoints.claimed(generation_id, 'user', 'chill beats') as checkpoint:
+        checkpoint.save(stage, **{f"{stage}_field": [1, 2]})
+
+    with checkpoints.claimed(generation_id, 'user', 'chill beats') as checkpoint:
+        assert checkpoint.stage == stage
+        position = checkpoints.STAGES.index(stage)
+        assert all(checkpoint.reached(earlier) for earlier in checkpoints.STAGES[:position + 1])
+        assert not any(checkpoint.reached(later) for later in checkpoints.STAGES[position + 1:])
+        assert checkpoint.get(f"{stage}_field") == [1, 2]
+
+
+def test_fields_of_earlier_stages_are_kept():
+    generation_id = checkpoints.new_id()
+    with checkpoints.claimed(generation_id, 'user', 'chill beats') as checkpoint:
+        checkpoint.save('suggestions', songs=['a by b'])
+        checkpoint.save('resolution', track_uris=['spotify:track:1'])
+    state = checkpoints.load(generation_id)
+    assert state['stage'] == 'resolution'
+    assert state['songs'] == ['a by b'] and state['track_uris'] == ['spotify:track:1']
+
+
+def test_concurrent_claim_conflicts():
+    generation_id = checkpoints.new_id()
+    with checkpoints.claimed(generation_id, 'user', 'chill beats'):
+        with pytest.raises(checkpoints.Conflict):
+            with checkpoints.claimed(generation_id, 'user', 'chill beats'):
+                pass
+    # Released once the first request is done
+    with checkpoints.claimed(generation_id, 'user', 'chill beats'):
+        pass
+
+
+@pytest.mark.parametrize('user_id, description', [('someone else', 'chill beats'), ('user', 'sad songs')])
+def test_claim_for_a_different_request_conflicts(user_id, description):
+    generation_id = checkpoints.new_id()
+    with checkpoints.claimed(generation_id, 'user', 'chill beats') as checkpoint:
+        checkpoint.save('suggestions', songs=[])
+    with pytest.raises(checkpoints.Conflict):
+        with checkpoints.claimed(generation_id, user_id, description):
+            pass
+
+
+def test_expired_and_unreadable_checkpoints_are_ignored(checkpoint_dir, monkeypatch):
+    generation_id = checkpoints.new_id()
+    checkpoints.Checkpoint(generation_id, 'user', 'chill beats').save('tracks')
+    assert checkpoints.load(generation_id)['stage'] == 'tracks'
+    monkeypatch.setattr(checkpoints, 'CHECKPOINT_TTL', -1)
+    assert checkpoints.load(generation_id) is None
+
+    monkeypatch.setattr(checkpoints, 'CHECKPOINT_TTL', 3600)
+    (checkpoint_dir / f"{generation_id}.checkpoint").write_bytes(b'not zlib')
+    assert checkpoints.load(generation_id) is None
+
+
+def test_without_an_id_nothing_is_written(checkpoint_dir):
+    checkpoint = checkpoints.Checkpoint(None, 'user', 'chill beats')
+    checkpoint.save('playlist', required=True, playlist={'id': 'p'})
+    assert checkpoint.reached('playlist') and checkpoint.get('playlist') == {'id': 'p'}
+    assert os.listdir(checkpoint_dir) == []
+
+
+def test_disabled_checkpoints_are_not_written(checkpoint_dir, monkeypatch):
+    monkeypatch.setattr(checkpoints, 'ENABLED', False)
+    with checkpoints.claimed(checkpoints.new_id(), 'user', 'chill beats') as checkpoint:
+        checkpoint.save('done', response={})
+    assert os.listdir(checkpoint_dir) == []
+
+
+def test_failed_save_raises_only_when_required(tmp_path, monkeypatch):
+    blocker = tmp_path / 'not a directory'
+    blocker.write_text('')
+    monkeypatch.setattr(checkpoints, 'CHECKPOINT_DIR', str(blocker))
+    checkpoint = checkpoints.Checkpoint(checkpoints.new_id(), 'user', 'chill beats')
+    checkpoint.save('tracks', tracks=[])
+    with pytest.raises(OSError):
+        checkpoint.save('playlist', required=True, playlist={'id': 'p'})
+
+
+def test_prune_drops_expired_files(checkpoint_dir, monkeypatch):
+    old, fresh = checkpoints.new_id(), checkpoints.new_id()
+    for generation_id in (old, fresh):
+        checkpoints.Checkpoint(generation_id, 'user', 'chill beats').save('done')
+    past = time.time() - 2 * checkpoints.CHECKPOINT_TTL
+    os.utime(checkpoint_dir / f"{old}.checkpoint", (past, past))
+    monkeypatch.setattr(checkpoints, '_last_prune', 0.0)
+    checkpoints._maybe_prune()
+    assert sorted(os.listdir(checkpoint_dir)) == [f"{fresh}.checkpoint"]
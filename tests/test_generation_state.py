@@ -0,0 +1,27 @@
+import pytest
+
+import generation_state
+
+
+@pytest.fixture(autouse=True)
+def state_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(generation_state, 'STATE_DIR', str(tmp_path))
+    return tmp_path
+
+
+def test_second_extend_of_a_playlist_conflicts():
+    with generation_state.claimed('abc123'):
+        with pytest.raises(generation_state.Conflict):
+            with generation_state.claimed('abc123'):
+                pass
+        with generation_state.claimed('other456'):
+            pass
+    with generation_state.claimed('abc123'):
+        pass
+
+
+def test_invalid_ids_are_never_claimed():
+    assert not generation_state.valid_id('../etc/passwd')
+    with pytest.raises(ValueError):
+        with generation_state.claimed('../etc/passwd'):
+            pass
@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+import playlist_generator
+import suggestion_backends
+
+
+class FakeSpotify:
+    """Playlists in memory; searching 'track:<title> ...' finds spotify:track:<title>"""
+
+    def __init__(self, playlists=None):
+        self.playlists = playlists or {}
+
+    def current_user(self):
+        return {'id': 'user'}
+
+    def user_playlist_create(self, user_id, name, **kwargs):
+        playlist_id = f"playlist{len(self.playlists)}"
+        self.playlists[playlist_id] = []
+        return {'id': playlist_id}
+
+    def search(self, q, **kwargs):
+        title = q.split()[0][len('track:'):]
+        return {'tracks': {'items': [{'uri': f"spotify:track:{title}"}]}}
+
+    def playlist_items(self, playlist_id, **kwargs):
+        return {'items': [{'track': {'uri': uri}} for uri in self.playlists[playlist_id]], 'next': None}
+
+    def playlist_add_items(self, playlist_id, uris):
+        self.playlists[playlist_id] += uris
+
+
+@pytest.fixture(autouse=True)
+def suggestions(monkeypatch):
+    """Suggests s0, s1, ... in order, carrying on where the last call stopped"""
+    suggested = []
+
+    def suggest(endpoint, request):
+        songs = [{'title': f"s{len(suggested) + i}", 'artist': 'a'} for i in range(request['count'])]
+        suggested.extend(songs)
+        return {'songs': songs}, 'fake'
+
+    monkeypatch.setattr(suggestion_backends, 'suggest', suggest)
+
+
+def test_identical_batch_lines_get_their_own_ids(tmp_path):
+    path = tmp_path / 'batch.jsonl'
+    lines = [{'prompt': 'chill'}, {'prompt': 'focus'}, {'prompt': 'chill'}]
+    path.write_text(''.join(json.dumps(line) + '\n' for line in lines))
+    ids = [entry['id'] for entry in playlist_generator.load_batch(str(path))]
+    assert len(set(ids)) == 3
+
+    # Moving lines keeps the ids of the entries that moved
+    path.write_text(''.join(json.dumps(line) + '\n' for line in lines[::-1]))
+    assert sorted(entry['id'] for entry in playlist_generator.load_batch(str(path))) == sorted(ids)
+
+
+def test_resumed_playlist_is_only_topped_up():
+    sp = FakeSpotify({'playlist0': ['spotify:track:s0', 'spotify:track:s1', 'spotify:track:s2']})
+    generator = playlist_generator.PlaylistGenerator('chill', length=5, sp=sp, quiet=True)
+    assert generator.generate_playlist('playlist0') == 'playlist0'
+    assert len(sp.playlists['playlist0']) == 5
+    assert len(set(sp.playlists['playlist0'])) == 5
+    assert generator.added == 5
+
+
+def test_full_resumed_playlist_gets_nothing_more():
+    sp = FakeSpotify({'playlist0': [f"spotify:track:s{i}" for i in range(5)]})
+    generator = playlist_generator.PlaylistGenerator('chill', length=5, sp=sp, quiet=True)
+    generator.generate_playlist('playlist0')
+    assert len(sp.playlists['playlist0']) == 5
@@ -0,0 +1,38 @@
+import time
+
+import snapshots
+
+
+def test_resaving_keeps_creation_time_and_history_order(tmp_path, monkeypatch):
+    store = snapshots.SnapshotStore(str(tmp_path))
+    clock = [1_700_000_000]
+    monkeypatch.setattr(time, 'time', lambda: clock[0])
+    store.append('user', 'p1', {'playlist_name': 'first', 'tracks': []})
+    clock[0] += 60
+    store.append('user', 'p2', {'playlist_name': 'second', 'tracks': []})
+    clock[0] += 60
+
+    # Extending p1 appends a newer snapshot with p1's original creation time
+    snapshot, _ = store.get('user', 'p1')
+    created = snapshot.pop('created_at')
+    store.append('user', 'p1', dict(snapshot, tracks=[{'name': 'added'}]), created)
+
+    snapshot, _ = store.get('user', 'p1')
+    assert snapshot['created_at'] == created and snapshot['tracks'] == [{'name': 'added'}]
+    items, _ = store.history('user')
+    assert [item['playlist_id'] for item in items] == ['p2', 'p1']
+    assert items[1]['track_count'] == 1
+
+
+def test_history_cursor_pages_through_every_playlist(tmp_path):
+    store = snapshots.SnapshotStore(str(tmp_path))
+    for i in range(5):
+        store.append('user', f"p{i}", {'tracks': []})
+    seen, cursor = [], None
+    while True:
+        items, next_cursor = store.history('user', 2, snapshots.parse_cursor(cursor) if cursor else None)
+        seen += [item['playlist_id'] for item in items]
+        if next_cursor is None:
+            break
+        cursor = next_cursor
+    assert seen == ['p4', 'p3', 'p2', 'p1', 'p0']
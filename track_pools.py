@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import logging
+import threading
+
+import requests
+
+import intent
+import metrics
+
+logger = logging.getLogger(__name__)
+
+REFRESH_INTERVAL = float(os.getenv('MOOSIC_TRACK_POOL_REFRESH_SECONDS', '3600'))
+# Tracks kept per pool, fetched 50 at a time (the search API maximum)
+POOL_SIZE = int(os.getenv('MOOSIC_TRACK_POOL_SIZE', '100'))
+ENABLED = os.getenv('MOOSIC_TRACK_POOLS', 'true').lower() in ('1', 'true', 'yes')
+
+
+def pool_queries():
+    """Every pool as (kind, name) -> search query"""
+    queries = {('genre', genre): f"genre:{genre}" for genre in intent.POSSIBLE_GENRES}
+    for era, info in intent.ERA_PATTERNS.items():
+        queries[('era', era)] = f"year:{info['min_year']}-{info['max_year']}"
+    return queries
+
+
+def compact_track(item):
+    """The parts of a search result the playlist fallback needs"""
+    release_date = item.get('album', {}).get('release_date') or ''
+    return {
+        'uri': item['uri'],
+        'name': item['name'],
+        'artist': item['artists'][0]['name'],
+        'images': item['album']['images'],
+        'popularity': item.get('popularity', 0),
+        'year': int(release_date[:4]) if release_date[:4].isdigit() else None,
+    }
+
+
+class TrackPools:
+    """
+    Popularity-sorted candidate tracks per genre and era, kept in memory and
+    refreshed by a background thread with an app (client credentials) token.
+    The thread starts on first use, so each forked worker runs its own.
+    """
+
+    def __init__(self, accounts_url, api_url, refresh_interval=REFRESH_INTERVAL, pool_size=POOL_SIZE):
+        self.accounts_url = accounts_url
+        self.api_url = api_url
+        self.refresh_interval = refresh_interval
+        self.pool_size = pool_size
+        self._pools = {}
+        self._refreshed_at = 0.0
+        self._token = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def get(self, kind, name):
+        """The pool for e.g. ('genre', 'rock'), or None if it has not been loaded"""
+        self.ensure_started()
+        pool = self._pools.get((kind, name))
+        metrics.cache_lookup(f"track_pool_{kind}", pool is not None)
+        return pool
+
+    def ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='track-pools', daemon=True)
+                self._thread.start()
+
+    def after_fork(self):
+        # The parent's refresher thread does not exist in the child
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            if time.time() - self._refreshed_at >= self.refresh_interval:
+                self.refresh()
+            time.sleep(min(60.0, self.refresh_interval))
+
+    def _app_token(self):
+        if self._token and self._token['expires_at'] - time.time() > 60:
+            return self._token['access_token']
+        with metrics.upstream('spotify_client_credentials'):
+            response = requests.post(
+                f"{self.accounts_url}/api/token",
+                data={
+                    'grant_type': 'client_credentials',
+                    'client_id': os.environ['SPOTIFY_CLIENT_ID'],
+                    'client_secret': os.environ['SPOTIFY_CLIENT_SECRET']
+                },
+                timeout=10
+            )
+        response.raise_for_status()
+        data = response.json()
+        self._token = {'access_token': data['access_token'], 'expires_at': time.time() + data['expires_in']}
+        return self._token['access_token']
+
+    def _fetch(self, query):
+        items = []
+        for offset in range(0, self.pool_size, 50):
+            headers = {"Authorization": f"Bearer {self._app_token()}"}
+            params = {"q": query, "type": "track", "limit": min(50, self.pool_size - offset),
+                      "offset": offset, "market": "US"}
+            with metrics.upstream('spotify_search'):
+                response = requests.get(f"{self.api_url}search", headers=headers, params=params, timeout=10)
+            response.raise_for_status()
+            page = response.json().get('tracks', {}).get('items', [])
+            items.extend(page)
+            if len(page) < params['limit']:
+                break
+
+        pool, seen = [], set()
+        for item in sorted(items, key=lambda x: x.get('popularity', 0), reverse=True):
+            if item['uri'] in seen or intent.is_suspicious(item['name']):
+                continue
+            seen.add(item['uri'])
+            pool.append(compact_track(item))
+        return pool
+
+    def refresh(self):
+        """Rebuild every pool. Pools that fail to load keep their previous contents"""
+        start = time.perf_counter()
+        failed = 0
+        queries = pool_queries()
+        for key, query in queries.items():
+            try:
+                self._pools[key] = self._fetch(query)
+            except Exception as e:
+                failed += 1
+                logger.warning("Could not refresh track pool %s: %s", key, e)
+        self._refreshed_at = time.time()
+        if failed == len(queries):
+            # Nothing loaded (e.g. Spotify unreachable) - try again in a few minutes
+            self._refreshed_at -= max(0.0, self.refresh_interval - 300)
+        logger.info("Refreshed %s track pools in %.2fs (%s failed)",
+                    len(self._pools), time.perf_counter() - start, failed)
+
+
+POOLS = None
+
+
+def configure(accounts_url, api_url):
+    """Create the process-wide pools for the given Spotify endpoints (no-op if disabled)"""
+    global POOLS
+    if ENABLED:
+        POOLS = TrackPools(accounts_url, api_url)
+    return POOLS
+
+
+def get(kind, name):
+    """Pooled tracks for ('genre', name) or ('era', name), or None when not available"""
+    return POOLS.get(kind, name) if POOLS is not None else None
+
+
+def _after_fork():
+    if POOLS is not None:
+        POOLS.after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
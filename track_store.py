@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+"""
+Track metadata store shared by all gunicorn workers.
+
+Three append-only files in MOOSIC_TRACK_STORE_DIR, memory-mapped read-only
+by every process:
+
+    records.bin  fixed-width track records (id, string offsets, popularity, year)
+    strings.bin  interned, length-prefixed UTF-8 strings (names, artists, image URLs)
+    index.bin    open-addressing hash table: 64-bit key hash -> record/string
+
+Readers never lock: a record is published by bumping the record count after
+its strings and index entries are written. Writers serialize on an fcntl
+lock, so any worker can add tracks but only one writes at a time.
+
+The index is sized by MOOSIC_TRACK_STORE_INDEX_SLOTS when created. Once it
+is MAX_LOAD full, a background thread rehashes a copy into a table twice
+the size without the writer lock, then takes the lock only to copy over
+the slots written meanwhile and swap the file in. Request-path writes never
+rehash; past FULL_LOAD they are skipped until the bigger index is in place.
+"""
+
+import os
+import re
+import sys
+import mmap
+import fcntl
+import struct
+import hashlib
+import logging
+import argparse
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = os.getenv('MOOSIC_TRACK_STORE_DIR', '/tmp/moosic_tracks')
+ENABLED = os.getenv('MOOSIC_TRACK_STORE', 'true').lower() in ('1', 'true', 'yes')
+
+HEADER = struct.Struct('<4sIQ')          # magic, version, count / end offset
+INDEX_HEADER = struct.Struct('<4sIII')   # magic, version, capacity, used
+SLOT = struct.Struct('<QI4x')            # key hash, record number / string offset + 1
+# id, name, artist, small/medium/large image URL (string offsets), popularity, year
+RECORD = struct.Struct('<22s5IBxH2x')
+STRING_LENGTH = struct.Struct('<H')
+VERSION = 1
+INDEX_SLOTS = int(os.getenv('MOOSIC_TRACK_STORE_INDEX_SLOTS', str(1 << 16)))
+INITIAL_CAPACITY = 1 << max(4, (INDEX_SLOTS - 1).bit_length())  # a power of two
+MAX_LOAD = 0.7
+FULL_LOAD = 0.9
+# Slots compared at a time when catching up with writes made during a rehash
+CATCH_UP_SLOTS = 4096
+MAX_STRING_BYTES = 2048
+IMAGE_WIDTHS = (64, 300, 640)
+
+
+def _clean(text):
+    return ' '.join(re.sub(r'[^\w\s]', '', (text or '').lower()).split())
+
+
+def normalize(title, artist):
+    """Lookup key for a song: lowercase, punctuation stripped, whitespace collapsed"""
+    return f"{_clean(title)}|{_clean(artist)}"
+
+
+class IndexFull(Exception):
+    """The index is too full for request-path writes until the background growth completes"""
+
+
+def _hash(key):
+    value = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+    return value or 1  # 0 marks an empty slot
+
+
+class TrackStore:
+    def __init__(self, directory=STORE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._paths = {name: os.path.join(directory, f"{name}.bin") for name in ('records', 'strings', 'index')}
+        self._lock_path = os.path.join(directory, 'writer.lock')
+        self._grow_lock_path = os.path.join(directory, 'grow.lock')
+        self._thread_lock = threading.Lock()
+        self._bulk = False
+        self._growing = False
+        self._maps = {}
+        self._index_inode = None
+        with self._writer():
+            pass
+
+    # -- mapping ---------------------------------------------------------
+
+    def _map(self, name, needed=0):
+        """Read-only map of a file, remapped when `needed` bytes lie beyond the current mapping"""
+        current = self._maps.get(name)
+        if current is not None and needed <= len(current):
+            return current
+        with open(self._paths[name], 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if name == 'index':
+                self._index_inode = os.fstat(f.fileno()).st_ino
+        self._maps[name] = mapped
+        return mapped
+
+    def _index_replaced(self):
+        try:
+            return os.stat(self._paths['index']).st_ino != self._index_inode
+        except OSError:
+            return False
+
+    def after_fork(self):
+        self._thread_lock = threading.Lock()
+        self._growing = False
+
+    # -- reading ---------------------------------------------------------
+
+    def __len__(self):
+        return HEADER.unpack_from(self._map('records'), 0)[2]
+
+    def _string(self, offset):
+        if not offset:
+            return None
+        strings = self._map('strings', offset + STRING_LENGTH.size)
+        (length,) = STRING_LENGTH.unpack_from(strings, offset)
+        strings = self._map('strings', offset + STRING_LENGTH.size + length)
+        start = offset + STRING_LENGTH.size
+        return strings[start:start + length].decode('utf-8')
+
+    def _probe(self, key_hash, accept):
+        index = self._map('index')
+        _, _, capacity, _ = INDEX_HEADER.unpack_from(index, 0)
+        mask = capacity - 1
+        slot = key_hash & mask
+        while True:
+            slot_hash, value = SLOT.unpack_from(index, INDEX_HEADER.size + slot * SLOT.size)
+            if slot_hash == 0:
+                return None, slot
+            if slot_hash == key_hash and value and accept(value - 1):
+                return value - 1, slot
+            slot = (slot + 1) & mask
+
+    def _lookup(self, key, accept):
+        key_hash = _hash(key)
+        found, _ = self._probe(key_hash, accept)
+        if found is None and self._index_replaced():
+            # A writer grew the index into a new file since we mapped it
+            self._maps.pop('index', None)
+            found, _ = self._probe(key_hash, accept)
+        return found
+
+    def _record(self, number):
+        offset = HEADER.size + number * RECORD.size
+        track_id, name, artist, small, medium, large, popularity, year = RECORD.unpack_from(
+            self._map('records', offset + RECORD.size), offset)
+        images = []
+        for width, url_offset in zip(reversed(IMAGE_WIDTHS), (large, medium, small)):
+            if url_offset:
+                images.append({'url': self._string(url_offset), 'width': width, 'height': width})
+        track_id = track_id.rstrip(b'\x00').decode('ascii')
+        # Shaped like a Spotify track object so callers can treat both alike
+        return {
+            'id': track_id,
+            'uri': f"spotify:track:{track_id}",
+            'name': self._string(name),
+            'artists': [{'name': self._string(artist)}],
+            'album': {'images': images, 'release_date': str(year) if year else ''},
+            'popularity': popularity,
+        }
+
+    def _published(self, number):
+        return number < len(self)
+
+    def _record_id(self, number):
+        offset = HEADER.size + number * RECORD.size
+        return self._map('records', offset + 22)[offset:offset + 22].rstrip(b'\x00').decode('ascii')
+
+    def get(self, track_id):
+        """The stored track with this Spotify id, or None"""
+        number = self._lookup(b'i:' + track_id.encode(),
+                              lambda n: self._published(n) and self._record_id(n) == track_id)
+        return self._record(number) if number is not None else None
+
+    def find(self, title, artist):
+        """The stored track a (title, artist) suggestion resolved to, or None"""
+        number = self._lookup(b'k:' + normalize(title, artist).encode(), self._published)
+        return self._record(number) if number is not None else None
+
+    # -- writing ---------------------------------------------------------
+
+    @contextmanager
+    def _writer(self):
+        with self._thread_lock, open(self._lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            fds = {}
+            try:
+                for name, path in self._paths.items():
+                    fds[name] = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                self._fds = fds
+                self._initialize()
+                if self._index_replaced():
+                    self._maps.pop('index', None)
+                yield
+            finally:
+                for fd in fds.values():
+                    os.close(fd)
+                self._fds = None
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _initialize(self):
+        for name, magic in (('records', b'MTRK'), ('strings', b'MSTR')):
+            if os.fstat(self._fds[name]).st_size == 0:
+                os.ftruncate(self._fds[name], 1 << 20)
+                os.pwrite(self._fds[name], HEADER.pack(magic, VERSION, HEADER.size if name == 'strings' else 0), 0)
+        if os.fstat(self._fds['index']).st_size == 0:
+            os.ftruncate(self._fds['index'], INDEX_HEADER.size + INITIAL_CAPACITY * SLOT.size)
+            os.pwrite(self._fds['index'], INDEX_HEADER.pack(b'MIDX', VERSION, INITIAL_CAPACITY, 0), 0)
+
+    def _header(self, name):
+        return HEADER.unpack(os.pread(self._fds[name], HEADER.size, 0))
+
+    def _reserve(self, name, end):
+        size = os.fstat(self._fds[name]).st_size
+        if end > size:
+            os.ftruncate(self._fds[name], max(end, size * 2))
+
+    def _index_header(self):
+        return INDEX_HEADER.unpack(os.pread(self._fds['index'], INDEX_HEADER.size, 0))
+
+    def _insert(self, key_hash, value):
+        _, _, capacity, used = self._index_header()
+        if used + 1 > capacity * MAX_LOAD:
+            if self._bulk:
+                self._grow_index(capacity * 2)
+                _, _, capacity, used = self._index_header()
+            else:
+                self._start_growth()
+        _, slot = self._probe(key_hash, lambda n: n + 1 == value)
+        os.pwrite(self._fds['index'], SLOT.pack(key_hash, value), INDEX_HEADER.size + slot * SLOT.size)
+        os.pwrite(self._fds['index'], INDEX_HEADER.pack(b'MIDX', VERSION, capacity, used + 1), 0)
+
+    @staticmethod
+    def _rehash(table, source, slots):
+        mask = (len(table) - INDEX_HEADER.size) // SLOT.size - 1
+        for i in slots:
+            key_hash, value = SLOT.unpack_from(source, INDEX_HEADER.size + i * SLOT.size)
+            if not key_hash:
+                continue
+            slot = key_hash & mask
+            while SLOT.unpack_from(table, INDEX_HEADER.size + slot * SLOT.size)[0]:
+                slot = (slot + 1) & mask
+            SLOT.pack_into(table, INDEX_HEADER.size + slot * SLOT.size, key_hash, value)
+
+    def _swap_index(self, table):
+        tmp_path = f"{self._paths['index']}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(table)
+        os.replace(tmp_path, self._paths['index'])
+        os.close(self._fds['index'])
+        self._fds['index'] = os.open(self._paths['index'], os.O_RDWR)
+        self._maps.pop('index', None)
+
+    def _grow_index(self, capacity):
+        """Rehash every slot into a table twice the size and swap it in; caller holds the writer lock"""
+        old = self._map('index')
+        _, _, old_capacity, used = INDEX_HEADER.unpack_from(old, 0)
+        table = bytearray(INDEX_HEADER.size + capacity * SLOT.size)
+        INDEX_HEADER.pack_into(table, 0, b'MIDX', VERSION, capacity, used)
+        self._rehash(table, old, range(old_capacity))
+        self._swap_index(table)
+        logger.info("Grew track store index to %s slots", capacity)
+
+    def _start_growth(self):
+        if self._growing:
+            return
+        self._growing = True
+        threading.Thread(target=self._grow_in_background, name='track-store-grow', daemon=True).start()
+
+    def _grow_in_background(self):
+        try:
+            self.grow()
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning("Could not grow track store index: %s", e)
+        finally:
+            self._growing = False
+
+    def grow(self, capacity=None):
+        """
+        Rehash the index into one of `capacity` slots (default: twice the
+        current) from a copy, holding the writer lock only to catch up with
+        the slots written meanwhile and swap the file in. One worker grows
+        at a time; returns False if another one is, or already has.
+        """
+        with open(self._grow_lock_path, 'a') as grow_lock:
+            try:
+                fcntl.flock(grow_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            self._maps.pop('index', None)
+            snapshot = bytes(self._map('index'))
+            _, _, old_capacity, _ = INDEX_HEADER.unpack_from(snapshot, 0)
+            capacity = capacity or old_capacity * 2
+            if capacity <= old_capacity:
+                return False
+            started = time.perf_counter()
+            table = bytearray(INDEX_HEADER.size + capacity * SLOT.size)
+            self._rehash(table, snapshot, range(old_capacity))
+
+            with self._writer():
+                current = self._map('index')
+                _, _, current_capacity, used = INDEX_HEADER.unpack_from(current, 0)
+                if current_capacity != old_capacity:
+                    return False
+                # Writes only ever fill empty slots, so the chunks that differ
+                # from the copy hold everything inserted during the rehash
+                for start in range(0, old_capacity, CATCH_UP_SLOTS):
+                    begin = INDEX_HEADER.size + start * SLOT.size
+                    end = begin + CATCH_UP_SLOTS * SLOT.size
+                    if current[begin:end] != snapshot[begin:end]:
+                        chunk = range(start, min(old_capacity, start + CATCH_UP_SLOTS))
+                        self._rehash(table, current, [i for i in chunk if not SLOT.unpack_from(
+                            snapshot, INDEX_HEADER.size + i * SLOT.size)[0]])
+                INDEX_HEADER.pack_into(table, 0, b'MIDX', VERSION, capacity, used)
+                self._swap_index(table)
+            logger.info("Grew track store index to %s slots in %.2fs", capacity, time.perf_counter() - started)
+            return True
+
+    def _intern(self, text):
+        if not text:
+            return 0
+        text = text.encode('utf-8')[:MAX_STRING_BYTES].decode('utf-8', 'ignore')
+        data = text.encode('utf-8')
+        key_hash = _hash(b's:' + data)
+        found, _ = self._probe(key_hash, lambda offset: self._string(offset) == text)
+        if found is not None:
+            return found
+
+        _, _, end = self._header('strings')
+        self._reserve('strings', end + STRING_LENGTH.size + len(data))
+        os.pwrite(self._fds['strings'], STRING_LENGTH.pack(len(data)) + data, end)
+        os.pwrite(self._fds['strings'], HEADER.pack(b'MSTR', VERSION, end + STRING_LENGTH.size + len(data)), 0)
+        self._insert(key_hash, end + 1)
+        return end
+
+    def put(self, track, aliases=()):
+        """
+        Store a Spotify track object (if new) and map its own name/artist plus
+        any (title, artist) aliases, e.g. the suggestion it resolved from, to it.
+        Returns the record number.
+        """
+        with self._writer():
+            # Upper bound on the slots one track takes: 5 strings, its id, its keys
+            _, _, capacity, used = self._index_header()
+            if used + 7 + len(aliases) > capacity * FULL_LOAD:
+                self._start_growth()
+                raise IndexFull(f"Track store index is {used / capacity:.0%} full; growing it")
+            return self._put(track, aliases)
+
+    def put_many(self, tracks):
+        """
+        Store (track, aliases) pairs under a single writer lock, for bulk
+        loads; grows the index inline when needed.
+        """
+        with self._writer():
+            self._bulk = True
+            try:
+                return [self._put(track, aliases) for track, aliases in tracks]
+            finally:
+                self._bulk = False
+
+    def _put(self, track, aliases):
+        track_id = track['id']
+        number = self._lookup(b'i:' + track_id.encode(), lambda n: self._record_id(n) == track_id)
+        keys = {normalize(track['name'], track['artists'][0]['name'])}
+        keys.update(normalize(title, artist) for title, artist in aliases)
+
+        if number is None:
+            images = {}
+            for image in track.get('album', {}).get('images') or []:
+                width = image.get('width') or 0
+                size = 'large' if width >= 600 else 'medium' if width >= 200 else 'small'
+                images.setdefault(size, image['url'])
+            release_date = track.get('album', {}).get('release_date') or ''
+            record = RECORD.pack(
+                track_id.encode('ascii')[:22],
+                self._intern(track['name']),
+                self._intern(track['artists'][0]['name']),
+                self._intern(images.get('small')),
+                self._intern(images.get('medium')),
+                self._intern(images.get('large')),
+                max(0, min(255, int(track.get('popularity') or 0))),
+                int(release_date[:4]) if release_date[:4].isdigit() else 0,
+            )
+            _, _, number = self._header('records')
+            offset = HEADER.size + number * RECORD.size
+            self._reserve('records', offset + RECORD.size)
+            os.pwrite(self._fds['records'], record, offset)
+            self._insert(_hash(b'i:' + track_id.encode()), number + 1)
+        else:
+            # Only add aliases that are not mapped yet
+            keys = {key for key in keys if self._lookup(b'k:' + key.encode(), lambda n: True) is None}
+
+        for key in keys:
+            self._insert(_hash(b'k:' + key.encode()), number + 1)
+        # Publish last: readers ignore records at or beyond the count
+        _, _, count = self._header('records')
+        if number >= count:
+            os.pwrite(self._fds['records'], HEADER.pack(b'MTRK', VERSION, number + 1), 0)
+        return number
+
+    def stats(self):
+        """Record count and bytes used per file"""
+        _, _, end = HEADER.unpack_from(self._map('strings'), 0)
+        _, _, capacity, used = INDEX_HEADER.unpack_from(self._map('index'), 0)
+        count = len(self)
+        return {
+            'tracks': count,
+            'record_bytes': HEADER.size + count * RECORD.size,
+            'string_bytes': end,
+            'index_bytes': INDEX_HEADER.size + capacity * SLOT.size,
+            'index_load': used / capacity,
+        }
+
+
+STORE = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """The process's handle on the shared store, or None when disabled or unavailable"""
+    global STORE
+    if STORE is None and ENABLED:
+        with _store_lock:
+            if STORE is None:
+                try:
+                    STORE = TrackStore(STORE_DIR)
+                except OSError as e:
+                    logger.warning("Track store unavailable at %s: %s", STORE_DIR, e)
+    return STORE
+
+
+def find(title, artist):
+    """Look up a resolved suggestion; never raises"""
+    store = get_store()
+    if store is None:
+        return None
+    try:
+        track = store.find(title, artist)
+    except (OSError, ValueError, struct.error) as e:
+        logger.warning("Track store lookup failed: %s", e)
+        return None
+    metrics.cache_lookup('track_store', track is not None)
+    return track
+
+
+def remember(track, title=None, artist=None):
+    """Store a resolved track, aliased to the suggestion it came from; never raises"""
+    store = get_store()
+    if store is None:
+        return
+    try:
+        store.put(track, [(title, artist)] if title and artist else ())
+    except IndexFull as e:
+        logger.info("Not storing track %s: %s", track.get('id'), e)
+    except (OSError, ValueError, KeyError, IndexError, struct.error) as e:
+        logger.warning("Could not store track %s: %s", track.get('id'), e)
+
+
+def _after_fork():
+    if STORE is not None:
+        STORE.after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or resize the shared track store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('stats', help='Print record count, file sizes and index load')
+    grow_parser = subparsers.add_parser('grow', help='Resize the index ahead of time, e.g. before a bulk load')
+    grow_parser.add_argument('--slots', type=int, help='Index slots (rounded up to a power of two; default: double)')
+    parser.add_argument('--dir', default=STORE_DIR, help='Track store directory')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    store = TrackStore(args.dir)
+    if args.command == 'grow':
+        capacity = 1 << (args.slots - 1).bit_length() if args.slots else None
+        if not store.grow(capacity):
+            print("Index not grown: already that size, or another worker is growing it")
+    for name, value in store.stats().items():
+        print(f"{name:<14} {value:.2f}" if isinstance(value, float) else f"{name:<14} {value}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())